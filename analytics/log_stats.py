@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Потоковая аналитика по JSONL-логам (logs/*.jsonl и сжатые сегменты из manifest.json).
+Каждый сегмент читается построчно генератором и сворачивается в небольшие агрегаты
+в отдельном процессе, затем агрегаты сегментов объединяются.
+
+Пример:
+    python -m analytics.log_stats --logs-dir logs --since 2024-05-01 --top 20
+"""
+
+import argparse
+import bisect
+import glob
+import gzip
+import io
+import json
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import zstandard
+except ImportError:  # zstd-сегменты читаются только при установленном zstandard
+    zstandard = None
+
+# Границы корзин гистограммы задержек, секунды: от 1 мс до ~90 с с шагом x1.25
+LATENCY_BUCKETS = [0.001 * 1.25 ** i for i in range(52)]
+
+# Сколько разных значений держать в счётчиках ввода (остальное — хвост с малыми частотами)
+MAX_COUNTER_KEYS = 50000
+
+
+class LatencyHistogram:
+    """Гистограмма с фиксированными корзинами: складывается между сегментами, память O(1)"""
+
+    def __init__(self, counts=None):
+        self.counts = list(counts) if counts else [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+
+    @property
+    def total(self):
+        return sum(self.counts)
+
+    def percentile(self, p):
+        """Верхняя граница корзины, в которую попадает p-й перцентиль"""
+        total = self.total
+        if not total:
+            return None
+        rank = total * p / 100
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else float("inf")
+        return float("inf")
+
+
+def _prune(counter, limit):
+    if len(counter) > limit:
+        # Приближённый top-k: отбрасываем редкие значения, чтобы память не росла
+        kept = counter.most_common(limit // 2)
+        counter.clear()
+        counter.update(dict(kept))
+
+
+def bounded_update(counter, key, limit):
+    counter[key] += 1
+    _prune(counter, limit)
+
+
+def bounded_merge(counter, other, limit):
+    """Складывает счётчики сегментов с тем же ограничением числа ключей, что и при чтении"""
+    counter.update(other)
+    _prune(counter, limit)
+
+
+class LogStats:
+    """Агрегаты по одному или нескольким сегментам"""
+
+    def __init__(self, max_counter_keys=MAX_COUNTER_KEYS):
+        self.max_counter_keys = max_counter_keys
+        self.events = Counter()
+        self.not_found = Counter()
+        self.searches_by_city_day = Counter()
+        self.search_results = Counter()
+        self.latency = LatencyHistogram()
+        self.bad_lines = 0
+
+    def add(self, entry):
+        event = entry.get("event")
+        self.events[event] += 1
+        if event == "store_not_found":
+            bounded_update(self.not_found, str(entry.get("input", "")).strip().lower(), self.max_counter_keys)
+        elif event == "store_search":
+            day = str(entry.get("timestamp", ""))[:10]
+            self.searches_by_city_day[(day, entry.get("city"))] += 1
+        elif event == "search_result":
+            self.search_results[entry.get("result")] += 1
+        elif event == "http_response" and isinstance(entry.get("duration"), (int, float)):
+            self.latency.add(entry["duration"])
+
+    def merge(self, other):
+        bounded_merge(self.events, other.events, self.max_counter_keys)
+        bounded_merge(self.not_found, other.not_found, self.max_counter_keys)
+        # Ключи ниже — день x город и результат поиска: их немного, но ограничиваем и их
+        bounded_merge(self.searches_by_city_day, other.searches_by_city_day, self.max_counter_keys)
+        bounded_merge(self.search_results, other.search_results, self.max_counter_keys)
+        self.latency.merge(other.latency)
+        self.bad_lines += other.bad_lines
+
+    def report(self, top=20):
+        added = self.events.get("store_added", 0)
+        results = self.events.get("search_result", 0)
+        return {
+            "events": dict(self.events.most_common()),
+            "top_store_not_found": self.not_found.most_common(top),
+            "searches_per_city_per_day": [
+                {"day": day, "city": city, "searches": count}
+                for (day, city), count in sorted(self.searches_by_city_day.items(), key=lambda x: (x[0][0], str(x[0][1])))
+            ],
+            "conversion": {
+                "store_added": added,
+                "search_result": results,
+                "search_result_found": self.search_results.get("found", 0),
+                "search_result_no_matches": self.search_results.get("no_matches", 0),
+                "search_result_per_store_added": round(results / added, 4) if added else None,
+            },
+            "latency": {
+                "count": self.latency.total,
+                "p50": self.latency.percentile(50),
+                "p90": self.latency.percentile(90),
+                "p99": self.latency.percentile(99),
+            },
+            "bad_lines": self.bad_lines,
+        }
+
+
+def open_segment(path):
+    """Открывает сегмент лога как текстовый поток (обычный, .gz или .zst)"""
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError(f"Для чтения {path} нужен пакет zstandard")
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+        return io.TextIOWrapper(reader, encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+
+def iter_events(path, stats=None):
+    """Генератор записей сегмента; битые строки пропускаются и считаются в stats.bad_lines"""
+    with open_segment(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                if stats is not None:
+                    stats.bad_lines += 1
+                continue
+            if isinstance(entry, dict):
+                yield entry
+
+
+def aggregate_segment(path, since=None, until=None):
+    stats = LogStats()
+    for entry in iter_events(path, stats):
+        if since or until:
+            day = str(entry.get("timestamp", ""))[:10]
+            if (since and day < since) or (until and day > until):
+                continue
+        stats.add(entry)
+    return stats
+
+
+def _in_range(first_ts, last_ts, since, until):
+    if since and last_ts and last_ts[:10] < since:
+        return False
+    if until and first_ts and first_ts[:10] > until:
+        return False
+    return True
+
+
+def find_segments(logs_dir, since=None, until=None, include_live=True):
+    """Сегменты из manifest.json, пересекающиеся с [since, until], и текущие *.jsonl"""
+    paths = []
+    manifest_path = os.path.join(logs_dir, "manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            segments = json.load(f).get("segments", [])
+        for segment in segments:
+            if not _in_range(segment.get("first_ts"), segment.get("last_ts"), since, until):
+                continue
+            path = segment["path"]
+            if not os.path.exists(path):
+                # Пути в манифесте относительны каталогу запуска logic_api
+                path = os.path.join(logs_dir, os.path.basename(path))
+            if os.path.exists(path):
+                paths.append(path)
+    if include_live:
+        # Открытые сегменты (без даты в имени) ещё не в манифесте
+        for path in sorted(glob.glob(os.path.join(logs_dir, "*.jsonl"))):
+            if os.path.basename(path).count(".") == 1:
+                paths.append(path)
+    return paths
+
+
+def collect(paths, workers=None, since=None, until=None):
+    total = LogStats()
+    if workers == 1 or len(paths) <= 1:
+        for path in paths:
+            total.merge(aggregate_segment(path, since, until))
+        return total
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        n = len(paths)
+        for stats in pool.map(aggregate_segment, paths, [since] * n, [until] * n):
+            total.merge(stats)
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Аналитика по JSONL-логам бота")
+    parser.add_argument("--logs-dir", default="logs")
+    parser.add_argument("--since", help="YYYY-MM-DD, включительно")
+    parser.add_argument("--until", help="YYYY-MM-DD, включительно")
+    parser.add_argument("--top", type=int, default=20, help="Размер топа ненайденных магазинов")
+    parser.add_argument("--workers", type=int, default=None, help="Число процессов (по умолчанию — по числу CPU)")
+    parser.add_argument("--closed-only", action="store_true", help="Только закрытые сегменты из манифеста")
+    parser.add_argument("segments", nargs="*", help="Явный список файлов вместо поиска в --logs-dir")
+    args = parser.parse_args()
+
+    paths = args.segments or find_segments(args.logs_dir, args.since, args.until, include_live=not args.closed_only)
+    stats = collect(paths, args.workers, args.since, args.until)
+    print(json.dumps(stats.report(args.top), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
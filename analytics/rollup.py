@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Дневные агрегаты по закрытым сегментам логов в SQLite.
+Каждый сегмент из logs/manifest.json сворачивается один раз: счётчики событий,
+поиски по городам, добавления магазинов и гистограмма задержек по дням.
+Дашборды читают эти таблицы вместо сырых логов.
+
+Пример:
+    python -m analytics.rollup --logs-dir logs            # досчитать новые сегменты
+    python -m analytics.rollup --report --since 2024-05-01
+"""
+
+import argparse
+import bisect
+import json
+import os
+import sqlite3
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from analytics.log_stats import LATENCY_BUCKETS, LatencyHistogram, find_segments, iter_events
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rollup_segments (
+    path TEXT PRIMARY KEY,
+    events INTEGER NOT NULL,
+    processed_at TEXT NOT NULL DEFAULT (datetime('now'))
+);
+CREATE TABLE IF NOT EXISTS daily_events (
+    day TEXT NOT NULL, event TEXT NOT NULL, count INTEGER NOT NULL,
+    PRIMARY KEY (day, event)
+);
+CREATE TABLE IF NOT EXISTS daily_city_searches (
+    day TEXT NOT NULL, city TEXT NOT NULL, count INTEGER NOT NULL,
+    PRIMARY KEY (day, city)
+);
+CREATE TABLE IF NOT EXISTS daily_store_adds (
+    day TEXT NOT NULL, store TEXT NOT NULL, count INTEGER NOT NULL,
+    PRIMARY KEY (day, store)
+);
+CREATE TABLE IF NOT EXISTS daily_latency (
+    day TEXT NOT NULL, bucket INTEGER NOT NULL, count INTEGER NOT NULL,
+    PRIMARY KEY (day, bucket)
+);
+"""
+
+TABLES = {
+    "events": ("daily_events", "event"),
+    "city_searches": ("daily_city_searches", "city"),
+    "store_adds": ("daily_store_adds", "store"),
+    "latency": ("daily_latency", "bucket"),
+}
+
+
+def rollup_segment(path):
+    """Агрегаты одного сегмента: {таблица: Counter((day, ключ) -> count)}"""
+    result = {name: Counter() for name in TABLES}
+    events = 0
+    for entry in iter_events(path):
+        events += 1
+        day = str(entry.get("timestamp", ""))[:10]
+        event = entry.get("event")
+        result["events"][(day, str(event))] += 1
+        if event == "store_search":
+            result["city_searches"][(day, str(entry.get("city")))] += 1
+        elif event == "store_added" and entry.get("store"):
+            result["store_adds"][(day, entry["store"])] += 1
+        elif event == "http_response" and isinstance(entry.get("duration"), (int, float)):
+            result["latency"][(day, bisect.bisect_left(LATENCY_BUCKETS, entry["duration"]))] += 1
+    return path, events, result
+
+
+def connect(db_path):
+    directory = os.path.dirname(db_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _store(conn, path, events, result):
+    """Агрегаты сегмента и отметка об обработке — в одной транзакции; повторный сегмент пропускается"""
+    with conn:
+        # Сегмент мог обработать параллельный запуск — тогда счётчики не трогаем
+        if conn.execute("INSERT OR IGNORE INTO rollup_segments (path, events) VALUES (?, ?)", (path, events)).rowcount == 0:
+            return False
+        for name, counter in result.items():
+            table, column = TABLES[name]
+            conn.executemany(
+                f"INSERT INTO {table} (day, {column}, count) VALUES (?, ?, ?) "
+                f"ON CONFLICT (day, {column}) DO UPDATE SET count = count + excluded.count",
+                [(day, key, count) for (day, key), count in counter.items()],
+            )
+    return True
+
+
+def update_rollups(logs_dir, db_path, workers=None):
+    """Сворачивает ещё не обработанные закрытые сегменты; возвращает их число"""
+    conn = connect(db_path)
+    done = {row[0] for row in conn.execute("SELECT path FROM rollup_segments")}
+    pending = [p for p in find_segments(logs_dir, include_live=False) if p not in done]
+    if workers == 1 or len(pending) <= 1:
+        for path, events, result in map(rollup_segment, pending):
+            _store(conn, path, events, result)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for path, events, result in pool.map(rollup_segment, pending):
+                _store(conn, path, events, result)
+    conn.close()
+    return len(pending)
+
+
+def _day(days, day):
+    return days.setdefault(day, {"events": {}, "searches_by_city": {}, "latency": {}})
+
+
+def daily_report(db_path, since=None, until=None):
+    conn = connect(db_path)
+    where = "WHERE day >= ? AND day <= ?"
+    params = (since or "0000-00-00", until or "9999-99-99")
+    days = {}
+    for day, event, count in conn.execute(f"SELECT day, event, count FROM daily_events {where} ORDER BY day", params):
+        _day(days, day)["events"][event] = count
+    for day, city, count in conn.execute(f"SELECT day, city, count FROM daily_city_searches {where}", params):
+        _day(days, day)["searches_by_city"][city] = count
+    histograms = {}
+    for day, bucket, count in conn.execute(f"SELECT day, bucket, count FROM daily_latency {where}", params):
+        histogram = histograms.setdefault(day, LatencyHistogram())
+        histogram.counts[bucket] += count
+    for day, histogram in histograms.items():
+        _day(days, day)["latency"] = {
+            "count": histogram.total,
+            "p50": histogram.percentile(50),
+            "p90": histogram.percentile(90),
+            "p99": histogram.percentile(99),
+        }
+    conn.close()
+    return dict(sorted(days.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Дневные агрегаты по логам бота в SQLite")
+    parser.add_argument("--logs-dir", default="logs")
+    parser.add_argument("--db", default=os.path.join("logs", "rollups.sqlite"))
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--report", action="store_true", help="Показать агрегаты вместо пересчёта")
+    parser.add_argument("--since", help="YYYY-MM-DD, для --report")
+    parser.add_argument("--until", help="YYYY-MM-DD, для --report")
+    args = parser.parse_args()
+
+    if args.report:
+        print(json.dumps(daily_report(args.db, args.since, args.until), ensure_ascii=False, indent=2))
+    else:
+        count = update_rollups(args.logs_dir, args.db, args.workers)
+        print(f"Обработано сегментов: {count}")
+
+
+if __name__ == "__main__":
+    main()
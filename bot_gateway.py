@@ -1,23 +1,306 @@
 import asyncio
-from aiogram import Bot, Dispatcher, types
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from aiogram import BaseMiddleware, Bot, Dispatcher, types
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
+from aiogram.exceptions import TelegramBadRequest
 import aiohttp
-from config import BOT_TOKEN
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from config import (
+    BOT_TOKEN,
+    LOGIC_MODE,
+    LOGIC_API_BASE_URL,
+    GATEWAY_HTTP_LIMIT,
+    GATEWAY_HTTP_KEEPALIVE,
+    GATEWAY_DNS_TTL,
+    GATEWAY_HTTP_TIMEOUT,
+    GATEWAY_RUN_MODE,
+    GATEWAY_MAX_CONCURRENCY,
+    GATEWAY_SHUTDOWN_TIMEOUT,
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    WEBHOOK_PATH,
+    WEBHOOK_URL,
+    WEBHOOK_SECRET,
+    WEBHOOK_MAX_CONNECTIONS,
+)
 from aiogram.types import LinkPreviewOptions
+from send_scheduler import PRIORITY_HIGH, PRIORITY_NORMAL, SendScheduler
 import os
 
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN is not set in environment variables!")
+if LOGIC_MODE not in ("http", "embedded"):
+    raise ValueError(f"Unknown LOGIC_MODE: {LOGIC_MODE}")
+if GATEWAY_RUN_MODE not in ("polling", "webhook"):
+    raise ValueError(f"Unknown GATEWAY_RUN_MODE: {GATEWAY_RUN_MODE}")
 
-LOGIC_API_URL = "http://localhost:8000/handle_update"
-LOGIC_API_CALLBACK_URL = "http://localhost:8000/handle_callback"
+if LOGIC_MODE == "embedded":
+    # Логика в том же процессе: обработчики вызываются как обычные корутины
+    import logic_api
+
+LOGIC_API_URL = f"{LOGIC_API_BASE_URL}/handle_update"
+LOGIC_API_CALLBACK_URL = f"{LOGIC_API_BASE_URL}/handle_callback"
 API_TOKEN = os.getenv("API_TOKEN")
 HEADERS = {"Authorization": f"Bearer {API_TOKEN}"}
 
 bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 dp = Dispatcher()
 
+# Одна HTTP-сессия к logic_api на процесс: соединения переиспользуются (keep-alive)
+http_session = None
+
+
+class GatewayStats:
+    """Время обращений к logic_api, добавляемое шлюзом к обработке апдейта"""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.total_duration = 0.0
+        self.max_duration = 0.0
+
+    def add(self, duration, ok=True):
+        self.requests += 1
+        self.total_duration += duration
+        self.max_duration = max(self.max_duration, duration)
+        if not ok:
+            self.errors += 1
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "avg_duration": self.total_duration / self.requests if self.requests else None,
+            "max_duration": self.max_duration,
+        }
+
+
+gateway_stats = GatewayStats()
+
+
+def _chat_key(update):
+    """Чат апдейта: в его пределах апдейты обрабатываются строго по очереди"""
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query:
+        callback = update.callback_query
+        return callback.message.chat.id if callback.message else callback.from_user.id
+    return None
+
+
+class ChatOrderedDispatcher(BaseMiddleware):
+    """
+    Упорядоченная по чатам обработка апдейтов.
+    Апдейт встаёт в очередь своего чата; очередь разбирает одна задача, поэтому
+    внутри чата порядок сохраняется (FSM не видит гонок), а разные чаты
+    обрабатываются параллельно. Ограничение limit действует только на обращения
+    к логике (logic_slot): ожидание отправки под лимитами Telegram слот не занимает.
+    Считает незавершённые апдейты, чтобы при остановке дождаться их до закрытия сессий.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._semaphore = asyncio.Semaphore(limit)
+        self._queues = {}  # chat -> deque[(handler, event, data, future, enqueued_at)]
+        self._workers = set()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.in_flight = 0
+        self.running = 0
+        self.logic_running = 0
+        self.processed = 0
+        self.max_queue_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.logic_calls = 0
+        self.total_logic_wait = 0.0
+        self.max_logic_wait = 0.0
+
+    async def __call__(self, handler, event, data):
+        self.in_flight += 1
+        self._idle.clear()
+        try:
+            chat = _chat_key(event)
+            if chat is None:
+                return await self._run(handler, event, data, time.perf_counter())
+            future = asyncio.get_running_loop().create_future()
+            item = (handler, event, data, future, time.perf_counter())
+            queue = self._queues.get(chat)
+            if queue is None:
+                queue = self._queues[chat] = deque([item])
+                worker = asyncio.create_task(self._drain(chat, queue))
+                self._workers.add(worker)
+                worker.add_done_callback(self._workers.discard)
+            else:
+                queue.append(item)
+                self.max_queue_depth = max(self.max_queue_depth, len(queue))
+            return await future
+        finally:
+            self.in_flight -= 1
+            if self.in_flight == 0:
+                self._idle.set()
+
+    async def _run(self, handler, event, data, enqueued_at):
+        wait = time.perf_counter() - enqueued_at
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.running += 1
+        try:
+            return await handler(event, data)
+        finally:
+            self.running -= 1
+            self.processed += 1
+
+    @asynccontextmanager
+    async def logic_slot(self):
+        """Одно из limit одновременных обращений к логике"""
+        start_time = time.perf_counter()
+        async with self._semaphore:
+            wait = time.perf_counter() - start_time
+            self.logic_calls += 1
+            self.total_logic_wait += wait
+            self.max_logic_wait = max(self.max_logic_wait, wait)
+            self.logic_running += 1
+            try:
+                yield
+            finally:
+                self.logic_running -= 1
+
+    async def _drain(self, chat, queue):
+        try:
+            while queue:
+                handler, event, data, future, enqueued_at = queue[0]
+                try:
+                    result = await self._run(handler, event, data, enqueued_at)
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+                queue.popleft()
+        finally:
+            # При отмене воркера оставшиеся апдейты чата не должны ждать вечно,
+            # а очередь — блокировать следующий апдейт этого чата
+            for _, _, _, future, _ in queue:
+                if not future.done():
+                    future.cancel()
+            self._queues.pop(chat, None)
+
+    async def wait_idle(self, timeout):
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "running": self.running,
+            "logic_running": self.logic_running,
+            "queued": self.in_flight - self.running,
+            "chats": len(self._queues),
+            "queue_depth": max((len(q) for q in self._queues.values()), default=0),
+            "max_queue_depth": self.max_queue_depth,
+            "processed": self.processed,
+            "avg_wait": self.total_wait / self.processed if self.processed else None,
+            "max_wait": self.max_wait,
+            "avg_logic_wait": self.total_logic_wait / self.logic_calls if self.logic_calls else None,
+            "max_logic_wait": self.max_logic_wait,
+        }
+
+
+update_dispatcher = ChatOrderedDispatcher(GATEWAY_MAX_CONCURRENCY)
+dp.update.outer_middleware(update_dispatcher)
+
+# Все исходящие сообщения идут через планировщик с лимитами Telegram
+send_scheduler = SendScheduler()
+# Длинные тексты (результаты поиска) уступают очередь коротким ответам
+LONG_TEXT_LENGTH = 1000
+
+
+def send_priority(text):
+    return PRIORITY_NORMAL if text and len(text) > LONG_TEXT_LENGTH else PRIORITY_HIGH
+
+
+def create_http_session():
+    connector = aiohttp.TCPConnector(
+        limit=GATEWAY_HTTP_LIMIT,
+        keepalive_timeout=GATEWAY_HTTP_KEEPALIVE,
+        ttl_dns_cache=GATEWAY_DNS_TTL,
+        use_dns_cache=True,
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        headers=HEADERS,
+        timeout=aiohttp.ClientTimeout(total=GATEWAY_HTTP_TIMEOUT),
+    )
+
+
+@dp.startup()
+async def on_startup():
+    global http_session
+    send_scheduler.start()
+    if LOGIC_MODE == "embedded":
+        await logic_api.startup()
+    else:
+        http_session = create_http_session()
+    if GATEWAY_RUN_MODE == "webhook" and WEBHOOK_URL:
+        # Все реплики регистрируют один и тот же адрес балансировщика
+        await bot.set_webhook(
+            f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+
+
+@dp.shutdown()
+async def on_shutdown():
+    global http_session
+    # Новые апдейты уже не принимаются — даём начатым закончиться
+    if not await update_dispatcher.wait_idle(GATEWAY_SHUTDOWN_TIMEOUT):
+        print(f"Остановка: не дождались {update_dispatcher.in_flight} апдейтов")
+    await send_scheduler.stop()
+    if LOGIC_MODE == "embedded":
+        await logic_api.shutdown()
+    if http_session is not None:
+        await http_session.close()
+        http_session = None
+    print(f"logic_api ({LOGIC_MODE}): {gateway_stats.as_dict()}")
+    print(f"Отправка сообщений: {send_scheduler.stats()}")
+
+
+async def call_logic_api(kind, payload):
+    """kind: "update" (сообщение) или "callback" (инлайн-кнопка); возвращает ответ логики как dict"""
+    async with update_dispatcher.logic_slot():
+        return await _call_logic_api(kind, payload)
+
+
+async def _call_logic_api(kind, payload):
+    start_time = time.perf_counter()
+    ok = False
+    try:
+        if LOGIC_MODE == "embedded":
+            handler = logic_api.process_update if kind == "update" else logic_api.process_callback
+            data = await handler(payload)
+            ok = True
+            return data
+        url = LOGIC_API_URL if kind == "update" else LOGIC_API_CALLBACK_URL
+        async with http_session.post(url, json=payload) as resp:
+            data = await resp.json()
+            ok = resp.status == 200
+            return data
+    finally:
+        gateway_stats.add(time.perf_counter() - start_time, ok)
+
+
 def dict_to_reply_markup(markup_dict):
     if not markup_dict:
         return None
@@ -43,51 +326,115 @@ def dict_to_reply_markup(markup_dict):
 
 @dp.message()
 async def handle_message(message: types.Message):
-    async with aiohttp.ClientSession() as session:
-        payload = {
-            "user_id": message.from_user.id if message.from_user else None,
-            "username": message.from_user.username if message.from_user else None,
-            "first_name": message.from_user.first_name if message.from_user else None,
-            "text": message.text,
-            "chat_id": message.chat.id,
-        }
-        async with session.post(LOGIC_API_URL, json=payload, headers=HEADERS) as resp:
-            data = await resp.json()
-            reply_markup = dict_to_reply_markup(data.get("reply_markup"))
-            link_preview_options = None
-            if data.get("disable_web_page_preview"):
-                link_preview_options = LinkPreviewOptions(is_disabled=True)
-            await message.answer(
-                data["text"],
-                reply_markup=reply_markup,
-                link_preview_options=link_preview_options
+    payload = {
+        "user_id": message.from_user.id if message.from_user else None,
+        "username": message.from_user.username if message.from_user else None,
+        "first_name": message.from_user.first_name if message.from_user else None,
+        "text": message.text,
+        "chat_id": message.chat.id,
+    }
+    data = await call_logic_api("update", payload)
+    reply_markup = dict_to_reply_markup(data.get("reply_markup"))
+    link_preview_options = None
+    if data.get("disable_web_page_preview"):
+        link_preview_options = LinkPreviewOptions(is_disabled=True)
+    await send_scheduler.submit(
+        message.chat.id,
+        lambda: message.answer(
+            data["text"],
+            reply_markup=reply_markup,
+            link_preview_options=link_preview_options
+        ),
+        send_priority(data["text"]),
+    )
+
+async def apply_edit(chat_id, edit, text, reply_markup, link_preview_options):
+    """
+    Директива "edit" от логики: правка сообщения с нажатой кнопкой вместо нового.
+    Возвращает True, если ответ уже показан редактированием; False — ответ надо отправить новым сообщением.
+    """
+    message_id = edit.get("message_id")
+    if message_id is None:
+        return False
+    if edit.get("method") == "text" and (reply_markup is None or isinstance(reply_markup, types.InlineKeyboardMarkup)):
+        try:
+            await send_scheduler.submit(
+                chat_id,
+                lambda: bot.edit_message_text(
+                    text,
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    reply_markup=reply_markup,
+                    link_preview_options=link_preview_options
+                ),
+                send_priority(text),
             )
+            return True
+        except TelegramBadRequest as e:
+            # Сообщение не изменилось — ответ уже на экране; иначе (старое или удалённое) шлём новое
+            return "message is not modified" in str(e)
+    # "reply_markup": убираем инлайн-кнопки, ответ уходит отдельно
+    try:
+        await send_scheduler.submit(
+            chat_id,
+            lambda: bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id, reply_markup=None),
+        )
+    except TelegramBadRequest:
+        pass
+    return False
 
 @dp.callback_query()
 async def handle_callback_query(callback: types.CallbackQuery):
-    async with aiohttp.ClientSession() as session:
-        payload = {
-            "user_id": callback.from_user.id if callback.from_user else None,
-            "callback_data": callback.data,
-            "message_id": callback.message.message_id if callback.message else None,
-            "chat_id": callback.message.chat.id if callback.message else None,
-        }
-        async with session.post(LOGIC_API_CALLBACK_URL, json=payload, headers=HEADERS) as resp:
-            data = await resp.json()
-            reply_markup = dict_to_reply_markup(data.get("reply_markup"))
-            link_preview_options = None
-            if data.get("disable_web_page_preview"):
-                link_preview_options = LinkPreviewOptions(is_disabled=True)
-            if callback.message:
-                await callback.message.answer(
-                    data["text"],
-                    reply_markup=reply_markup,
-                    link_preview_options=link_preview_options
-                )
-        await callback.answer()
+    payload = {
+        "user_id": callback.from_user.id if callback.from_user else None,
+        "callback_data": callback.data,
+        "message_id": callback.message.message_id if callback.message else None,
+        "chat_id": callback.message.chat.id if callback.message else None,
+    }
+    data = await call_logic_api("callback", payload)
+    reply_markup = dict_to_reply_markup(data.get("reply_markup"))
+    link_preview_options = None
+    if data.get("disable_web_page_preview"):
+        link_preview_options = LinkPreviewOptions(is_disabled=True)
+    if callback.message:
+        chat_id = callback.message.chat.id
+        edit = data.get("edit")
+        if edit and await apply_edit(chat_id, edit, data["text"], reply_markup, link_preview_options):
+            await callback.answer()
+            return
+        await send_scheduler.submit(
+            chat_id,
+            lambda: callback.message.answer(
+                data["text"],
+                reply_markup=reply_markup,
+                link_preview_options=link_preview_options
+            ),
+            send_priority(data["text"]),
+        )
+    await callback.answer()
+
+async def metrics(request: web.Request):
+    if request.headers.get("Authorization") != f"Bearer {API_TOKEN}":
+        raise web.HTTPUnauthorized()
+    return web.json_response({
+        "logic_api": gateway_stats.as_dict(),
+        "updates": update_dispatcher.stats(),
+        "sends": send_scheduler.stats(),
+    })
+
+def run_webhook():
+    """Webhook-сервер: Telegram присылает апдейты POST-запросами, ответ 200 отдаётся сразу"""
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    app.router.add_get("/metrics", metrics)
+    setup_application(app, dp, bot=bot)
+    web.run_app(app, host=WEBHOOK_HOST, port=WEBHOOK_PORT, shutdown_timeout=GATEWAY_SHUTDOWN_TIMEOUT)
 
 async def main():
     await dp.start_polling(bot)
 
 if __name__ == "__main__":
-    asyncio.run(main()) 
\ No newline at end of file
+    if GATEWAY_RUN_MODE == "webhook":
+        run_webhook()
+    else:
+        asyncio.run(main())
@@ -14,6 +14,82 @@ MALLS_FILE = os.getenv("MALLS_FILE")
 ALIASES_FILE = os.getenv("ALIASES_FILE")
 USER_MAP_FILE = os.getenv("USER_MAP_FILE")
 USER_MAP_KEY_FILE = os.getenv("USER_MAP_KEY_FILE")
-LOG_FILE = os.getenv("LOG_FILE")
-USER_ACTIVITY_LOG_FILE = os.getenv("USER_ACTIVITY_LOG_FILE")
-ERROR_LOG_FILE = os.getenv("ERROR_LOG_FILE")
\ No newline at end of file
+
+# Логи (JSON Lines, см. logger.py)
+LOG_FILE = os.getenv("LOG_FILE", "logs/technical.jsonl")
+USER_ACTIVITY_LOG_FILE = os.getenv("USER_ACTIVITY_LOG_FILE", "logs/users_activity.jsonl")
+ERROR_LOG_FILE = os.getenv("ERROR_LOG_FILE", "logs/errors.jsonl")
+# Ротация: по размеру (0 — выключено) и/или раз в сутки
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+LOG_ROTATE_DAILY = os.getenv("LOG_ROTATE_DAILY", "1") == "1"
+# Закрытые сегменты сжимаются (gzip, zstd или none) и попадают в манифест
+LOG_COMPRESSION = os.getenv("LOG_COMPRESSION", "gzip")
+LOG_MANIFEST = os.getenv("LOG_MANIFEST", "logs/manifest.json")
+# Фоновая запись: размер очереди, строк за одну запись и политика при переполнении
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "500"))
+LOG_QUEUE_POLICY = os.getenv("LOG_QUEUE_POLICY", "drop_new")
+LOG_QUEUE_BLOCK_TIMEOUT = float(os.getenv("LOG_QUEUE_BLOCK_TIMEOUT", "0.05"))
+# Уровни и сэмплирование по типам событий (формат — в logger.py)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "info")
+LOG_EVENT_LEVELS = os.getenv("LOG_EVENT_LEVELS")
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES")
+
+# Redis: адрес, пул соединений, таймауты и повторы при сбоях
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", "0"))  # 0 — не ждать свободного соединения
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "2.0"))
+REDIS_CONNECT_TIMEOUT = float(os.getenv("REDIS_CONNECT_TIMEOUT", "2.0"))
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", "30"))
+REDIS_RETRY_ATTEMPTS = int(os.getenv("REDIS_RETRY_ATTEMPTS", "3"))
+REDIS_RETRY_BACKOFF_BASE = float(os.getenv("REDIS_RETRY_BACKOFF_BASE", "0.05"))
+REDIS_RETRY_BACKOFF_CAP = float(os.getenv("REDIS_RETRY_BACKOFF_CAP", "1.0"))
+
+# Хранилище сессий (FSM и user_data): redis или memory (dict + TTL, один процесс)
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "redis")
+SESSION_TTL = int(os.getenv("SESSION_TTL", "604800"))  # секунд, только для memory
+
+# Трассировка обращений к хранилищу сессий (по умолчанию выключена)
+REDIS_TRACE_LEVEL = os.getenv("REDIS_TRACE_LEVEL", "WARNING")  # DEBUG — включить трассировку
+REDIS_TRACE_SAMPLE_RATE = float(os.getenv("REDIS_TRACE_SAMPLE_RATE", "0.01"))
+REDIS_TRACE_MAX_PAYLOAD = int(os.getenv("REDIS_TRACE_MAX_PAYLOAD", "200"))
+REDIS_TRACE_FILE = os.getenv("REDIS_TRACE_FILE", "my_redis.log")
+
+# Сохранённые запросы: SQLite-база и старый JSON-файл (переносится в базу при первом запуске)
+SAVED_QUERIES_DB = os.getenv("SAVED_QUERIES_DB", "saved_queries.sqlite")
+SAVED_QUERIES_FILE = os.getenv("SAVED_QUERIES_FILE", "saved_queries.json")
+SAVED_QUERIES_CACHE_SIZE = int(os.getenv("SAVED_QUERIES_CACHE_SIZE", "10000"))  # пользователей в кэше воркера
+# Сколько секунд кэш воркера отдаёт список без сверки версии с базой (0 — сверять при каждом чтении).
+# Записи других воркеров становятся видны не позже чем через это время
+SAVED_QUERIES_CACHE_TTL = float(os.getenv("SAVED_QUERIES_CACHE_TTL", "2"))
+
+# bot_gateway: как вызывать логику — http (отдельный logic_api, можно масштабировать)
+# или embedded (logic_api импортируется в процесс шлюза, без HTTP и JSON между ними)
+LOGIC_MODE = os.getenv("LOGIC_MODE", "http")
+
+# bot_gateway: адрес logic_api и пул HTTP-соединений к нему (одна сессия на процесс)
+LOGIC_API_BASE_URL = os.getenv("LOGIC_API_BASE_URL", "http://localhost:8000")
+GATEWAY_HTTP_LIMIT = int(os.getenv("GATEWAY_HTTP_LIMIT", "100"))  # одновременных соединений
+GATEWAY_HTTP_KEEPALIVE = float(os.getenv("GATEWAY_HTTP_KEEPALIVE", "30"))  # секунд держать простаивающее соединение
+GATEWAY_DNS_TTL = int(os.getenv("GATEWAY_DNS_TTL", "300"))
+GATEWAY_HTTP_TIMEOUT = float(os.getenv("GATEWAY_HTTP_TIMEOUT", "10"))
+
+# bot_gateway: получение апдейтов — polling (один процесс) или webhook (aiohttp-сервер,
+# несколько реплик за балансировщиком). WEBHOOK_URL — внешний https-адрес без пути
+GATEWAY_RUN_MODE = os.getenv("GATEWAY_RUN_MODE", "polling")
+GATEWAY_MAX_CONCURRENCY = int(os.getenv("GATEWAY_MAX_CONCURRENCY", "100"))  # обращений к логике одновременно
+GATEWAY_SHUTDOWN_TIMEOUT = float(os.getenv("GATEWAY_SHUTDOWN_TIMEOUT", "30"))  # секунд дождаться начатых апдейтов
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))  # параллельных соединений от Telegram
+
+# bot_gateway: ограничение исходящих сообщений под лимиты Telegram (token bucket)
+GATEWAY_SEND_GLOBAL_RATE = float(os.getenv("GATEWAY_SEND_GLOBAL_RATE", "30"))  # сообщений в секунду на бота
+GATEWAY_SEND_CHAT_RATE = float(os.getenv("GATEWAY_SEND_CHAT_RATE", "1"))  # в секунду на личный чат
+GATEWAY_SEND_CHAT_BURST = int(os.getenv("GATEWAY_SEND_CHAT_BURST", "3"))  # короткая серия в личном чате
+GATEWAY_SEND_GROUP_RATE = float(os.getenv("GATEWAY_SEND_GROUP_RATE", str(20 / 60)))  # в секунду на группу
+GATEWAY_SEND_MAX_RETRIES = int(os.getenv("GATEWAY_SEND_MAX_RETRIES", "5"))  # повторов после RetryAfter
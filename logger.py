@@ -1,81 +1,513 @@
 # logger.py
+import asyncio
+import atexit
+import gzip
+import io
 import json
 import os
-from datetime import datetime
+import queue
+import random
+import re
+import threading
+import time
+from datetime import datetime, date
 
-TECHNICAL_LOG = "logs/technical.json"
-ERROR_LOG = "logs/errors.json"
-USER_ACTIVITY_LOG = "logs/users_activity.json"
+from config import (
+    LOG_FILE,
+    ERROR_LOG_FILE,
+    USER_ACTIVITY_LOG_FILE,
+    LOG_MAX_BYTES,
+    LOG_ROTATE_DAILY,
+    LOG_COMPRESSION,
+    LOG_MANIFEST,
+    LOG_QUEUE_SIZE,
+    LOG_BATCH_SIZE,
+    LOG_QUEUE_POLICY,
+    LOG_QUEUE_BLOCK_TIMEOUT,
+    LOG_LEVEL,
+    LOG_EVENT_LEVELS,
+    LOG_SAMPLE_RATES,
+)
 
-def log_event(user_id, event, details=None):
-    data = {
-        "user_id": user_id,
-        "event": event,
-        "timestamp": datetime.now().isoformat(timespec="seconds")
+try:
+    import fcntl
+except ImportError:  # Windows: блокировка только внутри процесса
+    fcntl = None
+
+try:
+    import zstandard
+except ImportError:  # zstd необязателен, без него сжимаем gzip
+    zstandard = None
+
+
+def _jsonl_path(path):
+    """Старые пути вида technical.json ведут в файл-массив — пишем в соседний .jsonl"""
+    base, ext = os.path.splitext(path)
+    if ext == ".jsonl":
+        return path
+    target = base + ".jsonl"
+    print(f"Лог {path} не в формате .jsonl — записи пойдут в {target} "
+          f"(старый файл переводится migration_tools/convert_logs_to_jsonl.py)")
+    return target
+
+
+# Логи пишутся в формате JSON Lines: одна запись — одна строка, файл только дописывается.
+# Старые логи-массивы (*.json) переводятся командой migration_tools/convert_logs_to_jsonl.py
+TECHNICAL_LOG = _jsonl_path(LOG_FILE)
+ERROR_LOG = _jsonl_path(ERROR_LOG_FILE)
+USER_ACTIVITY_LOG = _jsonl_path(USER_ACTIVITY_LOG_FILE)
+COMPRESSED_SUFFIXES = (".gz", ".zst")
+
+# Фоновая запись: обработчики только кладут строки в ограниченную очередь,
+# отдельный поток пишет их пачками (один write на файл за пачку).
+# LOG_QUEUE_POLICY: drop_new — отбрасывать новые записи, drop_old — вытеснять самые старые,
+# block — ждать место в очереди не дольше LOG_QUEUE_BLOCK_TIMEOUT секунд. block только для
+# синхронных скриптов: в потоке цикла событий (logic_api) ожидание остановило бы все
+# обработчики, поэтому там block ведёт себя как drop_new.
+MAX_BLOCK_TIMEOUT = 0.1
+
+# Уровни и сэмплирование по типам событий.
+# LOG_LEVEL — минимальный уровень записи (debug, info, warning, error).
+# LOG_EVENT_LEVELS — переопределение уровня событий: "bot_response=info,debug=debug".
+# LOG_SAMPLE_RATES — доля записываемых событий: "http_response=0.5,store_search=1".
+# По умолчанию в проде остаются http_response (статус и длительность на каждый запрос)
+# и пользовательские события, а тексты ответов и отладочные дампы отбрасываются.
+LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+DEFAULT_EVENT_LEVELS = {
+    "debug": "debug",
+    "bot_response": "debug",
+    "http_request": "debug",
+    "menu_selection": "debug",
+    "callback_query": "debug",
+    "processing_time": "debug",
+}
+
+
+def _parse_pairs(value):
+    pairs = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            key, val = item.split("=", 1)
+            pairs[key.strip()] = val.strip()
+    return pairs
+
+
+def parse_event_levels(value):
+    """Уровни событий по умолчанию с переопределениями из строки LOG_EVENT_LEVELS"""
+    return {
+        event: LEVELS.get(level.lower(), LEVELS["info"])
+        for event, level in {**DEFAULT_EVENT_LEVELS, **_parse_pairs(value)}.items()
     }
-    if details:
-        data.update(details)
 
-    # Определяем, в какой лог писать
-    if event.startswith("error"):
-        log_file = ERROR_LOG
-    elif event in ["city_selected", "store_added", "query_saved", "query_renamed", "query_deleted", "query_stores_updated", "store_search"]:
-        log_file = USER_ACTIVITY_LOG
-    else:
-        log_file = TECHNICAL_LOG
 
-    if os.path.exists(log_file):
-        with open(log_file, "r", encoding="utf-8") as f:
-            try:
-                stats = json.load(f)
-            except Exception:
-                stats = []
+def parse_sample_rates(value):
+    """Доли записи событий из строки LOG_SAMPLE_RATES"""
+    return {event: float(rate) for event, rate in _parse_pairs(value).items()}
+
+
+MIN_LEVEL = LEVELS.get(LOG_LEVEL.lower(), LEVELS["info"])
+EVENT_LEVELS = parse_event_levels(LOG_EVENT_LEVELS)
+SAMPLE_RATES = parse_sample_rates(LOG_SAMPLE_RATES)
+
+USER_ACTIVITY_EVENTS = {"city_selected", "store_added", "query_saved", "query_renamed", "query_deleted", "query_stores_updated", "store_search"}
+
+
+def _compression():
+    if LOG_COMPRESSION == "zstd" and zstandard is None:
+        return "gzip"
+    return LOG_COMPRESSION
+
+
+_manifest_lock = threading.Lock()
+_archivers = []
+
+
+def read_manifest(manifest_path=LOG_MANIFEST):
+    """Список закрытых сегментов: path, stream, day, first_ts, last_ts, events, bytes"""
+    if not os.path.exists(manifest_path):
+        return []
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f).get("segments", [])
+
+
+class _ManifestLock:
+    """Сжатие сегмента и правка манифеста — под flock на manifest.json.lock, общим для всех воркеров"""
+
+    def __init__(self, manifest_path):
+        self.path = manifest_path + ".lock"
+        self._file = None
+
+    def __enter__(self):
+        _manifest_lock.acquire()
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            if fcntl is not None:
+                self._file = open(self.path, "a")
+                fcntl.flock(self._file, fcntl.LOCK_EX)
+        except Exception:
+            _manifest_lock.release()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        if self._file is not None:
+            self._file.close()  # закрытие снимает flock
+            self._file = None
+        _manifest_lock.release()
+
+
+def _add_to_manifest(entry, manifest_path=LOG_MANIFEST):
+    """Вызывается под _ManifestLock: чтение, дополнение и атомарная замена файла"""
+    segments = [s for s in read_manifest(manifest_path) if s.get("path") != entry["path"]]
+    segments.append(entry)
+    tmp = f"{manifest_path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"segments": segments}, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, manifest_path)
+
+
+def _line_timestamp(line):
+    try:
+        return json.loads(line).get("timestamp")
+    except (ValueError, AttributeError):
+        return None
+
+
+def _open_compressed(target, method):
+    if method == "gzip":
+        return gzip.open(target, "wb")
+    return zstandard.ZstdCompressor().stream_writer(open(target, "wb"))
+
+
+def _read_lines(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    if path.endswith(".zst"):
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, "rb")))
+    return open(path, "rb")
+
+
+def _archive(path, stream, day, manifest_path):
+    method = _compression()
+    target = path + {"gzip": ".gz", "zstd": ".zst"}.get(method, "")
+    out = None
+    if os.path.exists(path):
+        source = path
+        if target != path:
+            # Пишем во временный файл: оборванное сжатие не оставит «готовый» сегмент
+            out = _open_compressed(target + ".tmp", method)
     else:
-        stats = []
+        # Сжатие прошло, а манифест не записался — досчитываем по сжатому файлу
+        target = source = next(path + s for s in COMPRESSED_SUFFIXES if os.path.exists(path + s))
+        method = "gzip" if target.endswith(".gz") else "zstd"
+    first_line = last_line = None
+    events = 0
+    with _read_lines(source) as src:
+        for line in src:
+            if not line.strip():
+                continue
+            if first_line is None:
+                first_line = line
+            last_line = line
+            events += 1
+            if out is not None:
+                out.write(line)
+    if out is not None:
+        out.close()
+        os.replace(target + ".tmp", target)
+        os.remove(path)
+    _add_to_manifest({
+        "path": target,
+        "stream": stream,
+        "day": day,
+        "first_ts": _line_timestamp(first_line) if first_line else None,
+        "last_ts": _line_timestamp(last_line) if last_line else None,
+        "events": events,
+        "bytes": os.path.getsize(target),
+        "compression": method,
+    }, manifest_path)
 
-    stats.append(data)
 
+def archive_segment(path, stream, day, manifest_path=LOG_MANIFEST):
+    """Сжимает закрытый сегмент и записывает его в манифест. Ошибка пишется в лог, сегмент остаётся до перезапуска"""
     try:
-        with open(log_file, "w", encoding="utf-8") as f:
-            json.dump(stats, f, ensure_ascii=False, indent=2)
+        with _ManifestLock(manifest_path):
+            candidates = [path] + [path + s for s in COMPRESSED_SUFFIXES]
+            known = {s.get("path") for s in read_manifest(manifest_path)}
+            if known.intersection(candidates) or not any(os.path.exists(p) for p in candidates):
+                return  # уже обработан другим воркером
+            _archive(path, stream, day, manifest_path)
     except Exception as e:
-        # Если не удалось записать лог — пробуем записать ошибку в технический лог
-        if log_file != TECHNICAL_LOG:
-            try:
-                with open(TECHNICAL_LOG, "a", encoding="utf-8") as f:
-                    f.write(f"LOGGING ERROR: {e} | DATA: {data}\n")
-            except Exception:
-                pass
+        _write(ERROR_LOG, None, "error_log_archive", {"segment": path, "error": repr(e)})
 
-def log_technical(user_id, event, details=None):
-    data = {
-        "user_id": user_id,
-        "event": event,
-        "timestamp": datetime.now().isoformat(timespec="seconds")
-    }
-    if details:
-        data.update(details)
-    log_file = TECHNICAL_LOG
-    if os.path.exists(log_file):
-        with open(log_file, "r", encoding="utf-8") as f:
+
+def _pending_segments(log_path, manifest_path):
+    """Закрытые сегменты потока, которых нет в манифесте (сжатие или запись манифеста не удались)"""
+    base, ext = os.path.splitext(log_path)
+    pattern = re.compile(re.escape(os.path.basename(base)) + r"\.(\d{4}-\d{2}-\d{2})(\.\d+)?" + re.escape(ext) + r"(\.gz|\.zst)?$")
+    known = {s.get("path") for s in read_manifest(manifest_path)}
+    directory = os.path.dirname(log_path) or "."
+    if not os.path.isdir(directory):
+        return []
+    pending = {}
+    for name in sorted(os.listdir(directory)):
+        match = pattern.match(name)
+        if not match:
+            continue
+        full = os.path.join(os.path.dirname(log_path), name)
+        segment = full[:-len(match.group(3))] if match.group(3) else full
+        if full in known or segment in known or any(segment + s in known for s in COMPRESSED_SUFFIXES):
+            continue
+        pending[segment] = match.group(1)
+    return sorted(pending.items())
+
+
+def recover_segments(manifest_path=LOG_MANIFEST):
+    """Доархивирует сегменты, оставшиеся после ошибки или остановки процесса; возвращает их число"""
+    recovered = 0
+    for log_path in sorted(_LOGS):
+        stream = os.path.splitext(os.path.basename(log_path))[0]
+        for segment, day in _pending_segments(log_path, manifest_path):
+            archive_segment(segment, stream, day, manifest_path)
+            recovered += 1
+    return recovered
+
+
+def start_segment_recovery():
+    """Фоновая доархивация при старте приложения"""
+    archiver = threading.Thread(target=recover_segments, name="log-archiver", daemon=True)
+    _archivers[:] = [a for a in _archivers if a.is_alive()] + [archiver]
+    archiver.start()
+
+
+class JsonlLog:
+    """
+    Append-only JSONL-файл с ротацией в сегменты вида technical.2024-05-01.jsonl.
+    Несколько воркеров пишут в один файл: проверка ротации и запись идут под
+    flock на technical.jsonl.lock, поэтому файл переименовывает только один процесс.
+    День файла берётся из его mtime — его мог создать другой процесс.
+    Закрытый сегмент сжимается в отдельном потоке, чтобы не задерживать запись логов.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.stream = os.path.splitext(os.path.basename(path))[0]
+        self._lock = threading.Lock()
+        self._lock_file = None
+
+    def _segment_path(self, day):
+        base, ext = os.path.splitext(self.path)
+        n = 0
+        while True:
+            suffix = f".{day}" if n == 0 else f".{day}.{n}"
+            candidate = f"{base}{suffix}{ext}"
+            if not any(os.path.exists(candidate + s) for s in ("",) + COMPRESSED_SUFFIXES):
+                return candidate
+            n += 1
+
+    def _maybe_rotate(self, incoming):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        day = date.fromtimestamp(stat.st_mtime).isoformat()
+        too_old = LOG_ROTATE_DAILY and day != date.today().isoformat()
+        too_big = LOG_MAX_BYTES and stat.st_size + incoming > LOG_MAX_BYTES
+        if too_old or too_big:
+            segment = self._segment_path(day)
+            os.replace(self.path, segment)
+            archiver = threading.Thread(
+                target=archive_segment,
+                args=(segment, self.stream, day),
+                name="log-archiver",
+                daemon=True,
+            )
+            _archivers[:] = [a for a in _archivers if a.is_alive()] + [archiver]
+            archiver.start()
+
+    def write(self, text):
+        """Дописывает одну или несколько уже сериализованных строк"""
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            if fcntl is not None and self._lock_file is None:
+                self._lock_file = open(self.path + ".lock", "a")
+            if self._lock_file is not None:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
             try:
-                stats = json.load(f)
-            except Exception:
-                stats = []
-    else:
-        stats = []
-    stats.append(data)
+                self._maybe_rotate(len(text))
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(text)
+            finally:
+                if self._lock_file is not None:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+
+_LOGS = {path: JsonlLog(path) for path in {TECHNICAL_LOG, ERROR_LOG, USER_ACTIVITY_LOG}}
+
+
+def _in_event_loop():
     try:
-        with open(log_file, "w", encoding="utf-8") as f:
-            json.dump(stats, f, ensure_ascii=False, indent=2)
-    except Exception as e:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+
+class LogWriter:
+    """Ограниченная очередь строк лога и поток, который сбрасывает их на диск пачками"""
+
+    _STOP = object()
+
+    def __init__(self, maxsize=LOG_QUEUE_SIZE, batch_size=LOG_BATCH_SIZE, policy=LOG_QUEUE_POLICY):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.batch_size = batch_size
+        self.policy = policy
+        self.block_timeout = min(LOG_QUEUE_BLOCK_TIMEOUT, MAX_BLOCK_TIMEOUT)
+        self.dropped = 0
+        self.written = 0
+        self._closed = False
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self):
+        # Поток стартует лениво — уже в процессе воркера uvicorn, а не до fork
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                    self._thread.start()
+                    atexit.register(self.close)
+
+    def put(self, log_file, line):
+        if self._closed:
+            # Поток записи уже остановлен (завершение процесса) — пишем сразу
+            self._write_lines(log_file, [line])
+            return
+        self._ensure_started()
+        item = (log_file, line)
         try:
-            with open(TECHNICAL_LOG, "a", encoding="utf-8") as f:
-                f.write(f"LOGGING ERROR: {e} | DATA: {data}\n")
-        except Exception:
+            if self.policy == "block" and not _in_event_loop():
+                self.queue.put(item, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(item)
+            return
+        except queue.Full:
             pass
+        if self.policy == "drop_old":
+            try:
+                self.queue.get_nowait()
+                self.queue.put_nowait(item)
+            except (queue.Empty, queue.Full):
+                pass
+        self.dropped += 1
 
-def log_user_activity(user_id, event, details=None):
+    def _run(self):
+        stop = False
+        while not stop:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            by_file = {}
+            for item in batch:
+                if item is self._STOP:
+                    stop = True
+                    continue
+                by_file.setdefault(item[0], []).append(item[1])
+            for log_file, lines in by_file.items():
+                self._write_lines(log_file, lines)
+
+    def _write_lines(self, log_file, lines):
+        try:
+            _LOGS[log_file].write("".join(lines))
+            self.written += len(lines)
+        except Exception as e:
+            self.dropped += len(lines)
+            # Если не удалось записать лог — пробуем записать ошибку в технический лог
+            if log_file != TECHNICAL_LOG:
+                try:
+                    error = {"event": "logging_error", "error": str(e), "lost": len(lines)}
+                    _LOGS[TECHNICAL_LOG].write(json.dumps(error, ensure_ascii=False) + "\n")
+                except Exception:
+                    pass
+
+    def _drain(self):
+        """Синхронно дописывает то, что попало в очередь после остановки потока"""
+        by_file = {}
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not self._STOP:
+                by_file.setdefault(item[0], []).append(item[1])
+        for log_file, lines in by_file.items():
+            self._write_lines(log_file, lines)
+
+    def close(self, timeout=5.0):
+        """Дописывает всё, что осталось в очереди, и останавливает поток"""
+        self._closed = True
+        if self._thread is None or not self._thread.is_alive():
+            self._drain()
+            return
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.queue.put(self._STOP, timeout=0.1)
+                break
+            except queue.Full:
+                if time.monotonic() > deadline:
+                    return
+        self._thread.join(max(0.0, deadline - time.monotonic()))
+        if not self._thread.is_alive():
+            self._drain()
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "policy": self.policy,
+            "closed": self._closed,
+        }
+
+
+_writer = LogWriter()
+
+
+def _event_level(event):
+    level = EVENT_LEVELS.get(event)
+    if level is None:
+        level = LEVELS["error"] if event.startswith("error") else LEVELS["info"]
+    return level
+
+
+def log_enabled(event):
+    """Будет ли событие записано (без учёта сэмплирования) — чтобы не собирать details зря"""
+    return _event_level(event) >= MIN_LEVEL
+
+
+def _should_write(event):
+    """Проверка уровня и сэмплирования события"""
+    if _event_level(event) < MIN_LEVEL:
+        return False
+    rate = SAMPLE_RATES.get(event)
+    return rate is None or random.random() < rate
+
+
+def _write(log_file, user_id, event, details):
+    if not _should_write(event):
+        return
+    _write_entry(log_file, user_id, event, details)
+
+
+def _write_entry(log_file, user_id, event, details):
     data = {
         "user_id": user_id,
         "event": event,
@@ -83,22 +515,46 @@ def log_user_activity(user_id, event, details=None):
     }
     if details:
         data.update(details)
-    log_file = USER_ACTIVITY_LOG
-    if os.path.exists(log_file):
-        with open(log_file, "r", encoding="utf-8") as f:
-            try:
-                stats = json.load(f)
-            except Exception:
-                stats = []
+    # Сериализуем сразу: details могут измениться после возврата из обработчика
+    _writer.put(log_file, json.dumps(data, ensure_ascii=False, default=str) + "\n")
+
+
+def shutdown_logging(timeout=5.0):
+    """Сбрасывает очередь логов на диск (вызывается при остановке приложения)"""
+    _writer.close(timeout)
+    # Дожидаемся сжатия сегментов, закрытых перед остановкой
+    for archiver in list(_archivers):
+        archiver.join(timeout)
+    _archivers[:] = [a for a in _archivers if a.is_alive()]
+
+
+def logging_stats():
+    return _writer.stats()
+
+
+def log_event(user_id, event, details=None):
+    # Определяем, в какой лог писать
+    if event.startswith("error"):
+        log_file = ERROR_LOG
+    elif event in USER_ACTIVITY_EVENTS:
+        log_file = USER_ACTIVITY_LOG
     else:
-        stats = []
-    stats.append(data)
-    try:
-        with open(log_file, "w", encoding="utf-8") as f:
-            json.dump(stats, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        try:
-            with open(TECHNICAL_LOG, "a", encoding="utf-8") as f:
-                f.write(f"LOGGING ERROR: {e} | DATA: {data}\n")
-        except Exception:
-            pass
+        log_file = TECHNICAL_LOG
+    _write(log_file, user_id, event, details)
+
+
+def log_debug(user_id, make_message):
+    """
+    Отладочное сообщение в технический лог. make_message — функция без аргументов,
+    возвращающая текст; вызывается, только если событие debug пройдёт уровень и сэмплирование.
+    """
+    if _should_write("debug"):
+        _write_entry(TECHNICAL_LOG, user_id, "debug", {"message": make_message()})
+
+
+def log_technical(user_id, event, details=None):
+    _write(TECHNICAL_LOG, user_id, event, details)
+
+
+def log_user_activity(user_id, event, details=None):
+    _write(USER_ACTIVITY_LOG, user_id, event, details)
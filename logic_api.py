@@ -1,16 +1,27 @@
 from fastapi import FastAPI, Request, Body, HTTPException
 from fastapi.responses import JSONResponse
+import asyncio
+import hashlib
+from contextlib import asynccontextmanager
 import json
 import os
 from datetime import datetime
 from typing import Dict, Any
 from rapidfuzz import process
 import time
-import redis.asyncio as redis
-from logger import log_technical, log_user_activity
-import logging
-from migration_tools.user_id_map_crypto import add_mapping
+from logger import (
+    log_technical,
+    log_user_activity,
+    log_debug,
+    logging_stats,
+    shutdown_logging,
+    start_segment_recovery,
+)
+from migration_tools.user_id_map_crypto import MappingRegistrar
 from migration_tools.utils import get_user_uuid
+from session_backend import create_session_backend
+from saved_queries import SavedQueryCache, SavedQueryRepository
+from redis_trace import setup_redis_trace, trace
 from dotenv import load_dotenv
 
 # Подгружаем переменные окружения (аналогично config.py)
@@ -20,18 +31,24 @@ if BOT_ENV == "test":
 else:
     load_dotenv(".env")
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    # startup()/shutdown() определены ниже; во встроенном режиме их вызывает bot_gateway напрямую
+    await startup()
+    try:
+        yield
+    finally:
+        await shutdown()
+
+app = FastAPI(lifespan=lifespan)
 
 USERS_FILE = os.getenv("USERS_FILE", "users.json")
 MALLS_FILE = os.getenv("MALLS_FILE", "malls.json")
 ALIASES_FILE = os.getenv("ALIASES_FILE", "aliases.json")
-SAVED_QUERIES_FILE = os.getenv("SAVED_QUERIES_FILE", "saved_queries.json")
-LOG_FILE = os.getenv("LOG_FILE", "logs/technical.json")
-USER_ACTIVITY_LOG_FILE = os.getenv("USER_ACTIVITY_LOG_FILE", "logs/users_activity.json")
-ERROR_LOG_FILE = os.getenv("ERROR_LOG_FILE", "logs/errors.json")
 
-REDIS_URL = "redis://localhost:6379/0"
-redis_client = redis.from_url(REDIS_URL)
+session = create_session_backend()
+mapping_registrar = MappingRegistrar()
+saved_queries = SavedQueryCache(SavedQueryRepository())
 
 # Загружаем malls.json и aliases.json при старте
 with open(MALLS_FILE, "r", encoding="utf-8") as f:
@@ -49,6 +66,11 @@ for city_data in MALLS_DATA.values():
         ALL_STORES.update(mall["stores"])
 ALL_STORES = list(ALL_STORES)
 
+# Версия каталога: меняется вместе с malls.json / aliases.json, устаревшие снимки результатов пересчитываются
+CATALOG_VERSION = hashlib.sha1(
+    json.dumps([MALLS_DATA, STORE_ALIASES], ensure_ascii=False, sort_keys=True).encode("utf-8")
+).hexdigest()[:16]
+
 # States
 STATE_CHOOSING_CITY = "choosing_city"
 STATE_ENTERING_STORE = "entering_store"
@@ -110,60 +132,83 @@ def reply(text, reply_markup=None, disable_web_page_preview=None):
         resp["disable_web_page_preview"] = disable_web_page_preview
     return resp
 
-# --- Redis logging setup ---
-logging.basicConfig(
-    level=logging.INFO,
-    filename='my_redis.log',
-    format='%(asctime)s %(levelname)s %(name)s %(message)s'
-)
-logging.getLogger("redis").setLevel(logging.DEBUG)
-redis_logger = logging.getLogger("myapp.redis")
+# Директивы редактирования для ответов на инлайн-кнопки (применяет bot_gateway):
+# "text" — сообщение с нажатой кнопкой заменяется ответом (reply_markup только инлайн),
+# "reply_markup" — у сообщения убирается инлайн-клавиатура, ответ уходит новым сообщением
+def edit_reply(message_id, text, reply_markup=None, disable_web_page_preview=None):
+    resp = reply(text, reply_markup, disable_web_page_preview)
+    if message_id is not None:
+        resp["edit"] = {"message_id": message_id, "method": "text"}
+    return resp
+
+def strip_keyboard(resp, message_id):
+    if message_id is not None:
+        resp["edit"] = {"message_id": message_id, "method": "reply_markup"}
+    return resp
+
+# Трассировка обращений к сессиям (сэмплированная, в фоновом потоке)
+setup_redis_trace()
 
 # FSM helpers
 async def get_state(user_id):
-    state = await redis_client.get(f"user_fsm:{str(user_id)}")
-    redis_logger.info(f"GET user_fsm:{str(user_id)} -> {state}")
+    state = await session.get_state(user_id)
+    trace("GET", "user_fsm", user_id, state)
     if state:
-        return state.decode()
+        return state
     return STATE_CHOOSING_CITY
 
 async def set_state(user_id, state):
-    await redis_client.set(f"user_fsm:{str(user_id)}", state)
-    redis_logger.info(f"SET user_fsm:{str(user_id)} = {state}")
+    await session.set_state(user_id, state)
+    trace("SET", "user_fsm", user_id, state)
 
 async def get_user_data(user_id):
-    key = f"user_data:{str(user_id)}"
-    data = await redis_client.get(key)
-    redis_logger.info(f"GET {key} -> {data}")
+    data = await session.get_user_data(user_id)
+    trace("GET", "user_data", user_id, data)
     if data:
-        return json.loads(data.decode('utf-8'))
+        return data
     return {"city": None, "stores": []}
 
 async def set_user_data(user_id, data):
-    key = f"user_data:{str(user_id)}"
-    await redis_client.set(key, json.dumps(data, ensure_ascii=False))
-    redis_logger.info(f"SET {key} = {data}")
+    await session.set_user_data(user_id, data)
+    trace("SET", "user_data", user_id, data)
 
-# Сохранённые запросы
-# ВНИМАНИЕ: user_id должен быть UUID (а не Telegram ID)!
-def load_saved_queries(user_id):
-    if os.path.exists(SAVED_QUERIES_FILE):
-        with open(SAVED_QUERIES_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-    else:
-        data = {}
-    return data.get(str(user_id), [])
+# Атомарные изменения списка магазинов (в Redis — Lua-скрипты, один round trip)
+async def append_store(user_id, store):
+    """Добавляет магазин, если его ещё нет. Возвращает (added, stores)"""
+    added, stores = await session.append_store(user_id, store)
+    trace("APPEND", "user_data", user_id, (store, added))
+    return added, stores
+
+async def pop_store(user_id, index):
+    """Удаляет магазин по индексу. Возвращает (removed или None, stores)"""
+    removed, stores = await session.pop_store(user_id, index)
+    trace("POP", "user_data", user_id, (index, removed))
+    return removed, stores
 
+async def reset_search(user_id):
+    """Очищает список магазинов и сбрасывает current_query_id"""
+    stores = await session.reset_search(user_id)
+    trace("RESET", "user_data", user_id)
+    return stores
+
+# Запуск и остановка хранилищ. Вызываются из lifespan FastAPI, а во встроенном режиме — bot_gateway
+async def startup():
+    await session.startup()
+    await mapping_registrar.start()
+    # Сегменты логов, не сжатые или не попавшие в манифест до прошлой остановки
+    start_segment_recovery()
+
+async def shutdown():
+    await mapping_registrar.stop()
+    await session.shutdown()
+    saved_queries.repository.close()
+    await asyncio.to_thread(shutdown_logging)
+
+# Сохранённые запросы (SQLite, строка на запрос; изменения — по id запроса).
+# Чтения идут из кэша воркера, актуальность проверяется по версии пользователя в той же базе
 # ВНИМАНИЕ: user_id должен быть UUID (а не Telegram ID)!
-def save_saved_queries(user_id, queries):
-    if os.path.exists(SAVED_QUERIES_FILE):
-        with open(SAVED_QUERIES_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-    else:
-        data = {}
-    data[str(user_id)] = queries
-    with open(SAVED_QUERIES_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+async def load_saved_queries(user_id):
+    return await saved_queries.list(user_id)
 
 def correct_store_name(user_input, all_known_stores, aliases_threshold=70, stores_threshold=80):
     if not user_input or not all_known_stores or process is None:
@@ -198,16 +243,6 @@ def correct_store_name(user_input, all_known_stores, aliases_threshold=70, store
     ) if process else None
     return match[0] if match else None
 
-def log_event(user_id, event, data=None):
-    entry = {
-        "timestamp": datetime.now().isoformat(),
-        "user_id": user_id,
-        "event": event,
-        "data": data or {}
-    }
-    with open(LOG_FILE, "a", encoding="utf-8") as f:
-        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
-
 API_TOKEN = os.getenv("API_TOKEN")
 
 def check_token(request: Request):
@@ -215,94 +250,82 @@ def check_token(request: Request):
     if auth != f"Bearer {API_TOKEN}":
         raise HTTPException(status_code=401, detail="Unauthorized")
 
-async def handle_start_command(user_id: str, start_time: float):
+@app.get("/metrics")
+async def metrics(request: Request):
+    check_token(request)
+    return JSONResponse({"session": session.stats(), "logging": logging_stats(), "saved_queries": saved_queries.stats()})
+
+async def handle_start_command(user_id: str, user_uuid: str, start_time: float):
     """Обработка команды /start"""
-    add_mapping(user_id)  # Добавляем пользователя в крипто-маппинг
+    mapping_registrar.register(user_id)  # Добавляем пользователя в крипто-маппинг (в фоне)
     await set_state(user_id, STATE_CHOOSING_CITY)
     await set_user_data(user_id, {"city": None, "stores": []})
     response = reply(WELCOME_TEXT, city_menu(), disable_web_page_preview=True)
     duration = time.time() - start_time
-    log_technical(get_user_uuid(user_id), "bot_response", details={"text": WELCOME_TEXT, "duration": duration})
-    log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-    return JSONResponse(response)
+    log_technical(user_uuid, "bot_response", details={"text": WELCOME_TEXT, "duration": duration})
+    log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+    return response
 
-async def handle_city_selection(user_id: str, text: str, start_time: float):
+async def handle_city_selection(user_id: str, user_uuid: str, text: str, start_time: float):
     """Обработка выбора города"""
     if text not in MALLS_DATA:
         response = reply("Пока доступны только Москва и Санкт-Петербург", city_menu(), disable_web_page_preview=True)
         duration = time.time() - start_time
-        log_technical(get_user_uuid(user_id), "bot_response", details={"text": "Пока доступны только Москва и Санкт-Петербург", "duration": duration})
-        log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-        return JSONResponse(response)
+        log_technical(user_uuid, "bot_response", details={"text": "Пока доступны только Москва и Санкт-Петербург", "duration": duration})
+        log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+        return response
     
-    await set_user_data(user_id, {"city": text, "stores": [], "current_query_index": None})
+    await set_user_data(user_id, {"city": text, "stores": [], "current_query_id": None})
     await set_state(user_id, STATE_ENTERING_STORE)
-    log_user_activity(get_user_uuid(user_id), "city_selected", {"city": text})
+    log_user_activity(user_uuid, "city_selected", {"city": text})
     response_text = f"Вы выбрали город: <b>{text}</b>.\n\nТеперь вы можете:\n🛍️ Добавить — ввести название магазина\n🔍 Искать — найти ТЦ с нужными магазинами\n🧾 Редактировать — посмотреть или удалить магазины\n\nВведите название магазина и нажмите ввод"
     response = reply(response_text, after_store_menu(), disable_web_page_preview=True)
     duration = time.time() - start_time
-    log_technical(get_user_uuid(user_id), "bot_response", details={"text": response_text, "duration": duration})
-    log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-    return JSONResponse(response)
+    log_technical(user_uuid, "bot_response", details={"text": response_text, "duration": duration})
+    log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+    return response
 
-async def handle_store_editing(user_id: str, start_time: float):
+async def handle_store_editing(user_id: str, user_uuid: str, start_time: float):
     """Обработка редактирования списка магазинов"""
-    log_user_activity(get_user_uuid(user_id), "menu_action", {"action": "edit_stores_list"})
+    log_user_activity(user_uuid, "menu_action", {"action": "edit_stores_list"})
     user_data = await get_user_data(user_id)
-    # Сброс current_query_index, если он был выставлен
-    if user_data.get("current_query_index") is not None:
-        user_data["current_query_index"] = None
+    # Сброс current_query_id, если он был выставлен
+    if user_data.get("current_query_id") is not None:
+        user_data["current_query_id"] = None
         await set_user_data(user_id, user_data)
     stores = user_data["stores"]
     if not stores:
         response = reply("Список пуст (изменения не сохранятся в запросе)", after_store_menu(), disable_web_page_preview=True)
         duration = time.time() - start_time
-        log_technical(get_user_uuid(user_id), "bot_response", details={"text": "Список пуст (изменения не сохранятся в запросе)", "duration": duration})
-        log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-        return JSONResponse(response)
+        log_technical(user_uuid, "bot_response", details={"text": "Список пуст (изменения не сохранятся в запросе)", "duration": duration})
+        log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+        return response
     response_text = "<b>Ваш список магазинов (изменения не сохранятся в запросе):</b>\n"
     for i, store in enumerate(stores, 1):
         response_text += f"{i}. {store}\n"
     response_text += "\nЧтобы удалить магазин — отправь его номер"
     response = reply(response_text, after_store_menu(), disable_web_page_preview=True)
     duration = time.time() - start_time
-    log_technical(get_user_uuid(user_id), "bot_response", details={"text": response_text, "duration": duration})
-    log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-    return JSONResponse(response)
+    log_technical(user_uuid, "bot_response", details={"text": response_text, "duration": duration})
+    log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+    return response
 
-async def handle_city_change(user_id: str, start_time: float):
+async def handle_city_change(user_id: str, user_uuid: str, start_time: float):
     """Обработка смены города"""
-    log_user_activity(get_user_uuid(user_id), "menu_action", {"action": "change_city"})
+    log_user_activity(user_uuid, "menu_action", {"action": "change_city"})
     await set_state(user_id, STATE_CHOOSING_CITY)
-    await set_user_data(user_id, {"city": None, "stores": [], "current_query_index": None})
+    await set_user_data(user_id, {"city": None, "stores": [], "current_query_id": None})
     response = reply("Выберите город:", city_menu(), disable_web_page_preview=True)
     duration = time.time() - start_time
-    log_technical(get_user_uuid(user_id), "bot_response", details={"text": "Выберите город:", "duration": duration})
-    log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-    return JSONResponse(response)
+    log_technical(user_uuid, "bot_response", details={"text": "Выберите город:", "duration": duration})
+    log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+    return response
 
-async def handle_mall_search(user_id: str, start_time: float):
-    """Обработка поиска торговых центров"""
-    log_user_activity(get_user_uuid(user_id), "menu_action", {"action": "search_malls"})
-    user_data = await get_user_data(user_id)
-    city = user_data.get("city")
-    queries = user_data.get("stores", [])
-    
-    if not city:
-        response = reply("Сначала выберите город через /start", after_store_menu(), disable_web_page_preview=True)
-        duration = time.time() - start_time
-        log_technical(get_user_uuid(user_id), "bot_response", details={"text": "Сначала выберите город через /start", "duration": duration})
-        log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-        return JSONResponse(response)
-    
-    if not queries:
-        response = reply("Сначала добавьте магазины для поиска", after_store_menu(), disable_web_page_preview=True)
-        duration = time.time() - start_time
-        log_technical(get_user_uuid(user_id), "bot_response", details={"text": "Сначала добавьте магазины для поиска", "duration": duration})
-        log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-        return JSONResponse(response)
-    
-    log_user_activity(get_user_uuid(user_id), "store_search", {"city": city, "stores": queries})
+def render_mall_search(city, queries, resolved):
+    """
+    Текст результата поиска по ТЦ города и число найденных ТЦ ("" и 0, если ничего не найдено).
+    resolved — названия из каталога для queries (correct_store_name), в том же порядке.
+    """
     results = []
     for mall_name, mall_data in MALLS_DATA[city].items():
         mall_stores_dict = mall_data.get("stores", {})
@@ -314,24 +337,14 @@ async def handle_mall_search(user_id: str, start_time: float):
         }
         matched_stores = []
         found_store_queries = set()
-        for store_query in queries:
-            corrected_query = correct_store_name(store_query, ALL_STORES) or store_query
-            for store_lower, (original_store, floor) in mall_stores_lower.items():
-                if corrected_query.lower() == store_lower:
-                    matched_stores.append((original_store, floor))
-                    found_store_queries.add(store_query.lower())
-                    break
+        for store_query, corrected_query in zip(queries, resolved):
+            match = mall_stores_lower.get(corrected_query.lower())
+            if match:
+                matched_stores.append(match)
+                found_store_queries.add(store_query.lower())
         if matched_stores:
             results.append((mall_name, mall_data["address"], matched_stores, mall_data, len(found_store_queries)))
     
-    if not results:
-        log_user_activity(get_user_uuid(user_id), "search_result", {"result": "no_matches", "city": city, "stores": queries})
-        response = reply("Магазины не найдены 😔", after_store_menu(), disable_web_page_preview=True)
-        duration = time.time() - start_time
-        log_technical(get_user_uuid(user_id), "bot_response", details={"text": "Магазины не найдены 😔", "duration": duration})
-        log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-        return JSONResponse(response)
-    
     results.sort(key=lambda x: x[4], reverse=True)
     total_user_selected = len(queries)
     full_response = ""
@@ -349,174 +362,226 @@ async def handle_mall_search(user_id: str, start_time: float):
                 floor_info = f" — {floor} этаж"
             text_result += f"• {name}{floor_info}\n"
         full_response += text_result + "\n"
+    return full_response.strip(), len(results)
+
+def snapshot_is_fresh(snapshot, city, stores):
+    """Снимок результата годится, если каталог тот же и запрос не менялся"""
+    return bool(snapshot) and (
+        snapshot.get("catalog_version") == CATALOG_VERSION
+        and snapshot.get("city") == city
+        and snapshot.get("stores") == list(stores)
+    )
+
+async def handle_mall_search(user_id: str, user_uuid: str, start_time: float, query_id=None):
+    """Обработка поиска торговых центров (query_id — сохранённый запрос, для снимка результата)"""
+    log_user_activity(user_uuid, "menu_action", {"action": "search_malls"})
+    user_data = await get_user_data(user_id)
+    city = user_data.get("city")
+    queries = user_data.get("stores", [])
     
-    log_user_activity(get_user_uuid(user_id), "search_result", {"result": "found", "city": city, "stores": queries, "malls_found": len(results)})
-    response = reply(full_response.strip(), after_store_menu(), disable_web_page_preview=True)
+    if not city:
+        response = reply("Сначала выберите город через /start", after_store_menu(), disable_web_page_preview=True)
+        duration = time.time() - start_time
+        log_technical(user_uuid, "bot_response", details={"text": "Сначала выберите город через /start", "duration": duration})
+        log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+        return response
+    
+    if not queries:
+        response = reply("Сначала добавьте магазины для поиска", after_store_menu(), disable_web_page_preview=True)
+        duration = time.time() - start_time
+        log_technical(user_uuid, "bot_response", details={"text": "Сначала добавьте магазины для поиска", "duration": duration})
+        log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+        return response
+    
+    log_user_activity(user_uuid, "store_search", {"city": city, "stores": queries})
+    # Для сохранённого запроса берём готовый результат, если каталог и список магазинов не менялись
+    query = await saved_queries.get(user_uuid, query_id) if query_id is not None else None
+    snapshot = query.get("snapshot") if query else None
+    from_snapshot = snapshot_is_fresh(snapshot, city, queries)
+    if from_snapshot:
+        full_response, malls_found = snapshot["text"], snapshot["malls_found"]
+    else:
+        resolved = [correct_store_name(store_query, ALL_STORES) or store_query for store_query in queries]
+        full_response, malls_found = render_mall_search(city, queries, resolved)
+        # Снимок описывает сохранённый запрос: пишем, только если ищем ровно его магазины
+        # (в сессии список мог разойтись с базой, например после правки в другом воркере)
+        if query is not None and list(queries) == query["stores"] and query.get("city") in (None, city):
+            await saved_queries.update(user_uuid, query_id, snapshot={
+                "catalog_version": CATALOG_VERSION,
+                "city": city,
+                "stores": list(queries),
+                "resolved": resolved,
+                "text": full_response,
+                "malls_found": malls_found,
+            })
+    
+    if not full_response:
+        log_user_activity(user_uuid, "search_result", {"result": "no_matches", "city": city, "stores": queries, "snapshot": from_snapshot})
+        response = reply("Магазины не найдены 😔", after_store_menu(), disable_web_page_preview=True)
+        duration = time.time() - start_time
+        log_technical(user_uuid, "bot_response", details={"text": "Магазины не найдены 😔", "duration": duration})
+        log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+        return response
+    
+    log_user_activity(user_uuid, "search_result", {"result": "found", "city": city, "stores": queries, "malls_found": malls_found, "snapshot": from_snapshot})
+    response = reply(full_response, after_store_menu(), disable_web_page_preview=True)
     duration = time.time() - start_time
-    log_technical(get_user_uuid(user_id), "bot_response", details={"text": full_response.strip(), "duration": duration})
-    log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-    return JSONResponse(response)
+    log_technical(user_uuid, "bot_response", details={"text": full_response, "duration": duration})
+    log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+    return response
 
-async def handle_clear_stores_list(user_id: str, start_time: float):
+async def handle_clear_stores_list(user_id: str, user_uuid: str, start_time: float):
     """Обработка очистки списка магазинов"""
-    log_user_activity(get_user_uuid(user_id), "menu_action", {"action": "clear_stores_list"})
+    log_user_activity(user_uuid, "menu_action", {"action": "clear_stores_list"})
     user_data = await get_user_data(user_id)
     user_data["stores"] = []
-    user_data["current_query_index"] = None # сброс индекса
+    user_data["current_query_id"] = None # сброс выбранного запроса
     await set_user_data(user_id, user_data)
-    log_user_activity(get_user_uuid(user_id), "query_stores_updated", {"stores": []})
+    log_user_activity(user_uuid, "query_stores_updated", {"stores": []})
     response = reply("Список магазинов очищен", after_store_menu(), disable_web_page_preview=True)
     duration = time.time() - start_time
-    log_technical(get_user_uuid(user_id), "bot_response", details={"text": "Список магазинов очищен", "duration": duration})
-    log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-    return JSONResponse(response)
+    log_technical(user_uuid, "bot_response", details={"text": "Список магазинов очищен", "duration": duration})
+    log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+    return response
 
-async def handle_show_saved_queries(user_id: str, start_time: float):
+async def handle_show_saved_queries(user_id: str, user_uuid: str, start_time: float):
     """Обработка показа сохраненных запросов"""
-    log_user_activity(get_user_uuid(user_id), "menu_action", {"action": "show_saved_queries"})
-    queries = load_saved_queries(get_user_uuid(user_id))
+    log_user_activity(user_uuid, "menu_action", {"action": "show_saved_queries"})
+    queries = await load_saved_queries(user_uuid)
     user_data = await get_user_data(user_id)
-    user_data["current_query_index"] = None # сброс индекса
+    user_data["current_query_id"] = None # сброс выбранного запроса
     await set_user_data(user_id, user_data)
     if not queries:
-        log_user_activity(get_user_uuid(user_id), "saved_queries_action", {"action": "view", "result": "empty"})
+        log_user_activity(user_uuid, "saved_queries_action", {"action": "view", "result": "empty"})
         response = reply("У вас нет сохранённых запросов", after_store_menu(), disable_web_page_preview=True)
         duration = time.time() - start_time
-        log_technical(get_user_uuid(user_id), "bot_response", details={"text": "У вас нет сохранённых запросов", "duration": duration})
-        log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-        return JSONResponse(response)
+        log_technical(user_uuid, "bot_response", details={"text": "У вас нет сохранённых запросов", "duration": duration})
+        log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+        return response
     
-    log_user_activity(get_user_uuid(user_id), "saved_queries_action", {"action": "view", "result": "found", "count": len(queries)})
+    log_user_activity(user_uuid, "saved_queries_action", {"action": "view", "result": "found", "count": len(queries)})
     lines = []
     buttons = []
     for i, q in enumerate(queries):
         stores_str = ", ".join(q["stores"])
         lines.append(f"{i + 1}. <b>{q['name']}</b>\n{stores_str}")
-        buttons.append([{"text": q["name"], "callback_data": f"load_query::{i}"}])
+        buttons.append([{"text": q["name"], "callback_data": f"saved_query::{q['id']}"}])
     text_out = "\n\n".join(lines)
     keyboard = {"inline_keyboard": buttons}
     response = reply(text_out + "\n\nВыберите список для загрузки:", keyboard, disable_web_page_preview=True)
     duration = time.time() - start_time
-    log_technical(get_user_uuid(user_id), "bot_response", details={"text": text_out + "\n\nВыберите список для загрузки:", "duration": duration})
-    log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-    return JSONResponse(response)
+    log_technical(user_uuid, "bot_response", details={"text": text_out + "\n\nВыберите список для загрузки:", "duration": duration})
+    log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+    return response
 
-async def handle_add_store_prompt(user_id: str, start_time: float):
+async def handle_add_store_prompt(user_id: str, user_uuid: str, start_time: float):
     """Обработка запроса на добавление магазина"""
-    log_user_activity(get_user_uuid(user_id), "menu_action", {"action": "add_store_prompt"})
+    log_user_activity(user_uuid, "menu_action", {"action": "add_store_prompt"})
     response = reply("Введите название магазина:", after_store_menu(), disable_web_page_preview=True)
     duration = time.time() - start_time
-    log_technical(get_user_uuid(user_id), "bot_response", details={"text": "Введите название магазина:", "duration": duration})
-    log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-    return JSONResponse(response)
+    log_technical(user_uuid, "bot_response", details={"text": "Введите название магазина:", "duration": duration})
+    log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+    return response
 
-async def handle_new_search(user_id: str, start_time: float):
+async def handle_new_search(user_id: str, user_uuid: str, start_time: float):
     """Обработка начала нового поиска"""
-    log_user_activity(get_user_uuid(user_id), "menu_action", {"action": "new_search"})
-    user_data = await get_user_data(user_id)
-    user_data["stores"] = []
-    user_data["current_query_index"] = None # сброс индекса
-    await set_user_data(user_id, user_data)
-    log_user_activity(get_user_uuid(user_id), "query_stores_updated", {"stores": []})
+    log_user_activity(user_uuid, "menu_action", {"action": "new_search"})
+    await reset_search(user_id)
+    log_user_activity(user_uuid, "query_stores_updated", {"stores": []})
     response = reply(
         "✅ Начат новый пустой поиск.\n\nТеперь вы можете:\n🛍️ Добавить — ввести название магазина\n🔍 Искать — найти ТЦ с нужными магазинами\n🧾 Редактировать — посмотреть или удалить магазины\n\nВведите название магазина и нажмите ввод",
         after_store_menu(),
         disable_web_page_preview=True
     )
     duration = time.time() - start_time
-    log_technical(get_user_uuid(user_id), "bot_response", details={"text": "✅ Начат новый пустой поиск. Теперь вы можете: ...", "duration": duration})
-    log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-    return JSONResponse(response)
+    log_technical(user_uuid, "bot_response", details={"text": "✅ Начат новый пустой поиск. Теперь вы можете: ...", "duration": duration})
+    log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+    return response
 
-async def handle_store_number_input(user_id: str, text: str, start_time: float):
+async def handle_store_number_input(user_id: str, user_uuid: str, text: str, start_time: float):
     """Обработка ввода номера магазина"""
-    user_data = await get_user_data(user_id)
-    stores = user_data["stores"]
     index = int(text) - 1
     
     # Сначала проверяем удаление магазина из текущего списка
-    if 0 <= index < len(stores):
-        removed = stores.pop(index)
-        user_data["stores"] = stores
-        await set_user_data(user_id, user_data)
-        log_user_activity(get_user_uuid(user_id), "store_removed", {"store": removed, "method": "by_number", "remaining_count": len(stores)})
+    # Отрицательный индекс скрипт трактует как «с конца», поэтому «0» туда не передаём
+    if index >= 0:
+        removed, stores = await pop_store(user_id, index)
+    else:
+        removed, stores = None, (await get_user_data(user_id))["stores"]
+    if removed is not None:
+        log_user_activity(user_uuid, "store_removed", {"store": removed, "method": "by_number", "remaining_count": len(stores)})
         response = reply(f"Магазин <b>{removed}</b> удалён из списка", after_store_menu(), disable_web_page_preview=True)
         duration = time.time() - start_time
-        log_technical(get_user_uuid(user_id), "bot_response", details={"text": f"Магазин <b>{removed}</b> удалён из списка", "duration": duration})
-        log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-        return JSONResponse(response)
+        log_technical(user_uuid, "bot_response", details={"text": f"Магазин <b>{removed}</b> удалён из списка", "duration": duration})
+        log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+        return response
     
     # Если номер не подходит для удаления магазина, проверяем загрузку сохраненного запроса
-    queries = load_saved_queries(get_user_uuid(user_id))
+    queries = await load_saved_queries(user_uuid)
     if 0 <= index < len(queries):
-        log_user_activity(get_user_uuid(user_id), "saved_queries_action", {"action": "load_by_number", "query_index": index, "query_name": queries[index]["name"]})
+        query = queries[index]
+        log_user_activity(user_uuid, "saved_queries_action", {"action": "load_by_number", "query_id": query["id"], "query_name": query["name"]})
         user_data = await get_user_data(user_id)
-        user_data["stores"] = list(queries[index]["stores"])
-        user_data["current_query_index"] = index
+        user_data["stores"] = list(query["stores"])
+        user_data["current_query_id"] = query["id"]
         await set_user_data(user_id, user_data)
         await set_state(user_id, STATE_EDITING_SAVED_QUERY)
-        response_text = f"Загружен список <b>{queries[index]['name']}</b>:\n\n"
-        for i, store in enumerate(queries[index]["stores"], 1):
+        response_text = f"Загружен список <b>{query['name']}</b>:\n\n"
+        for i, store in enumerate(query["stores"], 1):
             response_text += f"{i}. {store}\n"
         response = reply(response_text, query_menu(), disable_web_page_preview=True)
         duration = time.time() - start_time
-        log_technical(get_user_uuid(user_id), "bot_response", details={"text": response_text, "duration": duration})
-        log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-        return JSONResponse(response)
+        log_technical(user_uuid, "bot_response", details={"text": response_text, "duration": duration})
+        log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+        return response
     
     # Если номер не подходит ни для удаления, ни для загрузки
-    log_user_activity(get_user_uuid(user_id), "input_error", {"error": "invalid_store_number", "input": text, "max_valid": len(stores)})
+    log_user_activity(user_uuid, "input_error", {"error": "invalid_store_number", "input": text, "max_valid": len(stores)})
     response = reply("❌ Неверный номер", after_store_menu(), disable_web_page_preview=True)
     duration = time.time() - start_time
-    log_technical(get_user_uuid(user_id), "bot_response", details={"text": "❌ Неверный номер", "duration": duration})
-    log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-    return JSONResponse(response)
+    log_technical(user_uuid, "bot_response", details={"text": "❌ Неверный номер", "duration": duration})
+    log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+    return response
 
-async def handle_store_name_input(user_id: str, text: str, start_time: float):
+async def handle_store_name_input(user_id: str, user_uuid: str, text: str, start_time: float):
     """Обработка ввода названия магазина"""
     user_data = await get_user_data(user_id)
     state = await get_state(user_id)
-    current_query_index = user_data.get("current_query_index")
-    # Не сбрасываем current_query_index, если редактируем сохранённый запрос
-    if state == STATE_ENTERING_STORE and current_query_index is not None:
-        # Оставляем current_query_index, чтобы меню не менялось
+    current_query_id = user_data.get("current_query_id")
+    # Не сбрасываем current_query_id, если редактируем сохранённый запрос
+    if state == STATE_ENTERING_STORE and current_query_id is not None:
+        # Оставляем current_query_id, чтобы меню не менялось
         pass
     corrected = correct_store_name(text, ALL_STORES)
     if not corrected:
-        log_user_activity(get_user_uuid(user_id), "store_not_found", {"input": text, "suggestions": []})
-        menu = saved_query_edit_menu() if current_query_index is not None else after_store_menu()
+        log_user_activity(user_uuid, "store_not_found", {"input": text, "suggestions": []})
+        menu = saved_query_edit_menu() if current_query_id is not None else after_store_menu()
         response = reply(f"❌ Магазин <b>{text}</b> не найден. Попробуйте снова.", menu, disable_web_page_preview=True)
         duration = time.time() - start_time
-        log_technical(get_user_uuid(user_id), "bot_response", details={"text": f"❌ Магазин <b>{text}</b> не найден. Попробуйте снова.", "duration": duration})
-        log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-        return JSONResponse(response)
-    user_data = await get_user_data(user_id)
-    if corrected.lower() in [s.lower() for s in user_data["stores"]]:
-        log_user_activity(get_user_uuid(user_id), "store_already_exists", {"store": corrected, "input": text})
-        menu = saved_query_edit_menu() if current_query_index is not None else after_store_menu()
+        log_technical(user_uuid, "bot_response", details={"text": f"❌ Магазин <b>{text}</b> не найден. Попробуйте снова.", "duration": duration})
+        log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+        return response
+    added, stores = await append_store(user_id, corrected)
+    if not added:
+        log_user_activity(user_uuid, "store_already_exists", {"store": corrected, "input": text})
+        menu = saved_query_edit_menu() if current_query_id is not None else after_store_menu()
         response = reply(f"🔁 Магазин <b>{corrected}</b> уже есть в списке", menu, disable_web_page_preview=True)
         duration = time.time() - start_time
-        log_technical(get_user_uuid(user_id), "bot_response", details={"text": f"🔁 Магазин <b>{corrected}</b> уже есть в списке", "duration": duration})
-        log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-        return JSONResponse(response)
-    user_data["stores"] = user_data["stores"] + [corrected]
-    await set_user_data(user_id, user_data)
+        log_technical(user_uuid, "bot_response", details={"text": f"🔁 Магазин <b>{corrected}</b> уже есть в списке", "duration": duration})
+        log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+        return response
     # Если редактируем сохранённый запрос, обновляем его
-    if current_query_index is not None:
-        queries = load_saved_queries(get_user_uuid(user_id))
-        if 0 <= current_query_index < len(queries):
-            queries[current_query_index]["stores"] = list(user_data["stores"])
-            save_saved_queries(get_user_uuid(user_id), queries)
-    log_user_activity(get_user_uuid(user_id), "store_added", {"store": corrected, "input": text, "was_corrected": text != corrected})
+    if current_query_id is not None:
+        await saved_queries.update(user_uuid, current_query_id, stores=list(stores))
+    log_user_activity(user_uuid, "store_added", {"store": corrected, "input": text, "was_corrected": text != corrected})
     response_text = f"<b>Магазин добавлен:</b> {corrected}\n\n"
     response_text += "<b>Текущий список:</b>\n"
-    user_data = await get_user_data(user_id)
-    for i, store in enumerate(user_data["stores"], 1):
+    for i, store in enumerate(stores, 1):
         response_text += f"{i}. {store}\n"
-    if current_query_index is not None:
+    if current_query_id is not None:
         menu = saved_query_edit_menu()
         await set_state(user_id, STATE_EDITING_SAVED_QUERY_STORES_MENU)
-        log_technical(get_user_uuid(user_id), "menu_selection", details={"menu": "saved_query_edit_menu", "current_query_index": current_query_index})
+        log_technical(user_uuid, "menu_selection", details={"menu": "saved_query_edit_menu", "current_query_id": current_query_id})
         response = reply(response_text, menu, disable_web_page_preview=True)
     else:
         # Инлайн-кнопки: "Это не тот магазин" и "Сохранить запрос"
@@ -528,58 +593,55 @@ async def handle_store_name_input(user_id: str, text: str, start_time: float):
         await set_user_data(user_id, user_data)
         user_input_index = len(store_choices) - 1
         corrected_index = user_input_index  # по умолчанию, если только что добавили
-        log_technical(get_user_uuid(user_id), "debug", details={"message": f"Added store '{corrected}', original input '{text}', store_choices: {store_choices}"})
+        log_debug(user_uuid, lambda: f"Added store '{corrected}', original input '{text}', store_choices: {store_choices}")
         keyboard = {"inline_keyboard": [
             [{"text": "❌ Это не тот магазин", "callback_data": f"wrong_store::0::{corrected_index}"}],
             [{"text": "💾 Сохранить запрос", "callback_data": "save_query"}]
         ]}
         menu = after_store_menu()
-        log_technical(get_user_uuid(user_id), "menu_selection", details={"menu": "after_store_menu", "current_query_index": None})
+        log_technical(user_uuid, "menu_selection", details={"menu": "after_store_menu", "current_query_id": None})
         response = reply(response_text, keyboard, disable_web_page_preview=True)
     duration = time.time() - start_time
-    log_technical(get_user_uuid(user_id), "bot_response", details={"text": response_text, "duration": duration})
-    log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-    return JSONResponse(response)
+    log_technical(user_uuid, "bot_response", details={"text": response_text, "duration": duration})
+    log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+    return response
 
-async def handle_saved_query_actions(user_id: str, text: str, start_time: float):
+async def handle_saved_query_actions(user_id: str, user_uuid: str, text: str, start_time: float):
     """Обработка действий с сохраненными запросами"""
     # Добавлено: обработка кнопки '📜 Список запросов' из любого режима
     if text == "📜 Список запросов":
-        return await handle_show_saved_queries(user_id, start_time)
+        return await handle_show_saved_queries(user_id, user_uuid, start_time)
     user_data = await get_user_data(user_id)
-    idx = user_data.get("current_query_index")
-    queries = load_saved_queries(get_user_uuid(user_id))
+    query_id = user_data.get("current_query_id")
     
     if text == "✏️ Переименовать":
-        log_user_activity(get_user_uuid(user_id), "saved_query_action", {"action": "rename_prompt", "query_index": idx})
+        log_user_activity(user_uuid, "saved_query_action", {"action": "rename_prompt", "query_id": query_id})
         await set_state(user_id, STATE_RENAMING_QUERY_NAME)
         response = reply("Введите новое название:", query_menu(), disable_web_page_preview=True)
         duration = time.time() - start_time
-        log_technical(get_user_uuid(user_id), "bot_response", details={"text": "Введите новое название:", "duration": duration})
-        log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-        return JSONResponse(response)
+        log_technical(user_uuid, "bot_response", details={"text": "Введите новое название:", "duration": duration})
+        log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+        return response
     
     if text == "🛒 Редактировать магазины":
-        log_user_activity(get_user_uuid(user_id), "saved_query_action", {"action": "edit_stores", "query_index": idx})
-        if idx is not None and 0 <= idx < len(queries):
-            user_data["stores"] = list(queries[idx]["stores"])
-            user_data["current_query_index"] = idx
+        log_user_activity(user_uuid, "saved_query_action", {"action": "edit_stores", "query_id": query_id})
+        query = await saved_queries.get(user_uuid, query_id) if query_id is not None else None
+        if query is not None:
+            user_data["stores"] = list(query["stores"])
+            user_data["current_query_id"] = query_id
             await set_user_data(user_id, user_data)
         user_data = await get_user_data(user_id)
         stores = user_data["stores"]
         await set_state(user_id, STATE_ENTERING_STORE)
         response = reply("Выберите действие", saved_query_edit_menu(), disable_web_page_preview=True)
         duration = time.time() - start_time
-        log_technical(get_user_uuid(user_id), "bot_response", details={"text": "Выберите действие", "duration": duration})
-        log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-        return JSONResponse(response)
+        log_technical(user_uuid, "bot_response", details={"text": "Выберите действие", "duration": duration})
+        log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+        return response
     
     if text == "🆕 Новый поиск":
-        log_user_activity(get_user_uuid(user_id), "saved_query_action", {"action": "new_search_from_saved", "query_index": idx})
-        user_data = await get_user_data(user_id)
-        user_data["stores"] = []
-        user_data["current_query_index"] = None # сброс индекса
-        await set_user_data(user_id, user_data)
+        log_user_activity(user_uuid, "saved_query_action", {"action": "new_search_from_saved", "query_id": query_id})
+        await reset_search(user_id)
         await set_state(user_id, STATE_ENTERING_STORE)
         response = reply(
             "✅ Начат новый пустой поиск.\n\nТеперь вы можете:\n🛍️ Добавить — ввести название магазина\n🔍 Искать — найти ТЦ с нужными магазинами\n🧾 Редактировать — посмотреть или удалить магазины\n\nВведите название магазина и нажмите ввод",
@@ -587,173 +649,166 @@ async def handle_saved_query_actions(user_id: str, text: str, start_time: float)
             disable_web_page_preview=True
         )
         duration = time.time() - start_time
-        log_technical(get_user_uuid(user_id), "bot_response", details={"text": "✅ Начат новый пустой поиск. Теперь вы можете: ...", "duration": duration})
-        log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-        return JSONResponse(response)
+        log_technical(user_uuid, "bot_response", details={"text": "✅ Начат новый пустой поиск. Теперь вы можете: ...", "duration": duration})
+        log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+        return response
     
     if text == "🔍 Искать":
-        log_user_activity(get_user_uuid(user_id), "saved_query_action", {"action": "search_from_saved", "query_index": idx})
+        log_user_activity(user_uuid, "saved_query_action", {"action": "search_from_saved", "query_id": query_id})
         await set_state(user_id, STATE_ENTERING_STORE)
-        return await handle_mall_search(user_id, start_time)
+        return await handle_mall_search(user_id, user_uuid, start_time, query_id)
     
     if text == "🗑 Удалить":
-        log_user_activity(get_user_uuid(user_id), "saved_query_action", {"action": "delete", "query_index": idx})
-        if idx is not None and 0 <= idx < len(queries):
-            queries.pop(idx)
-            save_saved_queries(get_user_uuid(user_id), queries)
-            log_user_activity(get_user_uuid(user_id), "query_deleted", {"query_index": idx})
+        log_user_activity(user_uuid, "saved_query_action", {"action": "delete", "query_id": query_id})
+        if query_id is not None and await saved_queries.delete(user_uuid, query_id):
+            log_user_activity(user_uuid, "query_deleted", {"query_id": query_id})
             await set_state(user_id, STATE_ENTERING_STORE)
             user_data = await get_user_data(user_id)
-            user_data["current_query_index"] = None  # сброс индекса
+            user_data["current_query_id"] = None  # сброс выбранного запроса
             await set_user_data(user_id, user_data)
             response = reply("Запрос удалён.", after_store_menu(), disable_web_page_preview=True)
             duration = time.time() - start_time
-            log_technical(get_user_uuid(user_id), "bot_response", details={"text": "Запрос удалён.", "duration": duration})
-            log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-            return JSONResponse(response)
+            log_technical(user_uuid, "bot_response", details={"text": "Запрос удалён.", "duration": duration})
+            log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+            return response
         else:
-            log_user_activity(get_user_uuid(user_id), "error", {"error": "query_not_found", "query_index": idx})
+            log_user_activity(user_uuid, "error", {"error": "query_not_found", "query_id": query_id})
             user_data = await get_user_data(user_id)
-            user_data["current_query_index"] = None  # сброс индекса
+            user_data["current_query_id"] = None  # сброс выбранного запроса
             await set_user_data(user_id, user_data)
             response = reply("Не удалось удалить запрос. Возможно, он уже был удалён или не существует.", after_store_menu(), disable_web_page_preview=True)
             duration = time.time() - start_time
-            log_technical(get_user_uuid(user_id), "bot_response", details={"text": "Не удалось удалить запрос. Возможно, он уже был удалён или не существует.", "duration": duration})
-            log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-            return JSONResponse(response)
+            log_technical(user_uuid, "bot_response", details={"text": "Не удалось удалить запрос. Возможно, он уже был удалён или не существует.", "duration": duration})
+            log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+            return response
     
     if text == "⬅️ Назад":
-        log_user_activity(get_user_uuid(user_id), "navigation", {"action": "back_to_main_menu"})
+        log_user_activity(user_uuid, "navigation", {"action": "back_to_main_menu"})
         await set_state(user_id, STATE_ENTERING_STORE)
         user_data = await get_user_data(user_id)
-        user_data["current_query_index"] = None  # сброс индекса
+        user_data["current_query_id"] = None  # сброс выбранного запроса
         await set_user_data(user_id, user_data)
         response = reply("Выберите действие:", after_store_menu(), disable_web_page_preview=True)
         duration = time.time() - start_time
-        log_technical(get_user_uuid(user_id), "bot_response", details={"text": "Выберите действие:", "duration": duration})
-        log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-        return JSONResponse(response)
+        log_technical(user_uuid, "bot_response", details={"text": "Выберите действие:", "duration": duration})
+        log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+        return response
     
-    log_user_activity(get_user_uuid(user_id), "input_error", {"error": "unknown_command_in_saved_query", "input": text})
+    log_user_activity(user_uuid, "input_error", {"error": "unknown_command_in_saved_query", "input": text})
     response = reply("Выберите действие:", query_menu(), disable_web_page_preview=True)
     duration = time.time() - start_time
-    log_technical(get_user_uuid(user_id), "bot_response", details={"text": "Выберите действие:", "duration": duration})
-    log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-    return JSONResponse(response)
+    log_technical(user_uuid, "bot_response", details={"text": "Выберите действие:", "duration": duration})
+    log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+    return response
 
-async def handle_query_renaming(user_id: str, text: str, start_time: float):
+async def handle_query_renaming(user_id: str, user_uuid: str, text: str, start_time: float):
     """Обработка переименования запроса"""
     user_data = await get_user_data(user_id)
-    idx = user_data.get("current_query_index")
-    queries = load_saved_queries(get_user_uuid(user_id))
+    query_id = user_data.get("current_query_id")
     new_name = text
     
-    if idx is None or not (0 <= idx < len(queries)):
-        log_user_activity(get_user_uuid(user_id), "error", {"error": "query_not_found_for_rename", "query_index": idx})
+    if query_id is None or not await saved_queries.update(user_uuid, query_id, name=new_name):
+        log_user_activity(user_uuid, "error", {"error": "query_not_found_for_rename", "query_id": query_id})
         await set_state(user_id, STATE_ENTERING_STORE)
         response = reply("🔎 Не удалось найти этот запрос. Возможно, он был удалён. Пожалуйста, выберите другой из списка или создайте новый.", after_store_menu(), disable_web_page_preview=True)
         duration = time.time() - start_time
-        log_technical(get_user_uuid(user_id), "bot_response", details={"text": "🔎 Не удалось найти этот запрос. Возможно, он был удалён. Пожалуйста, выберите другой из списка или создайте новый.", "duration": duration})
-        log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-        return JSONResponse(response)
+        log_technical(user_uuid, "bot_response", details={"text": "🔎 Не удалось найти этот запрос. Возможно, он был удалён. Пожалуйста, выберите другой из списка или создайте новый.", "duration": duration})
+        log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+        return response
     
-    queries[idx]["name"] = new_name
-    save_saved_queries(get_user_uuid(user_id), queries)
-    log_user_activity(get_user_uuid(user_id), "query_renamed", {"query_index": idx, "new_name": new_name})
+    log_user_activity(user_uuid, "query_renamed", {"query_id": query_id, "new_name": new_name})
     await set_state(user_id, STATE_EDITING_SAVED_QUERY_STORES_MENU)
     response = reply("✅ Название обновлено", saved_query_edit_menu(), disable_web_page_preview=True)
     duration = time.time() - start_time
-    log_technical(get_user_uuid(user_id), "bot_response", details={"text": "✅ Название обновлено", "duration": duration})
-    log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-    return JSONResponse(response)
+    log_technical(user_uuid, "bot_response", details={"text": "✅ Название обновлено", "duration": duration})
+    log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+    return response
 
-async def handle_saved_query_stores_editing(user_id: str, text: str, start_time: float):
+async def handle_saved_query_stores_editing(user_id: str, user_uuid: str, text: str, start_time: float):
     """Обработка редактирования магазинов в сохраненном запросе"""
     user_data = await get_user_data(user_id)
-    idx = user_data.get("current_query_index")
-    queries = load_saved_queries(get_user_uuid(user_id))
+    query_id = user_data.get("current_query_id")
+    query = await saved_queries.get(user_uuid, query_id) if query_id is not None else None
     
-    if idx is None or not (0 <= idx < len(queries)):
-        log_user_activity(get_user_uuid(user_id), "error", {"error": "query_not_found_for_edit", "query_index": idx})
+    if query is None:
+        log_user_activity(user_uuid, "error", {"error": "query_not_found_for_edit", "query_id": query_id})
         await set_state(user_id, STATE_EDITING_SAVED_QUERY)
         response = reply("🔎 Не удалось найти этот запрос. Возможно, он был удалён. Пожалуйста, выберите другой из списка или создайте новый.", query_menu(), disable_web_page_preview=True)
         duration = time.time() - start_time
-        log_technical(get_user_uuid(user_id), "bot_response", details={"text": " Не удалось найти этот запрос. Возможно, он был удалён. Пожалуйста, выберите другой из списка или создайте новый.", "duration": duration})
-        log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-        return JSONResponse(response)
+        log_technical(user_uuid, "bot_response", details={"text": " Не удалось найти этот запрос. Возможно, он был удалён. Пожалуйста, выберите другой из списка или создайте новый.", "duration": duration})
+        log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+        return response
     
     if text == "⬅️ Назад":
-        log_user_activity(get_user_uuid(user_id), "navigation", {"action": "back_to_saved_query_menu"})
+        log_user_activity(user_uuid, "navigation", {"action": "back_to_saved_query_menu"})
         await set_state(user_id, STATE_EDITING_SAVED_QUERY)
         response = reply("Выберите действие:", query_menu(), disable_web_page_preview=True)
         duration = time.time() - start_time
-        log_technical(get_user_uuid(user_id), "bot_response", details={"text": "Выберите действие:", "duration": duration})
-        log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-        return JSONResponse(response)
+        log_technical(user_uuid, "bot_response", details={"text": "Выберите действие:", "duration": duration})
+        log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+        return response
     
     if text == "🗑 Очистить список":
-        log_user_activity(get_user_uuid(user_id), "saved_query_action", {"action": "clear_stores", "query_index": idx})
+        log_user_activity(user_uuid, "saved_query_action", {"action": "clear_stores", "query_id": query_id})
         user_data = await get_user_data(user_id)
         user_data["stores"] = []
         await set_user_data(user_id, user_data)
-        queries[idx]["stores"] = []
-        save_saved_queries(get_user_uuid(user_id), queries)
-        log_user_activity(get_user_uuid(user_id), "query_stores_updated", {"stores": []})
+        await saved_queries.update(user_uuid, query_id, stores=[])
+        log_user_activity(user_uuid, "query_stores_updated", {"stores": []})
         response = reply("✅ Изменения сохранены", saved_query_edit_menu(), disable_web_page_preview=True)
         duration = time.time() - start_time
-        log_technical(get_user_uuid(user_id), "bot_response", details={"text": "✅ Изменения сохранены", "duration": duration})
-        log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-        return JSONResponse(response)
+        log_technical(user_uuid, "bot_response", details={"text": "✅ Изменения сохранены", "duration": duration})
+        log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+        return response
     
     if text == "💾 Сохранить":
-        log_user_activity(get_user_uuid(user_id), "saved_query_action", {"action": "save_changes", "query_index": idx})
+        log_user_activity(user_uuid, "saved_query_action", {"action": "save_changes", "query_id": query_id})
         user_data = await get_user_data(user_id)
-        queries[idx]["stores"] = list(user_data["stores"])
-        save_saved_queries(get_user_uuid(user_id), queries)
-        log_user_activity(get_user_uuid(user_id), "query_saved", {"query_index": idx, "stores": user_data["stores"]})
+        await saved_queries.update(user_uuid, query_id, stores=list(user_data["stores"]))
+        log_user_activity(user_uuid, "query_saved", {"query_id": query_id, "stores": user_data["stores"]})
         response = reply("✅ Изменения сохранены", saved_query_edit_menu(), disable_web_page_preview=True)
         duration = time.time() - start_time
-        log_technical(get_user_uuid(user_id), "bot_response", details={"text": "✅ Изменения сохранены", "duration": duration})
-        log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-        return JSONResponse(response)
+        log_technical(user_uuid, "bot_response", details={"text": "✅ Изменения сохранены", "duration": duration})
+        log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+        return response
     
     if text == "✏️ Переименовать":
-        log_user_activity(get_user_uuid(user_id), "saved_query_action", {"action": "rename_prompt_from_edit", "query_index": idx})
+        log_user_activity(user_uuid, "saved_query_action", {"action": "rename_prompt_from_edit", "query_id": query_id})
         await set_state(user_id, STATE_RENAMING_QUERY_NAME)
         response = reply("Введите новое название:", saved_query_edit_menu(), disable_web_page_preview=True)
         duration = time.time() - start_time
-        log_technical(get_user_uuid(user_id), "bot_response", details={"text": "Введите новое название:", "duration": duration})
-        log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-        return JSONResponse(response)
+        log_technical(user_uuid, "bot_response", details={"text": "Введите новое название:", "duration": duration})
+        log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+        return response
     
     if text == "➕ Добавить в запрос":
-        log_user_activity(get_user_uuid(user_id), "saved_query_action", {"action": "add_store_prompt", "query_index": idx})
+        log_user_activity(user_uuid, "saved_query_action", {"action": "add_store_prompt", "query_id": query_id})
         await set_state(user_id, STATE_ENTERING_STORE)
         response = reply("Введите название магазина, который хотите добавить:", saved_query_edit_menu(), disable_web_page_preview=True)
         duration = time.time() - start_time
-        log_technical(get_user_uuid(user_id), "bot_response", details={"text": "Введите название магазина, который хотите добавить:", "duration": duration})
-        log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-        return JSONResponse(response)
+        log_technical(user_uuid, "bot_response", details={"text": "Введите название магазина, который хотите добавить:", "duration": duration})
+        log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+        return response
     
     if text == "🗑 Удалить магазин":
-        log_user_activity(get_user_uuid(user_id), "saved_query_action", {"action": "remove_store_prompt", "query_index": idx})
+        log_user_activity(user_uuid, "saved_query_action", {"action": "remove_store_prompt", "query_id": query_id})
         user_data = await get_user_data(user_id)
         stores = user_data["stores"]
         if not stores:
             response = reply("Список пуст", saved_query_edit_menu(), disable_web_page_preview=True)
             duration = time.time() - start_time
-            log_technical(get_user_uuid(user_id), "bot_response", details={"text": "Список пуст", "duration": duration})
-            log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-            return JSONResponse(response)
+            log_technical(user_uuid, "bot_response", details={"text": "Список пуст", "duration": duration})
+            log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+            return response
         response_text = "<b>Ваш список магазинов:</b>\n"
         for i, store in enumerate(stores, 1):
             response_text += f"{i}. {store}\n"
         response_text += "\nВведите номер магазина, который хотите удалить."
         response = reply(response_text, saved_query_edit_menu(), disable_web_page_preview=True)
         duration = time.time() - start_time
-        log_technical(get_user_uuid(user_id), "bot_response", details={"text": response_text, "duration": duration})
-        log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-        return JSONResponse(response)
+        log_technical(user_uuid, "bot_response", details={"text": response_text, "duration": duration})
+        log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+        return response
     
     if text.isdigit():
         index = int(text) - 1
@@ -761,59 +816,57 @@ async def handle_saved_query_stores_editing(user_id: str, text: str, start_time:
         stores = user_data["stores"]
         if 0 <= index < len(stores):
             removed = stores.pop(index)
-            queries[idx]["stores"] = list(stores)
-            save_saved_queries(get_user_uuid(user_id), queries)
+            await saved_queries.update(user_uuid, query_id, stores=list(stores))
             user_data["stores"] = stores
             await set_user_data(user_id, user_data)
-            log_user_activity(get_user_uuid(user_id), "query_stores_updated", {"removed_store": removed, "stores": stores, "method": "by_number"})
+            log_user_activity(user_uuid, "query_stores_updated", {"removed_store": removed, "stores": stores, "method": "by_number"})
             await set_state(user_id, STATE_EDITING_SAVED_QUERY_STORES_MENU)
             response = reply(f"Магазин <b>{removed}</b> удалён из списка", saved_query_edit_menu(), disable_web_page_preview=True)
             duration = time.time() - start_time
-            log_technical(get_user_uuid(user_id), "bot_response", details={"text": f"Магазин <b>{removed}</b> удалён из списка", "duration": duration})
-            log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-            return JSONResponse(response)
+            log_technical(user_uuid, "bot_response", details={"text": f"Магазин <b>{removed}</b> удалён из списка", "duration": duration})
+            log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+            return response
         else:
-            log_user_activity(get_user_uuid(user_id), "input_error", {"error": "invalid_store_number_in_saved", "input": text, "max_valid": len(stores)})
+            log_user_activity(user_uuid, "input_error", {"error": "invalid_store_number_in_saved", "input": text, "max_valid": len(stores)})
             response = reply("Похоже, вы ввели неверный номер магазина. Проверьте список и попробуйте снова.", saved_query_edit_menu(), disable_web_page_preview=True)
             duration = time.time() - start_time
-            log_technical(get_user_uuid(user_id), "bot_response", details={"text": "Похоже, вы ввели неверный номер магазина. Проверьте список и попробуйте снова.", "duration": duration})
-            log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-            return JSONResponse(response)
+            log_technical(user_uuid, "bot_response", details={"text": "Похоже, вы ввели неверный номер магазина. Проверьте список и попробуйте снова.", "duration": duration})
+            log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+            return response
     
     # Добавление магазина в сохраненный запрос
     corrected = correct_store_name(text, ALL_STORES)
     if not corrected:
-        log_user_activity(get_user_uuid(user_id), "store_not_found_in_saved", {"input": text, "query_index": idx})
+        log_user_activity(user_uuid, "store_not_found_in_saved", {"input": text, "query_id": query_id})
         response = reply(f"❌ Магазин <b>{text}</b> не найден. Попробуйте снова.", saved_query_edit_menu(), disable_web_page_preview=True)
         duration = time.time() - start_time
-        log_technical(get_user_uuid(user_id), "bot_response", details={"text": f"❌ Магазин <b>{text}</b> не найден. Попробуйте снова.", "duration": duration})
-        log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-        return JSONResponse(response)
+        log_technical(user_uuid, "bot_response", details={"text": f"❌ Магазин <b>{text}</b> не найден. Попробуйте снова.", "duration": duration})
+        log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+        return response
     
     user_data = await get_user_data(user_id)
     if corrected.lower() in [s.lower() for s in user_data["stores"]]:
-        log_user_activity(get_user_uuid(user_id), "store_already_exists_in_saved", {"store": corrected, "input": text, "query_index": idx})
+        log_user_activity(user_uuid, "store_already_exists_in_saved", {"store": corrected, "input": text, "query_id": query_id})
         response = reply(f"🔁 Магазин <b>{corrected}</b> уже есть в списке.", saved_query_edit_menu(), disable_web_page_preview=True)
         duration = time.time() - start_time
-        log_technical(get_user_uuid(user_id), "bot_response", details={"text": f"🔁 Магазин <b>{corrected}</b> уже есть в списке.", "duration": duration})
-        log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-        return JSONResponse(response)
+        log_technical(user_uuid, "bot_response", details={"text": f"🔁 Магазин <b>{corrected}</b> уже есть в списке.", "duration": duration})
+        log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+        return response
     
     user_data["stores"] = user_data["stores"] + [corrected]
     await set_user_data(user_id, user_data)
     user_data = await get_user_data(user_id)
-    queries[idx]["stores"] = list(user_data["stores"])
-    save_saved_queries(get_user_uuid(user_id), queries)
-    log_user_activity(get_user_uuid(user_id), "query_stores_updated", {"added_store": corrected, "stores": user_data["stores"], "input": text, "was_corrected": text != corrected})
+    await saved_queries.update(user_uuid, query_id, stores=list(user_data["stores"]))
+    log_user_activity(user_uuid, "query_stores_updated", {"added_store": corrected, "stores": user_data["stores"], "input": text, "was_corrected": text != corrected})
     response_text = f"<b>Магазин добавлен:</b> {corrected}\n\n"
     response_text += "<b>Текущий список:</b>\n"
     for i, store in enumerate(user_data["stores"], 1):
         response_text += f"{i}. {store}\n"
     response = reply(response_text, saved_query_edit_menu(), disable_web_page_preview=True)
     duration = time.time() - start_time
-    log_technical(get_user_uuid(user_id), "bot_response", details={"text": response_text, "duration": duration})
-    log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-    return JSONResponse(response)
+    log_technical(user_uuid, "bot_response", details={"text": response_text, "duration": duration})
+    log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+    return response
 
 @app.post("/handle_update")
 async def handle_update(request: Request):
@@ -829,111 +882,7 @@ async def handle_update(request: Request):
     try:
         check_token(request)
         data = await request.json()
-        user_id = data.get("user_id")
-        text = (data.get("text") or "").strip()
-        
-        # Обновляем лог с информацией о пользователе
-        log_technical(get_user_uuid(user_id), "http_request", details={
-            "method": "POST",
-            "path": "/handle_update",
-            "user_id": user_id,
-            "text": text[:100] if text else None,  # Ограничиваем длину текста
-            "timestamp": datetime.now().isoformat()
-        })
-        
-        if not user_id:
-            response = reply("Произошла ошибка. Пожалуйста, попробуйте ещё раз или начните сначала.", disable_web_page_preview=True)
-            duration = time.time() - start_time
-            log_technical(get_user_uuid(user_id), "bot_response", details={"text": "Произошла ошибка. Пожалуйста, попробуйте ещё раз или начните сначала.", "duration": duration})
-            log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-            return JSONResponse(response)
-        
-        user_data = await get_user_data(user_id)
-        state = await get_state(user_id)
-
-        # /start
-        if text == "/start":
-            return await handle_start_command(user_id, start_time)
-
-        # FSM: выбор города
-        if state == STATE_CHOOSING_CITY:
-            return await handle_city_selection(user_id, text, start_time)
-
-        # FSM: ввод магазинов
-        if state == STATE_ENTERING_STORE:
-            # Обычные кнопки для обычного режима (обрабатываются всегда, даже если есть current_query_index)
-            if text == "🧾 Редактировать":
-                return await handle_store_editing(user_id, start_time)
-            if text == "🔁 Сменить город":
-                return await handle_city_change(user_id, start_time)
-            if text == "🔍 Искать":
-                return await handle_mall_search(user_id, start_time)
-            if text == "🗑 Очистить список":
-                return await handle_clear_stores_list(user_id, start_time)
-            if text == "📜 Список запросов":
-                return await handle_show_saved_queries(user_id, start_time)
-            if text == "🛍️ Добавить":
-                return await handle_add_store_prompt(user_id, start_time)
-            if text == "🆕 Новый поиск":
-                return await handle_new_search(user_id, start_time)
-            user_data = await get_user_data(user_id)
-            if user_data.get("current_query_index") is not None:
-                # Обрабатываем все действия (включая ввод номера) через handle_saved_query_stores_editing
-                return await handle_saved_query_stores_editing(user_id, text, start_time)
-            if text.isdigit():
-                return await handle_store_number_input(user_id, text, start_time)
-            # Добавление магазина
-            return await handle_store_name_input(user_id, text, start_time)
-
-        # FSM: работа с сохранённым запросом
-        if state == STATE_EDITING_SAVED_QUERY:
-            return await handle_saved_query_actions(user_id, text, start_time)
-
-        # FSM: переименование запроса
-        if state == STATE_RENAMING_QUERY_NAME:
-            return await handle_query_renaming(user_id, text, start_time)
-
-        # FSM: редактирование магазинов в сохранённом запросе
-        if state == STATE_EDITING_SAVED_QUERY_STORES_MENU:
-            return await handle_saved_query_stores_editing(user_id, text, start_time)
-
-        # FSM: ввод названия нового запроса
-        if state == STATE_ENTERING_QUERY_NAME:
-            user_data = await get_user_data(user_id)
-            query_name = text.strip()
-            if not query_name:
-                response = reply("Название запроса не может быть пустым. Пожалуйста, введите название:", disable_web_page_preview=True)
-                duration = time.time() - start_time
-                log_technical(get_user_uuid(user_id), "bot_response", details={"text": "Название запроса не может быть пустым. Пожалуйста, введите название:", "duration": duration})
-                log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-                return JSONResponse(response)
-            queries = load_saved_queries(get_user_uuid(user_id))
-            # Генерируем уникальный id
-            if queries:
-                max_id = max(q.get("id", 0) for q in queries)
-                new_id = max_id + 1
-            else:
-                new_id = 1
-            new_query = {"id": new_id, "name": query_name, "stores": list(user_data.get("stores", [])), "city": user_data.get("city")}
-            queries.append(new_query)
-            save_saved_queries(get_user_uuid(user_id), queries)
-            user_data["current_query_index"] = None
-            await set_user_data(user_id, user_data)
-            await set_state(user_id, STATE_ENTERING_STORE)
-            response = reply(f"✅ Запрос <b>{query_name}</b> сохранён!", after_store_menu(), disable_web_page_preview=True)
-            duration = time.time() - start_time
-            log_technical(get_user_uuid(user_id), "bot_response", details={"text": f"✅ Запрос <b>{query_name}</b> сохранён!", "duration": duration})
-            log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-            return JSONResponse(response)
-
-        # fallback
-        log_user_activity(get_user_uuid(user_id), "navigation", {"action": "fallback_to_start"})
-        response = reply("Не удалось распознать действие. Пожалуйста, начните сначала с команды /start", city_menu(), disable_web_page_preview=True)
-        duration = time.time() - start_time
-        log_technical(get_user_uuid(user_id), "bot_response", details={"text": "Не удалось распознать действие. Пожалуйста, начните сначала с команды /start", "duration": duration})
-        log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-        return JSONResponse(response)
-        
+        return JSONResponse(await process_update(data, start_time))
     except HTTPException as e:
         duration = time.time() - start_time
         log_technical(None, "http_response", details={"status_code": e.status_code, "status": e.detail, "duration": duration})
@@ -943,6 +892,111 @@ async def handle_update(request: Request):
         log_technical(None, "http_response", details={"status_code": 500, "status": "Internal Server Error", "error": str(e), "duration": duration})
         raise
 
+async def process_update(data: Dict[str, Any], start_time: float = None) -> Dict[str, Any]:
+    """
+    Обработка сообщения пользователя: payload от bot_gateway -> ответ (text, reply_markup, ...).
+    Вызывается из /handle_update или напрямую из bot_gateway во встроенном режиме.
+    """
+    if start_time is None:
+        start_time = time.time()
+    user_id = data.get("user_id")
+    user_uuid = get_user_uuid(user_id)
+    text = (data.get("text") or "").strip()
+    
+    # Обновляем лог с информацией о пользователе
+    log_technical(user_uuid, "http_request", details={
+        "method": "POST",
+        "path": "/handle_update",
+        "user_id": user_id,
+        "text": text[:100] if text else None,  # Ограничиваем длину текста
+        "timestamp": datetime.now().isoformat()
+    })
+    
+    if not user_id:
+        response = reply("Произошла ошибка. Пожалуйста, попробуйте ещё раз или начните сначала.", disable_web_page_preview=True)
+        duration = time.time() - start_time
+        log_technical(user_uuid, "bot_response", details={"text": "Произошла ошибка. Пожалуйста, попробуйте ещё раз или начните сначала.", "duration": duration})
+        log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+        return response
+    
+    user_data = await get_user_data(user_id)
+    state = await get_state(user_id)
+
+    # /start
+    if text == "/start":
+        return await handle_start_command(user_id, user_uuid, start_time)
+
+    # FSM: выбор города
+    if state == STATE_CHOOSING_CITY:
+        return await handle_city_selection(user_id, user_uuid, text, start_time)
+
+    # FSM: ввод магазинов
+    if state == STATE_ENTERING_STORE:
+        # Обычные кнопки для обычного режима (обрабатываются всегда, даже если есть current_query_id)
+        if text == "🧾 Редактировать":
+            return await handle_store_editing(user_id, user_uuid, start_time)
+        if text == "🔁 Сменить город":
+            return await handle_city_change(user_id, user_uuid, start_time)
+        if text == "🔍 Искать":
+            return await handle_mall_search(user_id, user_uuid, start_time)
+        if text == "🗑 Очистить список":
+            return await handle_clear_stores_list(user_id, user_uuid, start_time)
+        if text == "📜 Список запросов":
+            return await handle_show_saved_queries(user_id, user_uuid, start_time)
+        if text == "🛍️ Добавить":
+            return await handle_add_store_prompt(user_id, user_uuid, start_time)
+        if text == "🆕 Новый поиск":
+            return await handle_new_search(user_id, user_uuid, start_time)
+        user_data = await get_user_data(user_id)
+        if user_data.get("current_query_id") is not None:
+            # Обрабатываем все действия (включая ввод номера) через handle_saved_query_stores_editing
+            return await handle_saved_query_stores_editing(user_id, user_uuid, text, start_time)
+        if text.isdigit():
+            return await handle_store_number_input(user_id, user_uuid, text, start_time)
+        # Добавление магазина
+        return await handle_store_name_input(user_id, user_uuid, text, start_time)
+
+    # FSM: работа с сохранённым запросом
+    if state == STATE_EDITING_SAVED_QUERY:
+        return await handle_saved_query_actions(user_id, user_uuid, text, start_time)
+
+    # FSM: переименование запроса
+    if state == STATE_RENAMING_QUERY_NAME:
+        return await handle_query_renaming(user_id, user_uuid, text, start_time)
+
+    # FSM: редактирование магазинов в сохранённом запросе
+    if state == STATE_EDITING_SAVED_QUERY_STORES_MENU:
+        return await handle_saved_query_stores_editing(user_id, user_uuid, text, start_time)
+
+    # FSM: ввод названия нового запроса
+    if state == STATE_ENTERING_QUERY_NAME:
+        user_data = await get_user_data(user_id)
+        query_name = text.strip()
+        if not query_name:
+            response = reply("Название запроса не может быть пустым. Пожалуйста, введите название:", disable_web_page_preview=True)
+            duration = time.time() - start_time
+            log_technical(user_uuid, "bot_response", details={"text": "Название запроса не может быть пустым. Пожалуйста, введите название:", "duration": duration})
+            log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+            return response
+        # id выдаётся хранилищем атомарно (max + 1 в пределах пользователя)
+        await saved_queries.create(user_uuid, query_name, list(user_data.get("stores", [])), user_data.get("city"))
+        user_data["current_query_id"] = None
+        await set_user_data(user_id, user_data)
+        await set_state(user_id, STATE_ENTERING_STORE)
+        response = reply(f"✅ Запрос <b>{query_name}</b> сохранён!", after_store_menu(), disable_web_page_preview=True)
+        duration = time.time() - start_time
+        log_technical(user_uuid, "bot_response", details={"text": f"✅ Запрос <b>{query_name}</b> сохранён!", "duration": duration})
+        log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+        return response
+
+    # fallback
+    log_user_activity(user_uuid, "navigation", {"action": "fallback_to_start"})
+    response = reply("Не удалось распознать действие. Пожалуйста, начните сначала с команды /start", city_menu(), disable_web_page_preview=True)
+    duration = time.time() - start_time
+    log_technical(user_uuid, "bot_response", details={"text": "Не удалось распознать действие. Пожалуйста, начните сначала с команды /start", "duration": duration})
+    log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+    return response
+
 @app.post("/handle_callback")
 async def handle_callback(request: Request):
     start_time = time.time()
@@ -957,238 +1011,256 @@ async def handle_callback(request: Request):
     try:
         check_token(request)
         data = await request.json()
-        user_id = data.get("user_id")
-        callback_data = data.get("callback_data")
-        message_id = data.get("message_id")
-        chat_id = data.get("chat_id")
+        return JSONResponse(await process_callback(data, start_time))
+    except HTTPException as e:
+        duration = time.time() - start_time
+        log_technical(None, "http_response", details={"status_code": e.status_code, "status": e.detail, "duration": duration})
+        raise
+    except Exception as e:
+        duration = time.time() - start_time
+        log_technical(None, "http_response", details={"status_code": 500, "status": "Internal Server Error", "error": str(e), "duration": duration})
+        raise
+
+async def process_callback(data: Dict[str, Any], start_time: float = None) -> Dict[str, Any]:
+    """Обработка нажатия инлайн-кнопки; вызывается из /handle_callback или из bot_gateway во встроенном режиме"""
+    if start_time is None:
+        start_time = time.time()
+    user_id = data.get("user_id")
+    user_uuid = get_user_uuid(user_id)
+    callback_data = data.get("callback_data")
+    message_id = data.get("message_id")
+    chat_id = data.get("chat_id")
+    
+    # Обновляем лог с информацией о пользователе
+    log_technical(user_uuid, "http_request", details={
+        "method": "POST", 
+        "path": "/handle_callback",
+        "user_id": user_id,
+        "callback_data": callback_data,
+        "message_id": message_id,
+        "chat_id": chat_id,
+        "timestamp": datetime.now().isoformat()
+    })
+    
+    if not user_id or not callback_data:
+        response = reply("Не удалось выполнить действие. Пожалуйста, попробуйте ещё раз или перезапустите бота.", disable_web_page_preview=True)
+        duration = time.time() - start_time
+        log_technical(user_uuid, "bot_response", details={"text": "Не удалось выполнить действие. Пожалуйста, попробуйте ещё раз или перезапустите бота.", "duration": duration})
+        log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+        return response
+    state = await get_state(user_id)
+    log_technical(user_uuid, "callback_query", details={"callback_data": callback_data, "state": state})
+
+    # wrong_store::<user_input_index>::<corrected_index>
+    if callback_data.startswith("wrong_store::"):
+        log_user_activity(user_uuid, "callback_action", {"action": "wrong_store_correction"})
+        log_debug(user_uuid, lambda: f"Processing wrong_store callback: {callback_data}")
+        parts = callback_data.split("::")
+        if len(parts) < 3 or not parts[1].isdigit() or not parts[2].isdigit():
+            response = reply("Не удалось выполнить действие. Пожалуйста, попробуйте ещё раз или начните сначала.", disable_web_page_preview=True)
+            duration = time.time() - start_time
+            log_technical(user_uuid, "bot_response", details={"text": "Не удалось выполнить действие. Пожалуйста, попробуйте ещё раз или начните сначала.", "duration": duration})
+            log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+            return response
+        user_input_index = int(parts[1])
+        corrected_index = int(parts[2])
+        log_debug(user_uuid, lambda: f"Parsed indices: user_input_index={user_input_index}, corrected_index={corrected_index}")
+        user_data = await get_user_data(user_id)
+        store_choices = user_data.get("store_choices", [])
+        log_debug(user_uuid, lambda: f"Before removal - stores: {user_data.get('stores', [])}, store_choices: {store_choices}")
         
-        # Обновляем лог с информацией о пользователе
-        log_technical(get_user_uuid(user_id), "http_request", details={
-            "method": "POST", 
-            "path": "/handle_callback",
-            "user_id": user_id,
-            "callback_data": callback_data,
-            "message_id": message_id,
-            "chat_id": chat_id,
-            "timestamp": datetime.now().isoformat()
-        })
+        # Удаляем последний добавленный магазин из списка
+        stores = user_data.get("stores", [])
+        if stores:
+            last_added_store = stores[-1]
+            user_data["stores"] = stores[:-1]  # Удаляем последний элемент
+            await set_user_data(user_id, user_data)
+            log_user_activity(user_uuid, "store_removed", {"store": last_added_store, "method": "wrong_store_callback"})
+            log_debug(user_uuid, lambda: f"Removed store '{last_added_store}', remaining stores: {user_data.get('stores', [])}")
+            log_debug(user_uuid, lambda: f"After removal - stores: {user_data.get('stores', [])}, store_choices: {user_data.get('store_choices', [])}")
+        else:
+            last_added_store = None
+            log_debug(user_uuid, lambda: "No stores to remove")
         
-        if not user_id or not callback_data:
-            response = reply("Не удалось выполнить действие. Пожалуйста, попробуйте ещё раз или перезапустите бота.", disable_web_page_preview=True)
-            duration = time.time() - start_time
-            log_technical(get_user_uuid(user_id), "bot_response", details={"text": "Не удалось выполнить действие. Пожалуйста, попробуйте ещё раз или перезапустите бота.", "duration": duration})
-            log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-            return JSONResponse(response)
-        state = await get_state(user_id)
-        log_technical(get_user_uuid(user_id), "callback_query", details={"callback_data": callback_data, "state": state})
-
-        # wrong_store::<user_input_index>::<corrected_index>
-        if callback_data.startswith("wrong_store::"):
-            log_user_activity(get_user_uuid(user_id), "callback_action", {"action": "wrong_store_correction"})
-            log_technical(get_user_uuid(user_id), "debug", details={"message": f"Processing wrong_store callback: {callback_data}"})
-            parts = callback_data.split("::")
-            if len(parts) < 3 or not parts[1].isdigit() or not parts[2].isdigit():
-                response = reply("Не удалось выполнить действие. Пожалуйста, попробуйте ещё раз или начните сначала.", disable_web_page_preview=True)
-                duration = time.time() - start_time
-                log_technical(get_user_uuid(user_id), "bot_response", details={"text": "Не удалось выполнить действие. Пожалуйста, попробуйте ещё раз или начните сначала.", "duration": duration})
-                log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-                return JSONResponse(response)
-            user_input_index = int(parts[1])
-            corrected_index = int(parts[2])
-            log_technical(get_user_uuid(user_id), "debug", details={"message": f"Parsed indices: user_input_index={user_input_index}, corrected_index={corrected_index}"})
-            user_data = await get_user_data(user_id)
-            store_choices = user_data.get("store_choices", [])
-            log_technical(get_user_uuid(user_id), "debug", details={"message": f"Before removal - stores: {user_data.get('stores', [])}, store_choices: {store_choices}"})
-            
-            # Удаляем последний добавленный магазин из списка
-            stores = user_data.get("stores", [])
-            if stores:
-                last_added_store = stores[-1]
-                user_data["stores"] = stores[:-1]  # Удаляем последний элемент
-                await set_user_data(user_id, user_data)
-                log_user_activity(get_user_uuid(user_id), "store_removed", {"store": last_added_store, "method": "wrong_store_callback"})
-                log_technical(get_user_uuid(user_id), "debug", details={"message": f"Removed store '{last_added_store}', remaining stores: {user_data.get('stores', [])}"})
-                log_technical(get_user_uuid(user_id), "debug", details={"message": f"After removal - stores: {user_data.get('stores', [])}, store_choices: {user_data.get('store_choices', [])}"})
-            else:
-                last_added_store = None
-                log_technical(get_user_uuid(user_id), "debug", details={"message": "No stores to remove"})
-            
-            # Получаем исходный пользовательский ввод
-            log_technical(get_user_uuid(user_id), "debug", details={"message": f"store_choices: {store_choices}, user_input_index: {user_input_index}"})
-            if len(store_choices) > 0:
-                user_input = store_choices[0]  # Всегда используем первый элемент
-                log_technical(get_user_uuid(user_id), "debug", details={"message": f"Using store_choices[0] = {user_input}"})
+        # Получаем исходный пользовательский ввод
+        log_debug(user_uuid, lambda: f"store_choices: {store_choices}, user_input_index: {user_input_index}")
+        if len(store_choices) > 0:
+            user_input = store_choices[0]  # Всегда используем первый элемент
+            log_debug(user_uuid, lambda: f"Using store_choices[0] = {user_input}")
+        else:
+            # Если store_choices пуст, попробуем использовать удаленный магазин как исходный ввод
+            if last_added_store:
+                user_input = last_added_store
+                log_debug(user_uuid, lambda: f"Using removed store as input: {user_input}")
             else:
-                # Если store_choices пуст, попробуем использовать удаленный магазин как исходный ввод
-                if last_added_store:
-                    user_input = last_added_store
-                    log_technical(get_user_uuid(user_id), "debug", details={"message": f"Using removed store as input: {user_input}"})
-                else:
-                    user_input = ""
-                    log_technical(get_user_uuid(user_id), "debug", details={"message": "No input found, using empty string"})
-            
-            similar = process.extract(
-                user_input,
-                ALL_STORES,
-                limit=5,
-                processor=str.lower,
-            ) if process else []
-            if not similar:
-                response = reply("Не удалось найти похожие магазины. Попробуйте изменить запрос или ввести название вручную", disable_web_page_preview=True)
-                duration = time.time() - start_time
-                log_technical(get_user_uuid(user_id), "bot_response", details={"text": "Не удалось найти похожие магазины. Попробуйте изменить запрос или ввести название вручную", "duration": duration})
-                log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-                return JSONResponse(response)
-            # Сохраняем варианты в user_data
-            user_data["store_choices"] = [match[0] for match in similar]
-            await set_user_data(user_id, user_data)
-            log_technical(get_user_uuid(user_id), "debug", details={"message": f"Found {len(similar)} similar stores for '{user_input}': {[match[0] for match in similar]}"})
-            log_technical(get_user_uuid(user_id), "debug", details={"message": f"After finding similar stores - stores: {user_data.get('stores', [])}, store_choices: {user_data.get('store_choices', [])}"})
-            # Формируем кнопки с индексами
-            buttons = [
-                [{"text": match[0], "callback_data": f"pick_store::{i}"}] for i, match in enumerate(similar)
-            ]
-            keyboard = {"inline_keyboard": buttons}
-            response = reply(f"Выберите правильный магазин для: <b>{user_input}</b>", keyboard, disable_web_page_preview=True)
-            log_technical(get_user_uuid(user_id), "debug", details={"message": f"Final response - stores: {user_data.get('stores', [])}, store_choices: {user_data.get('store_choices', [])}"})
-            duration = time.time() - start_time
-            log_technical(get_user_uuid(user_id), "bot_response", details={"text": f"Выберите правильный магазин для: <b>{user_input}</b>", "duration": duration})
-            log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-            return JSONResponse(response)
-
-        # pick_store::<index>
-        if callback_data.startswith("pick_store::"):
-            log_technical(get_user_uuid(user_id), "debug", details={"message": f"Processing pick_store callback: {callback_data}"})
-            index_str = callback_data.split("::")[1].strip() if len(callback_data.split("::")) > 1 else None
-            if not index_str or not index_str.isdigit():
-                response = reply("🏪 Не удалось определить магазин. Пожалуйста, выберите магазин из списка или попробуйте снова.", disable_web_page_preview=True)
-                duration = time.time() - start_time
-                log_technical(get_user_uuid(user_id), "bot_response", details={"text": "🏪 Не удалось определить магазин. Пожалуйста, выберите магазин из списка или попробуйте снова.", "duration": duration})
-                log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-                return JSONResponse(response)
-            index = int(index_str)
-            log_technical(get_user_uuid(user_id), "debug", details={"message": f"Parsed index: {index}"})
-            user_data = await get_user_data(user_id)
-            store_choices = user_data.get("store_choices", [])
-            log_technical(get_user_uuid(user_id), "debug", details={"message": f"pick_store - stores: {user_data.get('stores', [])}, store_choices: {store_choices}, index: {index}"})
-            if index < 0 or index >= len(store_choices):
-                response = reply("🏪 Не удалось определить магазин. Пожалуйста, выберите магазин из списка или попробуйте снова.", disable_web_page_preview=True)
-                duration = time.time() - start_time
-                log_technical(get_user_uuid(user_id), "bot_response", details={"text": "🏪 Не удалось определить магазин. Пожалуйста, выберите магазин из списка или попробуйте снова.", "duration": duration})
-                log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-                return JSONResponse(response)
-            chosen = store_choices[index]
-            if chosen.lower() in [s.lower().strip() for s in user_data.get("stores", [])]:
-                log_user_activity(get_user_uuid(user_id), "store_already_exists", {"store": chosen, "method": "callback_pick"})
-                response = reply(f"🔁 Магазин <b>{chosen}</b> уже есть в списке", disable_web_page_preview=True)
-                duration = time.time() - start_time
-                log_technical(get_user_uuid(user_id), "bot_response", details={"text": f"🔁 Магазин <b>{chosen}</b> уже есть в списке", "duration": duration})
-                log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-                return JSONResponse(response)
-            user_data["stores"] = user_data.get("stores", []) + [chosen]
-            await set_user_data(user_id, user_data)
-            user_data = await get_user_data(user_id)
-            log_user_activity(get_user_uuid(user_id), "store_added", {"store": chosen, "method": "callback_pick"})
-            log_technical(get_user_uuid(user_id), "debug", details={"message": f"Added store '{chosen}', current stores: {user_data.get('stores', [])}"})
-            log_technical(get_user_uuid(user_id), "debug", details={"message": f"After adding store - stores: {user_data.get('stores', [])}, store_choices: {user_data.get('store_choices', [])}"})
-            response_text = f"<b>Магазин добавлен:</b> {chosen}\n\n"
-            response_text += "<b>Текущий список:</b>\n"
-            for i, store in enumerate(user_data["stores"], 1):
-                response_text += f"{i}. {store}\n"
-            # Две кнопки — каждая на своей строке
-            # Для wrong_store передаём индекс исходного пользовательского ввода
-            user_data = await get_user_data(user_id)
-            store_choices = user_data.get("store_choices", [])
-            # Находим индекс исходного пользовательского ввода
-            original_input_index = len(store_choices) - 1 if store_choices else 0
-            log_technical(get_user_uuid(user_id), "debug", details={"message": f"Added store '{chosen}', store_choices: {store_choices}, original_input_index: {original_input_index}"})
-            keyboard = {"inline_keyboard": [
-                [{"text": "❌ Это не тот магазин", "callback_data": f"wrong_store::0::{index}"}],
-                [{"text": "💾 Сохранить запрос", "callback_data": "save_query"}]
-            ]}
-            response = reply(response_text, keyboard, disable_web_page_preview=True)
-            duration = time.time() - start_time
-            log_technical(get_user_uuid(user_id), "bot_response", details={"text": response_text, "duration": duration})
-            log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-            return JSONResponse(response)
-
-        # clear_list
-        if callback_data == "clear_list":
-            log_user_activity(get_user_uuid(user_id), "callback_action", {"action": "clear_list"})
-            await set_user_data(user_id, {"stores": []})
-            response = reply("Список магазинов очищен", disable_web_page_preview=True)
+                user_input = ""
+                log_debug(user_uuid, lambda: "No input found, using empty string")
+        
+        similar = process.extract(
+            user_input,
+            ALL_STORES,
+            limit=5,
+            processor=str.lower,
+        ) if process else []
+        if not similar:
+            response = reply("Не удалось найти похожие магазины. Попробуйте изменить запрос или ввести название вручную", disable_web_page_preview=True)
             duration = time.time() - start_time
-            log_technical(get_user_uuid(user_id), "bot_response", details={"text": "Список магазинов очищен", "duration": duration})
-            log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-            return JSONResponse(response)
+            log_technical(user_uuid, "bot_response", details={"text": "Не удалось найти похожие магазины. Попробуйте изменить запрос или ввести название вручную", "duration": duration})
+            log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+            return response
+        # Сохраняем варианты в user_data
+        user_data["store_choices"] = [match[0] for match in similar]
+        await set_user_data(user_id, user_data)
+        log_debug(user_uuid, lambda: f"Found {len(similar)} similar stores for '{user_input}': {[match[0] for match in similar]}")
+        log_debug(user_uuid, lambda: f"After finding similar stores - stores: {user_data.get('stores', [])}, store_choices: {user_data.get('store_choices', [])}")
+        # Формируем кнопки с индексами
+        buttons = [
+            [{"text": match[0], "callback_data": f"pick_store::{i}"}] for i, match in enumerate(similar)
+        ]
+        keyboard = {"inline_keyboard": buttons}
+        response = edit_reply(message_id, f"Выберите правильный магазин для: <b>{user_input}</b>", keyboard, disable_web_page_preview=True)
+        log_debug(user_uuid, lambda: f"Final response - stores: {user_data.get('stores', [])}, store_choices: {user_data.get('store_choices', [])}")
+        duration = time.time() - start_time
+        log_technical(user_uuid, "bot_response", details={"text": f"Выберите правильный магазин для: <b>{user_input}</b>", "duration": duration})
+        log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+        return response
 
-        # save_query
-        if callback_data == "save_query":
-            log_user_activity(get_user_uuid(user_id), "callback_action", {"action": "save_query_prompt"})
-            user_data = await get_user_data(user_id)
-            if not user_data.get("stores"):
-                response = reply("Список магазинов пуст, нечего сохранять.", disable_web_page_preview=True)
-                duration = time.time() - start_time
-                log_technical(get_user_uuid(user_id), "bot_response", details={"text": "Список магазинов пуст, нечего сохранять.", "duration": duration})
-                log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-                return JSONResponse(response)
-            await set_state(user_id, STATE_ENTERING_QUERY_NAME)
-            response = reply("Введите название запроса:", disable_web_page_preview=True)
+    # pick_store::<index>
+    if callback_data.startswith("pick_store::"):
+        log_debug(user_uuid, lambda: f"Processing pick_store callback: {callback_data}")
+        index_str = callback_data.split("::")[1].strip() if len(callback_data.split("::")) > 1 else None
+        if not index_str or not index_str.isdigit():
+            response = reply("🏪 Не удалось определить магазин. Пожалуйста, выберите магазин из списка или попробуйте снова.", disable_web_page_preview=True)
             duration = time.time() - start_time
-            log_technical(get_user_uuid(user_id), "bot_response", details={"text": "Введите название запроса:", "duration": duration})
-            log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-            return JSONResponse(response)
-
-        # load_query::<index>
-        if callback_data.startswith("load_query::"):
-            idx = int(callback_data.split("::")[1])
-            queries = load_saved_queries(get_user_uuid(user_id))
-            if idx >= len(queries):
-                log_user_activity(get_user_uuid(user_id), "error", {"error": "query_index_out_of_range", "requested_index": idx, "available_count": len(queries)})
-                response = reply("Не удалось найти выбранный запрос. Пожалуйста, выберите другой из списка.", disable_web_page_preview=True)
-                duration = time.time() - start_time
-                log_technical(get_user_uuid(user_id), "bot_response", details={"text": "Не удалось найти выбранный запрос. Пожалуйста, выберите другой из списка.", "duration": duration})
-                log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-                return JSONResponse(response)
-            query = queries[idx]
-            log_user_activity(get_user_uuid(user_id), "saved_queries_action", {"action": "load_by_callback", "query_index": idx, "query_name": query["name"]})
-            # Сохраняем город, если он есть в запросе
-            city = query.get("city")
-            user_data = await get_user_data(user_id)
-            new_data = {
-                "stores": list(query["stores"]),
-                "current_query_index": idx
-            }
-            if city:
-                new_data["city"] = city
-            else:
-                # если в query нет города, оставляем старый
-                if "city" in user_data:
-                    new_data["city"] = user_data["city"]
-            await set_user_data(user_id, new_data)
-            await set_state(user_id, STATE_EDITING_SAVED_QUERY)
-            response_text = f"Загружен список <b>{query['name']}</b>:\n\n"
-            for i, store in enumerate(query["stores"], 1):
-                response_text += f"{i}. {store}\n"
-            response = reply(response_text, query_menu(), disable_web_page_preview=True)
+            log_technical(user_uuid, "bot_response", details={"text": "🏪 Не удалось определить магазин. Пожалуйста, выберите магазин из списка или попробуйте снова.", "duration": duration})
+            log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+            return response
+        index = int(index_str)
+        log_debug(user_uuid, lambda: f"Parsed index: {index}")
+        user_data = await get_user_data(user_id)
+        store_choices = user_data.get("store_choices", [])
+        log_debug(user_uuid, lambda: f"pick_store - stores: {user_data.get('stores', [])}, store_choices: {store_choices}, index: {index}")
+        if index < 0 or index >= len(store_choices):
+            response = reply("🏪 Не удалось определить магазин. Пожалуйста, выберите магазин из списка или попробуйте снова.", disable_web_page_preview=True)
+            duration = time.time() - start_time
+            log_technical(user_uuid, "bot_response", details={"text": "🏪 Не удалось определить магазин. Пожалуйста, выберите магазин из списка или попробуйте снова.", "duration": duration})
+            log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+            return response
+        chosen = store_choices[index]
+        if chosen.lower() in [s.lower().strip() for s in user_data.get("stores", [])]:
+            log_user_activity(user_uuid, "store_already_exists", {"store": chosen, "method": "callback_pick"})
+            response = reply(f"🔁 Магазин <b>{chosen}</b> уже есть в списке", disable_web_page_preview=True)
             duration = time.time() - start_time
-            log_technical(get_user_uuid(user_id), "bot_response", details={"text": response_text, "duration": duration})
-            log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-            return JSONResponse(response)
+            log_technical(user_uuid, "bot_response", details={"text": f"🔁 Магазин <b>{chosen}</b> уже есть в списке", "duration": duration})
+            log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+            return response
+        user_data["stores"] = user_data.get("stores", []) + [chosen]
+        await set_user_data(user_id, user_data)
+        user_data = await get_user_data(user_id)
+        log_user_activity(user_uuid, "store_added", {"store": chosen, "method": "callback_pick"})
+        log_debug(user_uuid, lambda: f"Added store '{chosen}', current stores: {user_data.get('stores', [])}")
+        log_debug(user_uuid, lambda: f"After adding store - stores: {user_data.get('stores', [])}, store_choices: {user_data.get('store_choices', [])}")
+        response_text = f"<b>Магазин добавлен:</b> {chosen}\n\n"
+        response_text += "<b>Текущий список:</b>\n"
+        for i, store in enumerate(user_data["stores"], 1):
+            response_text += f"{i}. {store}\n"
+        # Две кнопки — каждая на своей строке
+        # Для wrong_store передаём индекс исходного пользовательского ввода
+        user_data = await get_user_data(user_id)
+        store_choices = user_data.get("store_choices", [])
+        # Находим индекс исходного пользовательского ввода
+        original_input_index = len(store_choices) - 1 if store_choices else 0
+        log_debug(user_uuid, lambda: f"Added store '{chosen}', store_choices: {store_choices}, original_input_index: {original_input_index}")
+        keyboard = {"inline_keyboard": [
+            [{"text": "❌ Это не тот магазин", "callback_data": f"wrong_store::0::{index}"}],
+            [{"text": "💾 Сохранить запрос", "callback_data": "save_query"}]
+        ]}
+        response = edit_reply(message_id, response_text, keyboard, disable_web_page_preview=True)
+        duration = time.time() - start_time
+        log_technical(user_uuid, "bot_response", details={"text": response_text, "duration": duration})
+        log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+        return response
 
+    # clear_list
+    if callback_data == "clear_list":
+        log_user_activity(user_uuid, "callback_action", {"action": "clear_list"})
+        await set_user_data(user_id, {"stores": []})
+        response = reply("Список магазинов очищен", disable_web_page_preview=True)
         duration = time.time() - start_time
-        log_technical(get_user_uuid(user_id), "processing_time", details={"handler": "handle_callback", "duration": duration})
-        log_user_activity(get_user_uuid(user_id), "error", {"error": "unknown_callback", "callback_data": callback_data})
-        response = reply("Кнопка устарела или больше не работает. Пожалуйста, обновите меню или начните сначала.", disable_web_page_preview=True)
-        log_technical(get_user_uuid(user_id), "bot_response", details={"text": "Кнопка устарела или больше не работает. Пожалуйста, обновите меню или начните сначала.", "duration": duration})
-        log_technical(get_user_uuid(user_id), "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
-        return JSONResponse(response)
-        
-    except HTTPException as e:
+        log_technical(user_uuid, "bot_response", details={"text": "Список магазинов очищен", "duration": duration})
+        log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+        return response
+
+    # save_query
+    if callback_data == "save_query":
+        log_user_activity(user_uuid, "callback_action", {"action": "save_query_prompt"})
+        user_data = await get_user_data(user_id)
+        if not user_data.get("stores"):
+            response = reply("Список магазинов пуст, нечего сохранять.", disable_web_page_preview=True)
+            duration = time.time() - start_time
+            log_technical(user_uuid, "bot_response", details={"text": "Список магазинов пуст, нечего сохранять.", "duration": duration})
+            log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+            return response
+        await set_state(user_id, STATE_ENTERING_QUERY_NAME)
+        response = reply("Введите название запроса:", disable_web_page_preview=True)
         duration = time.time() - start_time
-        log_technical(None, "http_response", details={"status_code": e.status_code, "status": e.detail, "duration": duration})
-        raise
-    except Exception as e:
+        log_technical(user_uuid, "bot_response", details={"text": "Введите название запроса:", "duration": duration})
+        log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+        return response
+
+    # saved_query::<id>
+    if callback_data.startswith("saved_query::"):
+        query_id_str = callback_data.split("::")[1]
+        query = await saved_queries.get(user_uuid, int(query_id_str)) if query_id_str.isdigit() else None
+        if query is None:
+            log_user_activity(user_uuid, "error", {"error": "query_not_found", "requested_id": query_id_str})
+            response = reply("Не удалось найти выбранный запрос. Пожалуйста, выберите другой из списка.", disable_web_page_preview=True)
+            duration = time.time() - start_time
+            log_technical(user_uuid, "bot_response", details={"text": "Не удалось найти выбранный запрос. Пожалуйста, выберите другой из списка.", "duration": duration})
+            log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+            return response
+        log_user_activity(user_uuid, "saved_queries_action", {"action": "load_by_callback", "query_id": query["id"], "query_name": query["name"]})
+        # Сохраняем город, если он есть в запросе
+        city = query.get("city")
+        user_data = await get_user_data(user_id)
+        new_data = {
+            "stores": list(query["stores"]),
+            "current_query_id": query["id"]
+        }
+        if city:
+            new_data["city"] = city
+        else:
+            # если в query нет города, оставляем старый
+            if "city" in user_data:
+                new_data["city"] = user_data["city"]
+        await set_user_data(user_id, new_data)
+        await set_state(user_id, STATE_EDITING_SAVED_QUERY)
+        response_text = f"Загружен список <b>{query['name']}</b>:\n\n"
+        for i, store in enumerate(query["stores"], 1):
+            response_text += f"{i}. {store}\n"
+        # query_menu — обычная клавиатура, её нельзя поставить редактированием: список
+        # запросов теряет кнопки, а загруженный запрос приходит новым сообщением
+        response = strip_keyboard(reply(response_text, query_menu(), disable_web_page_preview=True), message_id)
         duration = time.time() - start_time
-        log_technical(None, "http_response", details={"status_code": 500, "status": "Internal Server Error", "error": str(e), "duration": duration})
-        raise 
\ No newline at end of file
+        log_technical(user_uuid, "bot_response", details={"text": response_text, "duration": duration})
+        log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+        return response
+
+    # load_query::<index> — кнопки до перехода на id запросов. Позиция в списке после удалений
+    # могла указывать на другой запрос, поэтому такие кнопки намеренно не выполняются:
+    # старый список теряет кнопки, пользователь открывает актуальный
+    if callback_data.startswith("load_query::"):
+        log_user_activity(user_uuid, "error", {"error": "stale_callback", "callback_data": callback_data})
+        response = strip_keyboard(reply("Кнопка устарела. Откройте «📜 Список запросов» заново.", disable_web_page_preview=True), message_id)
+        duration = time.time() - start_time
+        log_technical(user_uuid, "bot_response", details={"text": "Кнопка устарела. Откройте «📜 Список запросов» заново.", "duration": duration})
+        log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+        return response
+
+    duration = time.time() - start_time
+    log_technical(user_uuid, "processing_time", details={"handler": "handle_callback", "duration": duration})
+    log_user_activity(user_uuid, "error", {"error": "unknown_callback", "callback_data": callback_data})
+    response = reply("Кнопка устарела или больше не работает. Пожалуйста, обновите меню или начните сначала.", disable_web_page_preview=True)
+    log_technical(user_uuid, "bot_response", details={"text": "Кнопка устарела или больше не работает. Пожалуйста, обновите меню или начните сначала.", "duration": duration})
+    log_technical(user_uuid, "http_response", details={"status_code": 200, "status": "OK", "duration": duration})
+    return response
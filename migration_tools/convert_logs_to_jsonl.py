@@ -0,0 +1,68 @@
+"""
+Одноразовый перевод старых логов-массивов (logs/*.json) в JSON Lines.
+Записи из массива ставятся перед уже существующими строками .jsonl,
+исходный файл переименовывается в *.json.bak. Запускать при остановленном logic_api.
+Строки, дописанные в конец старого файла не в формате массива
+(например, "LOGGING ERROR: ..."), сохраняются, если это валидный JSON, иначе пропускаются.
+"""
+
+import json
+import os
+
+LEGACY_LOGS = {
+    "logs/technical.json": "logs/technical.jsonl",
+    "logs/errors.json": "logs/errors.jsonl",
+    "logs/users_activity.json": "logs/users_activity.jsonl",
+}
+
+
+def iter_legacy_entries(text):
+    """Разбирает массив и любые JSON-значения после него; возвращает (записи, пропущено строк)"""
+    decoder = json.JSONDecoder()
+    entries = []
+    skipped = 0
+    pos = 0
+    length = len(text)
+    while pos < length:
+        while pos < length and text[pos].isspace():
+            pos += 1
+        if pos >= length:
+            break
+        try:
+            value, pos = decoder.raw_decode(text, pos)
+        except json.JSONDecodeError:
+            # Пропускаем мусор до конца строки
+            newline = text.find("\n", pos)
+            pos = length if newline == -1 else newline + 1
+            skipped += 1
+            continue
+        if isinstance(value, list):
+            entries.extend(value)
+        else:
+            entries.append(value)
+    return entries, skipped
+
+
+def convert(src, dst):
+    if not os.path.exists(src):
+        print(f"Нет файла {src}, пропускаем")
+        return
+    with open(src, "r", encoding="utf-8") as f:
+        entries, skipped = iter_legacy_entries(f.read())
+
+    tmp = dst + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as out:
+        for entry in entries:
+            out.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        if os.path.exists(dst):
+            with open(dst, "r", encoding="utf-8") as existing:
+                for line in existing:
+                    out.write(line)
+    os.replace(tmp, dst)
+    os.replace(src, src + ".bak")
+    print(f"{src} -> {dst}: {len(entries)} записей, пропущено строк: {skipped}")
+
+
+if __name__ == "__main__":
+    for src, dst in LEGACY_LOGS.items():
+        convert(src, dst)
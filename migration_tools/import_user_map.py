@@ -1,21 +1,147 @@
+"""
+Потоковый импорт user_id в зашифрованный журнал mapping (user_map.records).
+Файл читается частями, ID сверяются с уже известными, новые дописываются
+в журнал пачками — весь mapping заново не шифруется и не перезаписывается.
+
+Поддерживаемые форматы:
+- .json  — объект {user_id: uuid} (как в user_map_decrypted.json) или массив ID / объектов с полем user_id;
+           большие файлы читаются потоково при установленном пакете ijson
+- .jsonl — по строке: ID, {"user_id": ...} или {user_id: uuid}
+- .csv   — первая колонка user_id (строка-заголовок пропускается), вторая колонка uuid необязательна
+
+UUID5 всегда считается заново нашим NAMESPACE. Записи, у которых в файле указан другой UUID,
+не импортируются: такой файл выгружен с другим NAMESPACE, и его UUID не совпадут с нашими логами.
+
+Пример:
+    python migration_tools/import_user_map.py other_bot_users.csv
+    python migration_tools/import_user_map.py user_map_decrypted.json --replace
+"""
+
+import argparse
+import csv
 import json
-from cryptography.fernet import Fernet
+import os
+import sys
+
+try:
+    import ijson
+except ImportError:  # без ijson .json загружается целиком
+    ijson = None
+
+try:
+    from migration_tools.user_id_map_crypto import store
+    from migration_tools.utils import get_user_uuid
+except ImportError:  # запуск как скрипта: python migration_tools/import_user_map.py
+    from user_id_map_crypto import store
+    from utils import get_user_uuid
 
-KEY_FILE = "user_map.key"
-ENC_FILE = "user_map.enc"
 DECRYPTED_FILE = "user_map_decrypted.json"
 
-with open(KEY_FILE, "rb") as f:
-    key = f.read()
-fernet = Fernet(key)
 
-with open(DECRYPTED_FILE, "r", encoding="utf-8") as f:
-    mapping = json.load(f)
+def _from_value(value):
+    """(user_id, uuid или None) из элемента массива / строки JSONL"""
+    if isinstance(value, dict):
+        if "user_id" in value:
+            return [(value["user_id"], value.get("uuid"))]
+        return list(value.items())
+    return [(value, None)]
+
+
+def _iter_json(f):
+    if ijson is not None:
+        prefix, event, _ = next(ijson.parse(f))
+        f.seek(0)
+        if event == "start_map":
+            yield from ijson.kvitems(f, "")
+        else:
+            for value in ijson.items(f, "item"):
+                yield from _from_value(value)
+        return
+    data = json.load(f)
+    if isinstance(data, dict):
+        yield from data.items()
+    else:
+        for value in data:
+            yield from _from_value(value)
+
+
+def _iter_jsonl(f):
+    for line in f:
+        if line.strip():
+            yield from _from_value(json.loads(line))
+
+
+def _iter_csv(f):
+    for i, row in enumerate(csv.reader(f)):
+        if not row or not row[0].strip():
+            continue
+        if i == 0 and not row[0].strip().lstrip("-").isdigit():
+            continue  # заголовок
+        yield row[0].strip(), (row[1].strip() or None) if len(row) > 1 else None
+
+
+def iter_records(path):
+    """Генератор пар (user_id, uuid или None) из файла экспорта"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".csv":
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            yield from _iter_csv(f)
+    elif ext == ".jsonl":
+        with open(path, "r", encoding="utf-8") as f:
+            yield from _iter_jsonl(f)
+    else:
+        with open(path, "rb") as f:
+            yield from _iter_json(f)
+
+
+def merge(path, chunk_size=5000, map_store=None):
+    """Дописывает в журнал новые ID из файла; возвращает статистику импорта"""
+    map_store = map_store or store
+    stats = {"read": 0, "added": 0, "uuid_mismatch": 0}
+    chunk = []
+    for user_id, uuid5 in iter_records(path):
+        user_id = str(user_id)
+        stats["read"] += 1
+        if uuid5 and uuid5 != get_user_uuid(user_id):
+            stats["uuid_mismatch"] += 1
+            continue
+        chunk.append(user_id)
+        if len(chunk) >= chunk_size:
+            stats["added"] += len(map_store.add_many(chunk))
+            chunk = []
+    if chunk:
+        stats["added"] += len(map_store.add_many(chunk))
+    return stats
+
+
+def replace(path, map_store=None):
+    """Старое поведение: mapping целиком заменяется содержимым файла"""
+    map_store = map_store or store
+    stats = {"read": 0, "added": 0, "uuid_mismatch": 0}
+    mapping = {}
+    for user_id, uuid5 in iter_records(path):
+        user_id = str(user_id)
+        stats["read"] += 1
+        if uuid5 and uuid5 != get_user_uuid(user_id):
+            stats["uuid_mismatch"] += 1
+            continue
+        mapping[user_id] = get_user_uuid(user_id)
+    map_store.replace_all(mapping)
+    stats["added"] = len(mapping)
+    return stats
 
-data = json.dumps(mapping, ensure_ascii=False).encode("utf-8")
-encrypted = fernet.encrypt(data)
 
-with open(ENC_FILE, "wb") as f:
-    f.write(encrypted)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import user IDs into the encrypted mapping")
+    parser.add_argument("file", nargs="?", default=DECRYPTED_FILE, help="JSON, JSONL or CSV export")
+    parser.add_argument("--chunk-size", type=int, default=5000, help="IDs per append to the records file")
+    parser.add_argument("--replace", action="store_true", help="Replace the whole mapping instead of merging")
+    args = parser.parse_args()
 
-print("user_map.enc обновлён!") 
\ No newline at end of file
+    if not os.path.exists(args.file):
+        print(f"Нет файла {args.file}")
+        sys.exit(1)
+    stats = replace(args.file) if args.replace else merge(args.file, args.chunk_size)
+    print(f"Прочитано: {stats['read']}, добавлено новых: {stats['added']}")
+    if stats["uuid_mismatch"]:
+        print(f"UUID из файла не совпал с нашим NAMESPACE для {stats['uuid_mismatch']} записей — они пропущены")
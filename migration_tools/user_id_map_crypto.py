@@ -1,9 +1,20 @@
-import uuid
+import asyncio
 import json
 import os
+import threading
 from cryptography.fernet import Fernet
 from dotenv import load_dotenv
 
+try:
+    import fcntl
+except ImportError:  # Windows: блокировка только внутри процесса
+    fcntl = None
+
+try:
+    from migration_tools.utils import NAMESPACE, get_user_uuid
+except ImportError:  # запуск как скрипта: python migration_tools/user_id_map_crypto.py
+    from utils import NAMESPACE, get_user_uuid
+
 # Подгружаем переменные окружения для поддержки тестовой среды
 BOT_ENV = os.getenv("BOT_ENV", "prod")
 if BOT_ENV == "test":
@@ -11,10 +22,15 @@ if BOT_ENV == "test":
 else:
     load_dotenv(".env")
 
-NAMESPACE_UUID = uuid.UUID("d2a8b4b9-d4a1-4761-8568-2b34923e493a")
+NAMESPACE_UUID = NAMESPACE
 KEY_FILE = os.getenv("USER_MAP_KEY_FILE", "user_map.key")
+# Старый формат: весь mapping одним зашифрованным блобом. Переносится в RECORDS_FILE при первой загрузке.
 ENC_FILE = os.getenv("USER_MAP_FILE", "user_map.enc")
+# Новый формат: append-only журнал, одна строка — одна запись, зашифрованная Fernet отдельно
+RECORDS_FILE = os.getenv("USER_MAP_RECORDS_FILE", "user_map.records")
 USER_MAP_SECRET = os.getenv("USER_MAP_SECRET")
+# Компакция, когда дублей в журнале больше, чем уникальных записей + порог
+COMPACT_MIN_DUPLICATES = int(os.getenv("USER_MAP_COMPACT_MIN_DUPLICATES", "1000"))
 
 
 def get_or_create_key():
@@ -30,56 +46,214 @@ def get_or_create_key():
     return key
 
 
-def load_mapping():
-    key = get_or_create_key()
-    fernet = Fernet(key)
-    if not os.path.exists(ENC_FILE):
-        return {}
-    with open(ENC_FILE, "rb") as f:
-        encrypted = f.read()
+class _FileLock:
+    """Межпроцессная блокировка журнала (flock) поверх блокировки потоков"""
+
+    def __init__(self, path):
+        self.path = path + ".lock"
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        self._depth += 1
+        if self._depth == 1 and fcntl is not None:
+            self._fd = open(self.path, "a")
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0 and self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            self._fd.close()
+            self._fd = None
+        self._thread_lock.release()
+
+
+class UserMapStore:
+    """
+    Зашифрованный mapping user_id -> UUID5 в виде журнала записей.
+    Новая запись — одна дописанная строка, без перешифровки всего файла.
+    Известные ID держатся в памяти; записи других процессов подчитываются
+    с последнего прочитанного смещения. Дубли убираются компакцией.
+    """
+
+    def __init__(self, path=RECORDS_FILE, legacy_path=ENC_FILE):
+        self.path = path
+        self.legacy_path = legacy_path
+        self._fernet = None
+        self._lock = _FileLock(path)
+        self._mapping = None
+        self._reverse = {}  # UUID5 -> user_id, для поиска по логам
+        self._offset = 0
+        self._lines = 0
+        self._inode = None
+
+    @property
+    def fernet(self):
+        if self._fernet is None:
+            self._fernet = Fernet(get_or_create_key())
+        return self._fernet
+
+    def _encrypt(self, user_id, uuid5):
+        record = json.dumps({"user_id": user_id, "uuid": uuid5}, ensure_ascii=False).encode("utf-8")
+        return self.fernet.encrypt(record) + b"\n"
+
+    def _refresh(self):
+        """Дочитывает записи, добавленные после последнего чтения (в т.ч. другими процессами)"""
+        if not os.path.exists(self.path):
+            return
+        inode = os.stat(self.path).st_ino
+        if inode != self._inode:
+            # Файл заменён компакцией (возможно, в другом процессе) — читаем заново
+            self._mapping, self._reverse, self._offset, self._lines = {}, {}, 0, 0
+            self._inode = inode
+        with open(self.path, "rb") as f:
+            f.seek(self._offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1  # неполную последнюю строку оставляем на потом
+        for line in data[:end].splitlines():
+            if not line:
+                continue
+            record = json.loads(self.fernet.decrypt(line).decode("utf-8"))
+            self._put(record["user_id"], record["uuid"])
+            self._lines += 1
+        self._offset += end
+
+    def _put(self, user_id, uuid5):
+        self._mapping[user_id] = uuid5
+        self._reverse[uuid5] = user_id
+
+    def _load_legacy(self):
+        with open(self.legacy_path, "rb") as f:
+            encrypted = f.read()
         if not encrypted:
             return {}
-        decrypted = fernet.decrypt(encrypted)
-        return json.loads(decrypted.decode("utf-8"))
+        return json.loads(self.fernet.decrypt(encrypted).decode("utf-8"))
 
+    def _ensure_loaded(self):
+        with self._lock:
+            if self._mapping is None:
+                self._mapping, self._reverse = {}, {}
+                self._refresh()
+                if os.path.exists(self.legacy_path):
+                    # Переносим старый блоб в журнал один раз
+                    legacy = self._load_legacy()
+                    for user_id, uuid5 in legacy.items():
+                        if user_id not in self._mapping:
+                            self._put(user_id, uuid5)
+                    self._write_compacted()
+                    os.replace(self.legacy_path, self.legacy_path + ".migrated")
+            else:
+                self._refresh()
 
-def save_mapping(mapping):
-    key = get_or_create_key()
-    fernet = Fernet(key)
-    data = json.dumps(mapping, ensure_ascii=False).encode("utf-8")
-    encrypted = fernet.encrypt(data)
-    with open(ENC_FILE, "wb") as f:
-        f.write(encrypted)
+    def _write_compacted(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            for user_id, uuid5 in self._mapping.items():
+                f.write(self._encrypt(user_id, uuid5))
+        os.replace(tmp, self.path)
+        stat = os.stat(self.path)
+        self._offset = stat.st_size
+        self._inode = stat.st_ino
+        self._lines = len(self._mapping)
+
+    def compact(self):
+        """Переписывает журнал без дублей"""
+        with self._lock:
+            self._ensure_loaded()
+            self._write_compacted()
+
+    def load(self):
+        self._ensure_loaded()
+
+    def is_known(self, user_id):
+        """Проверка по памяти, без чтения файла (до загрузки журнала — всегда False)"""
+        mapping = self._mapping
+        return mapping is not None and str(user_id) in mapping
+
+    def add_many(self, user_ids):
+        """Добавляет новые ID одной записью в файл; возвращает список добавленных"""
+        with self._lock:
+            self._ensure_loaded()
+            added = []
+            chunk = []
+            for user_id in user_ids:
+                user_id = str(user_id)
+                if user_id in self._mapping:
+                    continue
+                uuid5 = get_user_uuid(user_id)
+                self._put(user_id, uuid5)
+                chunk.append(self._encrypt(user_id, uuid5))
+                added.append(user_id)
+            if chunk:
+                with open(self.path, "ab") as f:
+                    f.write(b"".join(chunk))
+                self._offset += sum(len(line) for line in chunk)
+                self._lines += len(chunk)
+                if self._lines - len(self._mapping) > len(self._mapping) + COMPACT_MIN_DUPLICATES:
+                    self._write_compacted()
+            return added
+
+    def add(self, user_id):
+        """Возвращает (uuid5, added)"""
+        added = self.add_many([user_id])
+        return get_user_uuid(user_id), bool(added)
+
+    def get_uuid(self, user_id):
+        self._ensure_loaded()
+        return self._mapping.get(str(user_id))
+
+    def get_user_id(self, uuid5):
+        self._ensure_loaded()
+        return self._reverse.get(uuid5)
+
+    def get_user_ids(self, uuids):
+        """Пакетный поиск: {uuid5: user_id или None} за одну загрузку журнала"""
+        self._ensure_loaded()
+        return {uuid5: self._reverse.get(uuid5) for uuid5 in uuids}
 
+    def mapping(self):
+        self._ensure_loaded()
+        return dict(self._mapping)
 
-def get_user_uuid(user_id):
-    return str(uuid.uuid5(NAMESPACE_UUID, str(user_id)))
+    def replace_all(self, mapping):
+        with self._lock:
+            self._mapping, self._reverse = {}, {}
+            for user_id, uuid5 in mapping.items():
+                self._put(str(user_id), uuid5)
+            self._write_compacted()
+
+
+store = UserMapStore()
+
+
+def load_mapping():
+    return store.mapping()
+
+
+def save_mapping(mapping):
+    store.replace_all(mapping)
 
 
 def add_mapping(user_id):
-    mapping = load_mapping()
-    user_id_str = str(user_id)
-    uuid5 = get_user_uuid(user_id)
-    if user_id_str not in mapping:
-        mapping[user_id_str] = uuid5
-        save_mapping(mapping)
-        print(f"Добавлен: {user_id_str} -> {uuid5}")
-    else:
-        print(f"Уже есть: {user_id_str} -> {uuid5}")
+    """Синхронное добавление (CLI, скрипты). В боте используется MappingRegistrar"""
+    uuid5, _ = store.add(user_id)
     return uuid5
 
 
 def get_uuid(user_id):
-    mapping = load_mapping()
-    return mapping.get(str(user_id))
+    return store.get_uuid(user_id)
 
 
 def get_user_id(uuid5):
-    mapping = load_mapping()
-    for user_id, uuid_val in mapping.items():
-        if uuid_val == uuid5:
-            return user_id
-    return None
+    return store.get_user_id(uuid5)
+
+
+def get_user_ids(uuids):
+    return store.get_user_ids(uuids)
 
 
 def export_mapping(filename="user_map_decrypted.json"):
@@ -89,20 +263,100 @@ def export_mapping(filename="user_map_decrypted.json"):
     print(f"Экспортировано в {filename}")
 
 
+class MappingRegistrar:
+    """
+    Фоновая регистрация пользователей в mapping.
+    register() не делает ввода-вывода: известные ID отсекаются по памяти, новые
+    кладутся в очередь, а фоновая задача пачками шифрует и дописывает их в журнал
+    в отдельном потоке.
+    """
+
+    def __init__(self, map_store=None, batch_size=500, flush_interval=1.0):
+        self.store = map_store or store
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = None
+        self._pending = set()
+        self._task = None
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        # Журнал читается один раз при старте, дальше проверки идут по памяти
+        await asyncio.to_thread(self.store.load)
+        self._task = asyncio.create_task(self._run())
+
+    def register(self, user_id):
+        user_id = str(user_id)
+        if self._queue is None or user_id in self._pending or self.store.is_known(user_id):
+            return
+        self._pending.add(user_id)
+        self._queue.put_nowait(user_id)
+
+    async def _flush(self, batch):
+        try:
+            await asyncio.to_thread(self.store.add_many, batch)
+        finally:
+            self._pending.difference_update(batch)
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            first = await self._queue.get()
+            if first is None:
+                break
+            batch.append(first)
+            deadline = asyncio.get_running_loop().time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    user_id = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if user_id is None:
+                    stopping = True
+                    break
+                batch.append(user_id)
+            await self._flush(batch)
+
+    async def stop(self):
+        """Записывает всё, что осталось в очереди, и останавливает фоновую задачу"""
+        if self._task is None:
+            return
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(description="User ID <-> UUID5 mapping tool (encrypted)")
     parser.add_argument("--add", type=str, help="Add user_id to mapping")
     parser.add_argument("--get-uuid", type=str, help="Get UUID5 for user_id")
     parser.add_argument("--get-user-id", type=str, help="Get user_id for UUID5")
+    parser.add_argument("--get-user-ids", type=str, help="Resolve UUID5s from a file (one per line, '-' for stdin)")
     parser.add_argument("--export", action="store_true", help="Export mapping to user_map_decrypted.json")
+    parser.add_argument("--compact", action="store_true", help="Rewrite the records file without duplicates")
     args = parser.parse_args()
 
     if args.add:
-        add_mapping(args.add)
+        uuid5, added = store.add(args.add)
+        print(f"Добавлен: {args.add} -> {uuid5}" if added else f"Уже есть: {args.add} -> {uuid5}")
     if args.get_uuid:
         print(get_uuid(args.get_uuid))
     if args.get_user_id:
         print(get_user_id(args.get_user_id))
+    if args.get_user_ids:
+        import sys
+        source = sys.stdin if args.get_user_ids == "-" else open(args.get_user_ids, "r", encoding="utf-8")
+        with source:
+            uuids = [line.strip() for line in source if line.strip()]
+        for uuid5, user_id in get_user_ids(uuids).items():
+            print(f"{uuid5}\t{user_id if user_id is not None else ''}")
     if args.export:
-        export_mapping() 
\ No newline at end of file
+        export_mapping()
+    if args.compact:
+        store.compact()
+        print(f"Журнал {RECORDS_FILE} перезаписан без дублей")
@@ -1,11 +1,15 @@
 import uuid
+from functools import lru_cache
 
 NAMESPACE = uuid.UUID('d2a8b4b9-d4a1-4761-8568-2b34923e493a')
 
+@lru_cache(maxsize=100000)
 def get_user_uuid(telegram_id):
     """
     Генерирует детерминированный UUID5 для пользователя по Telegram ID.
+    Результат кэшируется для скриптов и регистратора mapping; logic_api считает UUID
+    один раз на запрос и передаёт его в обработчики.
     telegram_id: int или str
     return: str (UUID5)
     """
-    return str(uuid.uuid5(NAMESPACE, str(telegram_id))) 
\ No newline at end of file
+    return str(uuid.uuid5(NAMESPACE, str(telegram_id)))
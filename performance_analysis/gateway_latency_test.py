@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Задержка, которую bot_gateway добавляет на обращение к logic_api:
+новая aiohttp.ClientSession на каждый апдейт (как было) против одной общей
+сессии с пулом соединений (как сейчас в bot_gateway.create_http_session).
+
+Пример (logic_api запущен на localhost:8000):
+    python performance_analysis/gateway_latency_test.py --requests 500 --concurrency 10
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from performance_test import HEADERS, LOGIC_API_URL, TEST_PAYLOADS
+
+
+def _payload(i):
+    payload = TEST_PAYLOADS[i % len(TEST_PAYLOADS)].copy()
+    payload["user_id"] = f"gateway_test_{i % 50}"
+    return payload
+
+
+async def session_per_request(i):
+    async with aiohttp.ClientSession() as session:
+        async with session.post(LOGIC_API_URL, json=_payload(i), headers=HEADERS) as resp:
+            await resp.json()
+
+
+def shared_session_request(session):
+    async def request(i):
+        async with session.post(LOGIC_API_URL, json=_payload(i)) as resp:
+            await resp.json()
+    return request
+
+
+async def measure(request, num_requests, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    durations = []
+
+    async def one(i):
+        async with semaphore:
+            start_time = time.perf_counter()
+            await request(i)
+            durations.append(time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(num_requests)])
+    total_time = time.perf_counter() - start_time
+    durations.sort()
+    return {
+        "rps": num_requests / total_time,
+        "avg_ms": statistics.mean(durations) * 1000,
+        "p50_ms": durations[len(durations) // 2] * 1000,
+        "p95_ms": durations[int(len(durations) * 0.95) - 1] * 1000,
+    }
+
+
+async def main(num_requests, concurrency):
+    os.environ.setdefault("BOT_TOKEN", "0:benchmark")  # bot_gateway требует токен при импорте
+    os.environ.setdefault("API_TOKEN", HEADERS["Authorization"].split(" ", 1)[1])
+    from bot_gateway import create_http_session
+
+    # Прогрев logic_api, чтобы первый вариант не платил за холодный старт
+    await measure(session_per_request, 20, 1)
+    before = await measure(session_per_request, num_requests, concurrency)
+    async with create_http_session() as session:
+        after = await measure(shared_session_request(session), num_requests, concurrency)
+
+    print(f"Запросов: {num_requests}, конкурентность: {concurrency}")
+    for name, result in (("Сессия на запрос", before), ("Общая сессия", after)):
+        print(f"{name:18} RPS: {result['rps']:8.1f} | среднее: {result['avg_ms']:6.2f} мс | "
+              f"p50: {result['p50_ms']:6.2f} мс | p95: {result['p95_ms']:6.2f} мс")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Задержка bot_gateway -> logic_api")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=10)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.concurrency))
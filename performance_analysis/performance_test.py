@@ -10,6 +10,8 @@ import time
 import statistics
 from typing import List, Dict
 import json
+import os
+import sys
 
 # Конфигурация теста
 LOGIC_API_URL = "http://localhost:8000/handle_update"
@@ -69,6 +71,105 @@ async def make_request(session: aiohttp.ClientSession, payload: Dict) -> Dict:
             "error": str(e)
         }
 
+class InProcessSession:
+    """
+    Вызывает FastAPI-приложение logic_api напрямую через ASGI, без HTTP и сети.
+    Вместе с SESSION_BACKEND=memory измеряет чистую стоимость логики без Redis.
+    Используется как async with: приложение проходит lifespan (startup/shutdown),
+    как под uvicorn, поэтому хранилища инициализированы так же, как в режиме HTTP.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._lifespan = None
+        self._lifespan_in = None
+        self._lifespan_out = None
+
+    async def _lifespan_event(self, event: str):
+        await self._lifespan_in.put({"type": f"lifespan.{event}"})
+        message = await self._lifespan_out.get()
+        if message["type"] != f"lifespan.{event}.complete":
+            raise RuntimeError(f"logic_api lifespan {event} failed: {message.get('message')}")
+
+    async def __aenter__(self):
+        self._lifespan_in = asyncio.Queue()
+        self._lifespan_out = asyncio.Queue()
+        self._lifespan = asyncio.create_task(self.app(
+            {"type": "lifespan", "asgi": {"version": "3.0"}},
+            self._lifespan_in.get,
+            self._lifespan_out.put,
+        ))
+        await self._lifespan_event("startup")
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._lifespan_event("shutdown")
+        await self._lifespan
+
+    async def post(self, path: str, payload: Dict) -> Dict:
+        body = json.dumps(payload).encode("utf-8")
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "POST",
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "query_string": b"",
+            "root_path": "",
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"authorization", HEADERS["Authorization"].encode()),
+            ],
+            "client": ("127.0.0.1", 0),
+            "server": ("127.0.0.1", 8000),
+        }
+        messages = [{"type": "http.request", "body": body, "more_body": False}]
+        result = {"status": None, "body": b""}
+
+        async def receive():
+            return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                result["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                result["body"] += message.get("body", b"")
+
+        await self.app(scope, receive, send)
+        return result
+
+async def make_inprocess_request(session: InProcessSession, payload: Dict) -> Dict:
+    """Выполняет один запрос к logic_api внутри процесса"""
+    start_time = time.time()
+    try:
+        result = await session.post("/handle_update", payload)
+        duration = time.time() - start_time
+        return {
+            "success": result["status"] == 200,
+            "duration": duration,
+            "status_code": result["status"],
+            "response_size": len(result["body"])
+        }
+    except Exception as e:
+        duration = time.time() - start_time
+        return {
+            "success": False,
+            "duration": duration,
+            "error": str(e)
+        }
+
+def create_inprocess_session() -> InProcessSession:
+    """Импортирует logic_api с in-memory сессиями (по умолчанию) и тестовым токеном"""
+    os.environ.setdefault("SESSION_BACKEND", "memory")
+    os.environ["API_TOKEN"] = API_TOKEN
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import logic_api
+    return InProcessSession(logic_api.app)
+
+IN_PROCESS_SESSION = None
+
 async def concurrent_test(num_requests: int, concurrency: int) -> Dict:
     """Тест с заданным количеством запросов и уровнем конкурентности"""
     print(f"Запуск теста: {num_requests} запросов, конкурентность: {concurrency}")
@@ -79,7 +180,10 @@ async def concurrent_test(num_requests: int, concurrency: int) -> Dict:
         for i in range(num_requests):
             payload = TEST_PAYLOADS[i % len(TEST_PAYLOADS)].copy()
             payload["user_id"] = f"test_user_{i}"
-            tasks.append(make_request(session, payload))
+            if IN_PROCESS_SESSION is not None:
+                tasks.append(make_inprocess_request(IN_PROCESS_SESSION, payload))
+            else:
+                tasks.append(make_request(session, payload))
         
         # Выполняем запросы с ограничением конкурентности
         start_time = time.time()
@@ -178,6 +282,15 @@ async def load_test():
 async def health_check():
     """Проверка доступности API"""
     print("Проверка доступности API...")
+    if IN_PROCESS_SESSION is not None:
+        payload = TEST_PAYLOADS[0].copy()
+        payload["user_id"] = "health_check"
+        result = await make_inprocess_request(IN_PROCESS_SESSION, payload)
+        if result["success"]:
+            print("✅ logic_api загружен в процесс")
+            return True
+        print(f"❌ logic_api вернул ошибку: {result.get('error', result.get('status_code'))}")
+        return False
     async with aiohttp.ClientSession() as session:
         try:
             payload = TEST_PAYLOADS[0].copy()
@@ -194,7 +307,15 @@ async def health_check():
             return False
 
 if __name__ == "__main__":
-    async def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Нагрузочный тест logic_api")
+    parser.add_argument("--in-process", action="store_true",
+                        help="Вызывать logic_api внутри процесса (без HTTP); сессии по умолчанию в памяти")
+    args = parser.parse_args()
+    if args.in_process:
+        IN_PROCESS_SESSION = create_inprocess_session()
+
+    async def run_tests():
         # Проверяем доступность API
         if not await health_check():
             print("API недоступен. Убедитесь, что сервер запущен на localhost:8000")
@@ -202,5 +323,13 @@ if __name__ == "__main__":
         
         print()
         await load_test()
+
+    async def main():
+        if IN_PROCESS_SESSION is None:
+            await run_tests()
+            return
+        # startup/shutdown logic_api — как при запуске под uvicorn
+        async with IN_PROCESS_SESSION:
+            await run_tests()
     
     asyncio.run(main()) 
\ No newline at end of file
@@ -0,0 +1,57 @@
+"""
+Пул соединений Redis с таймаутами и политикой переподключения.
+Все параметры берутся из config.py (переменные окружения REDIS_*).
+"""
+
+import redis.asyncio as redis
+from redis.asyncio.retry import Retry
+from redis.backoff import ExponentialBackoff
+from redis.exceptions import ConnectionError, TimeoutError
+from config import (
+    REDIS_URL,
+    REDIS_MAX_CONNECTIONS,
+    REDIS_POOL_TIMEOUT,
+    REDIS_SOCKET_TIMEOUT,
+    REDIS_CONNECT_TIMEOUT,
+    REDIS_HEALTH_CHECK_INTERVAL,
+    REDIS_RETRY_ATTEMPTS,
+    REDIS_RETRY_BACKOFF_BASE,
+    REDIS_RETRY_BACKOFF_CAP,
+)
+
+
+def create_redis_client():
+    """Создаёт клиент Redis поверх настроенного пула соединений"""
+    retry = Retry(
+        ExponentialBackoff(cap=REDIS_RETRY_BACKOFF_CAP, base=REDIS_RETRY_BACKOFF_BASE),
+        REDIS_RETRY_ATTEMPTS,
+    )
+    pool_kwargs = {
+        "max_connections": REDIS_MAX_CONNECTIONS,
+        "socket_timeout": REDIS_SOCKET_TIMEOUT,
+        "socket_connect_timeout": REDIS_CONNECT_TIMEOUT,
+        "health_check_interval": REDIS_HEALTH_CHECK_INTERVAL,
+        "retry": retry,
+        "retry_on_error": [ConnectionError, TimeoutError],
+    }
+    if REDIS_POOL_TIMEOUT > 0:
+        # Ждём освобождения соединения вместо мгновенной ошибки "Too many connections"
+        pool = redis.BlockingConnectionPool.from_url(REDIS_URL, timeout=REDIS_POOL_TIMEOUT, **pool_kwargs)
+    else:
+        pool = redis.ConnectionPool.from_url(REDIS_URL, **pool_kwargs)
+    return redis.Redis(connection_pool=pool)
+
+
+def pool_stats(client):
+    """Заполненность пула соединений для /metrics"""
+    pool = client.connection_pool
+    in_use = len(getattr(pool, "_in_use_connections", ()))
+    available = len(getattr(pool, "_available_connections", ()))
+    max_connections = pool.max_connections
+    return {
+        "max_connections": max_connections,
+        "in_use": in_use,
+        "available": available,
+        "created": in_use + available,
+        "utilization": round(in_use / max_connections, 3) if max_connections else None,
+    }
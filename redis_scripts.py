@@ -0,0 +1,170 @@
+"""
+Lua-скрипты для атомарных изменений сессии пользователя в Redis.
+Каждый скрипт выполняет чтение-изменение-запись user_data за один round trip
+и возвращает новый список магазинов.
+"""
+
+import json
+from redis.exceptions import NoScriptError
+
+# KEYS[1] = user_data:<id>, ARGV[1] = название магазина, ARGV[2] = оно же в нижнем регистре
+# Возвращает {1|0, stores_json}: 1 — магазин добавлен, 0 — уже был в списке.
+# string.lower в Lua понимает только ASCII, поэтому регистр приводит Python (str.lower),
+# а рядом со stores хранится store_keys — те же названия в нижнем регистре.
+# Для сессий, записанных до появления store_keys, остаётся string.lower.
+APPEND_STORE_LUA = """
+local raw = redis.call('GET', KEYS[1])
+local data
+if raw then
+    data = cjson.decode(raw)
+else
+    data = {city = cjson.null}
+end
+local stores = data['stores']
+if type(stores) ~= 'table' then
+    stores = {}
+end
+local old_keys = data['store_keys']
+if type(old_keys) ~= 'table' then
+    old_keys = {}
+end
+local keys = {}
+for i, s in ipairs(stores) do
+    local key = old_keys[i]
+    if type(key) ~= 'string' then
+        key = string.lower(s)
+    end
+    if key == ARGV[2] then
+        return {0, cjson.encode(stores)}
+    end
+    keys[i] = key
+end
+table.insert(stores, ARGV[1])
+table.insert(keys, ARGV[2])
+data['stores'] = stores
+data['store_keys'] = keys
+redis.call('SET', KEYS[1], cjson.encode(data))
+return {1, cjson.encode(stores)}
+"""
+
+# KEYS[1] = user_data:<id>, ARGV[1] = индекс с нуля (отрицательный — с конца)
+# Возвращает {1, removed, stores_json} или {0, stores_json}, если индекс вне списка.
+POP_STORE_LUA = """
+local raw = redis.call('GET', KEYS[1])
+if not raw then
+    return {0, '[]'}
+end
+local data = cjson.decode(raw)
+local stores = data['stores']
+if type(stores) ~= 'table' then
+    return {0, '[]'}
+end
+local n = #stores
+local idx = tonumber(ARGV[1])
+if idx < 0 then
+    idx = n + idx
+end
+if idx < 0 or idx >= n then
+    return {0, cjson.encode(stores)}
+end
+local removed = table.remove(stores, idx + 1)
+data['stores'] = stores
+local keys = data['store_keys']
+if type(keys) == 'table' and #keys == n then
+    table.remove(keys, idx + 1)
+    data['store_keys'] = keys
+else
+    data['store_keys'] = nil
+end
+redis.call('SET', KEYS[1], cjson.encode(data))
+return {1, removed, cjson.encode(stores)}
+"""
+
+# KEYS[1] = user_data:<id>
+# Очищает список магазинов и сбрасывает current_query_id, город сохраняется.
+RESET_SEARCH_LUA = """
+local raw = redis.call('GET', KEYS[1])
+local data
+if raw then
+    data = cjson.decode(raw)
+else
+    data = {city = cjson.null}
+end
+data['stores'] = {}
+data['store_keys'] = {}
+data['current_query_id'] = cjson.null
+data['current_query_index'] = nil  -- поле старых сессий
+redis.call('SET', KEYS[1], cjson.encode(data))
+return '[]'
+"""
+
+SCRIPTS = {
+    "append_store": APPEND_STORE_LUA,
+    "pop_store": POP_STORE_LUA,
+    "reset_search": RESET_SEARCH_LUA,
+}
+
+# cjson кодирует пустую Lua-таблицу как {}, а не [] — приводим обратно к списку
+LIST_FIELDS = ("stores", "store_choices")
+
+
+def _decode(value):
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+    return value
+
+
+def decode_list(raw):
+    value = json.loads(_decode(raw))
+    return value if isinstance(value, list) else []
+
+
+def normalize_user_data(data):
+    """Исправляет списки, которые Lua-скрипты могли сохранить как {}, и убирает служебные поля"""
+    for field in LIST_FIELDS:
+        if field in data and not isinstance(data[field], list):
+            data[field] = []
+    data.pop("store_keys", None)
+    return data
+
+
+def with_store_keys(data):
+    """Копия user_data с ключами магазинов для сравнения без учёта регистра в Lua"""
+    data = dict(data)
+    data["store_keys"] = [s.lower() for s in data.get("stores") or []]
+    return data
+
+
+class SessionScripts:
+    """Регистрирует скрипты через SCRIPT LOAD и вызывает их по EVALSHA"""
+
+    def __init__(self, client):
+        self.client = client
+        self._shas = {}
+
+    async def load(self):
+        for name, source in SCRIPTS.items():
+            self._shas[name] = await self.client.script_load(source)
+
+    async def _call(self, name, key, *args):
+        if name not in self._shas:
+            await self.load()
+        try:
+            return await self.client.evalsha(self._shas[name], 1, key, *args)
+        except NoScriptError:
+            # Кэш скриптов сбрасывается при рестарте Redis или SCRIPT FLUSH
+            await self.load()
+            return await self.client.evalsha(self._shas[name], 1, key, *args)
+
+    async def append_store(self, key, store):
+        added, stores = await self._call("append_store", key, store, store.lower())
+        return bool(added), decode_list(stores)
+
+    async def pop_store(self, key, index):
+        result = await self._call("pop_store", key, index)
+        if not result[0]:
+            return None, decode_list(result[1])
+        return _decode(result[1]), decode_list(result[2])
+
+    async def reset_search(self, key):
+        return decode_list(await self._call("reset_search", key))
@@ -0,0 +1,61 @@
+"""
+Трассировка обращений к хранилищу сессий.
+Запись уровня DEBUG, с сэмплированием и обрезкой payload. Форматирование и запись
+в файл выполняет отдельный поток (QueueHandler + QueueListener), поэтому event loop
+не блокируется на диске. При переполнении очереди записи отбрасываются.
+"""
+
+import atexit
+import logging
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+from config import REDIS_TRACE_LEVEL, REDIS_TRACE_SAMPLE_RATE, REDIS_TRACE_MAX_PAYLOAD, REDIS_TRACE_FILE
+
+QUEUE_SIZE = 10000
+
+trace_logger = logging.getLogger("myapp.redis")
+_listener = None
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler, который не блокирует и не шумит при полной очереди"""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+def setup_redis_trace():
+    global _listener
+    if _listener is not None:
+        return
+    trace_logger.setLevel(REDIS_TRACE_LEVEL.upper())
+    trace_logger.propagate = False
+    if not trace_logger.isEnabledFor(logging.DEBUG):
+        return
+    file_handler = logging.FileHandler(REDIS_TRACE_FILE, encoding="utf-8")
+    file_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+    log_queue = queue.Queue(maxsize=QUEUE_SIZE)
+    trace_logger.addHandler(DroppingQueueHandler(log_queue))
+    _listener = QueueListener(log_queue, file_handler)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+def _truncate(payload):
+    text = str(payload)
+    if len(text) > REDIS_TRACE_MAX_PAYLOAD:
+        return text[:REDIS_TRACE_MAX_PAYLOAD] + f"...(+{len(text) - REDIS_TRACE_MAX_PAYLOAD})"
+    return text
+
+
+def trace(op, key_prefix, user_id, payload=None):
+    """Записывает операцию вида "GET user_fsm:<id> -> payload" (с вероятностью SAMPLE_RATE)"""
+    if not trace_logger.isEnabledFor(logging.DEBUG):
+        return
+    if REDIS_TRACE_SAMPLE_RATE < 1 and random.random() >= REDIS_TRACE_SAMPLE_RATE:
+        return
+    trace_logger.debug("%s %s:%s -> %s", op, key_prefix, user_id, _truncate(payload))
@@ -0,0 +1,324 @@
+"""
+Хранилище сохранённых запросов пользователей в SQLite.
+Одна строка — один запрос, ключ (user_id, id): чтение списка одного пользователя
+не трогает чужие данные, изменения идут отдельными транзакциями по строкам.
+Старый saved_queries.json переносится в базу при первом подключении.
+Каждая запись увеличивает версию пользователя (user_versions) в той же транзакции.
+SavedQueryCache держит списки в памяти воркера и сверяет их с этой версией не чаще
+раза в SAVED_QUERIES_CACHE_TTL секунд: навигация по меню запросов обходится без базы,
+а записи других воркеров видны с задержкой не больше TTL (свои — сразу).
+ВНИМАНИЕ: user_id — UUID пользователя (а не Telegram ID).
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from config import SAVED_QUERIES_CACHE_SIZE, SAVED_QUERIES_CACHE_TTL, SAVED_QUERIES_DB, SAVED_QUERIES_FILE
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS saved_queries (
+    user_id TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    city TEXT,
+    stores TEXT NOT NULL,
+    snapshot TEXT,
+    PRIMARY KEY (user_id, id)
+);
+CREATE INDEX IF NOT EXISTS saved_queries_position ON saved_queries (user_id, position);
+CREATE TABLE IF NOT EXISTS user_versions (
+    user_id TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+"""
+
+_FIELDS = {"name", "city", "stores", "snapshot"}
+_JSON_FIELDS = {"stores", "snapshot"}
+_COLUMNS = "id, name, city, stores, snapshot"
+
+
+def _row_to_query(row):
+    query_id, name, city, stores, snapshot = row
+    return {
+        "id": query_id,
+        "name": name,
+        "stores": json.loads(stores),
+        "city": city,
+        # Снимок результата поиска: {"catalog_version", "city", "stores", "resolved", "text", "malls_found"}
+        "snapshot": json.loads(snapshot) if snapshot else None,
+    }
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT/ROLLBACK: блокировка на запись берётся сразу, без гонки с другими воркерами"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+
+
+class SavedQueryRepository:
+    def __init__(self, db_path=SAVED_QUERIES_DB, legacy_path=SAVED_QUERIES_FILE):
+        self.db_path = db_path
+        self.legacy_path = legacy_path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # isolation_level=None: транзакции открываем явно (BEGIN IMMEDIATE)
+            conn = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False, timeout=5.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(saved_queries)")}
+            if "snapshot" not in columns:  # базы, созданные до снимков результатов
+                conn.execute("ALTER TABLE saved_queries ADD COLUMN snapshot TEXT")
+            self._conn = conn
+            if self.legacy_path and os.path.exists(self.legacy_path):
+                self._migrate_legacy()
+        return self._conn
+
+    def _transaction(self):
+        return _Transaction(self.conn)
+
+    @staticmethod
+    def _bump_version(conn, user_id):
+        """Увеличивает версию пользователя внутри текущей транзакции и возвращает её"""
+        conn.execute(
+            "INSERT INTO user_versions (user_id, version) VALUES (?, 1) "
+            "ON CONFLICT (user_id) DO UPDATE SET version = version + 1",
+            (user_id,),
+        )
+        return conn.execute("SELECT version FROM user_versions WHERE user_id = ?", (user_id,)).fetchone()[0]
+
+    @staticmethod
+    def _read_version(conn, user_id):
+        row = conn.execute("SELECT version FROM user_versions WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else 0
+
+    def _migrate_legacy(self):
+        """Переносит saved_queries.json в базу и переименовывает его в *.migrated"""
+        try:
+            with open(self.legacy_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:  # другой воркер перенёс и переименовал файл после проверки exists
+            return
+        rows = []
+        for user_id, queries in data.items():
+            used = set()
+            next_id = max([q.get("id") for q in queries if isinstance(q.get("id"), int)] or [0]) + 1
+            for position, query in enumerate(queries):
+                query_id = query.get("id")
+                if not isinstance(query_id, int) or query_id in used:
+                    query_id, next_id = next_id, next_id + 1
+                used.add(query_id)
+                rows.append((
+                    str(user_id), query_id, position, query.get("name", ""), query.get("city"),
+                    json.dumps(query.get("stores", []), ensure_ascii=False),
+                ))
+        with self._transaction() as conn:
+            # Пользователи, уже перенесённые другим воркером, не дублируются
+            conn.executemany(
+                "INSERT OR IGNORE INTO saved_queries (user_id, id, position, name, city, stores) VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+        try:
+            os.replace(self.legacy_path, self.legacy_path + ".migrated")
+        except FileNotFoundError:  # уже перенесён другим воркером
+            pass
+
+    def version(self, user_id):
+        """Версия списка пользователя (0 — записей ещё не было)"""
+        with self._lock:
+            return self._read_version(self.conn, str(user_id))
+
+    def list(self, user_id):
+        """Запросы пользователя в порядке создания"""
+        return self.list_versioned(user_id)[1]
+
+    def list_versioned(self, user_id):
+        """(версия, запросы) из одного снимка базы"""
+        with self._lock:
+            conn = self.conn
+            conn.execute("BEGIN")
+            try:
+                version = self._read_version(conn, str(user_id))
+                rows = conn.execute(
+                    f"SELECT {_COLUMNS} FROM saved_queries WHERE user_id = ? ORDER BY position",
+                    (str(user_id),),
+                ).fetchall()
+            finally:
+                conn.execute("COMMIT")
+        return version, [_row_to_query(row) for row in rows]
+
+    def get(self, user_id, query_id):
+        """Один запрос по id или None"""
+        with self._lock:
+            row = self.conn.execute(
+                f"SELECT {_COLUMNS} FROM saved_queries WHERE user_id = ? AND id = ?",
+                (str(user_id), query_id),
+            ).fetchone()
+        return _row_to_query(row) if row else None
+
+    def create(self, user_id, name, stores, city=None):
+        """Добавляет запрос с новым id (max + 1 в пределах пользователя); возвращает (запрос, новая версия)"""
+        with self._lock, self._transaction() as conn:
+            query_id, position = conn.execute(
+                "SELECT COALESCE(MAX(id), 0) + 1, COALESCE(MAX(position), -1) + 1 FROM saved_queries WHERE user_id = ?",
+                (str(user_id),),
+            ).fetchone()
+            conn.execute(
+                "INSERT INTO saved_queries (user_id, id, position, name, city, stores) VALUES (?, ?, ?, ?, ?, ?)",
+                (str(user_id), query_id, position, name, city, json.dumps(list(stores), ensure_ascii=False)),
+            )
+            version = self._bump_version(conn, str(user_id))
+        return {"id": query_id, "name": name, "stores": list(stores), "city": city, "snapshot": None}, version
+
+    def update(self, user_id, query_id, **fields):
+        """Меняет name / city / stores / snapshot одного запроса. Возвращает новую версию или None, если запроса нет"""
+        unknown = set(fields) - _FIELDS
+        if unknown:
+            raise ValueError(f"Unknown saved query fields: {sorted(unknown)}")
+        values = [
+            json.dumps(value, ensure_ascii=False) if name in _JSON_FIELDS and value is not None else value
+            for name, value in fields.items()
+        ]
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock, self._transaction() as conn:
+            cursor = conn.execute(
+                f"UPDATE saved_queries SET {assignments} WHERE user_id = ? AND id = ?",
+                (*values, str(user_id), query_id),
+            )
+            return self._bump_version(conn, str(user_id)) if cursor.rowcount > 0 else None
+
+    def delete(self, user_id, query_id):
+        """Удаляет запрос. Возвращает новую версию или None, если запроса нет"""
+        with self._lock, self._transaction() as conn:
+            cursor = conn.execute("DELETE FROM saved_queries WHERE user_id = ? AND id = ?", (str(user_id), query_id))
+            return self._bump_version(conn, str(user_id)) if cursor.rowcount > 0 else None
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def _copy(query):
+    return dict(query, stores=list(query["stores"]))
+
+
+class _Entry:
+    """Список запросов пользователя и индекс id -> запрос для одной версии"""
+
+    __slots__ = ("version", "queries", "by_id", "checked_at")
+
+    def __init__(self, version, queries):
+        self.version = version
+        self.queries = queries
+        self.by_id = {q["id"]: q for q in queries}
+        self.checked_at = time.monotonic()  # когда версия последний раз сверялась с базой
+
+
+class SavedQueryCache:
+    """
+    Кэш сохранённых запросов поверх SavedQueryRepository.
+    Запись идёт в базу (write-through) и в той же транзакции увеличивает версию
+    пользователя; другие воркеры видят новую версию и перечитывают список при следующем
+    обращении. Версия живёт рядом с данными, поэтому сброс Redis кэш не ломает.
+    Пока с последней сверки прошло меньше ttl секунд, чтение не обращается к базе вовсе.
+    Вызовы sqlite3 блокирующие — выполняются в потоке, а не в цикле событий.
+    """
+
+    def __init__(self, repository, max_users=SAVED_QUERIES_CACHE_SIZE, ttl=SAVED_QUERIES_CACHE_TTL):
+        self.repository = repository
+        self.max_users = max_users
+        self.ttl = ttl
+        self._entries = OrderedDict()  # user_id -> _Entry
+        self.hits = 0
+        self.misses = 0
+
+    def _remember(self, user_id, version, queries):
+        entry = _Entry(version, queries)
+        self._entries[user_id] = entry
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+        return entry
+
+    async def _entry(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            fresh = time.monotonic() - entry.checked_at < self.ttl
+            if not fresh:
+                version = await asyncio.to_thread(self.repository.version, user_id)
+                fresh = entry.version == version
+                if fresh:
+                    entry.checked_at = time.monotonic()
+            if fresh:
+                self.hits += 1
+                self._entries.move_to_end(user_id)
+                return entry
+        self.misses += 1
+        version, queries = await asyncio.to_thread(self.repository.list_versioned, user_id)
+        return self._remember(user_id, version, queries)
+
+    async def list(self, user_id):
+        entry = await self._entry(str(user_id))
+        return [_copy(q) for q in entry.queries]
+
+    async def get(self, user_id, query_id):
+        """Запрос по id или None, без перебора списка"""
+        entry = await self._entry(str(user_id))
+        query = entry.by_id.get(query_id)
+        return _copy(query) if query is not None else None
+
+    def _written(self, user_id, version, apply):
+        """После записи в базу: то же изменение в кэше (или сброс, если нас обогнали)"""
+        entry = self._entries.get(user_id)
+        if entry is not None and entry.version == version - 1:
+            self._remember(user_id, version, apply(entry.queries))
+        else:
+            # Между нашей версией и новой была запись другого воркера — перечитаем при обращении
+            self._entries.pop(user_id, None)
+
+    async def create(self, user_id, name, stores, city=None):
+        user_id = str(user_id)
+        query, version = await asyncio.to_thread(self.repository.create, user_id, name, stores, city)
+        self._written(user_id, version, lambda queries: queries + [query])
+        return _copy(query)
+
+    async def update(self, user_id, query_id, **fields):
+        user_id = str(user_id)
+        version = await asyncio.to_thread(self.repository.update, user_id, query_id, **fields)
+        if version is None:
+            return False
+        fields = dict(fields, stores=list(fields["stores"])) if "stores" in fields else fields
+        self._written(user_id, version, lambda queries: [dict(q, **fields) if q["id"] == query_id else q for q in queries])
+        return True
+
+    async def delete(self, user_id, query_id):
+        user_id = str(user_id)
+        version = await asyncio.to_thread(self.repository.delete, user_id, query_id)
+        if version is None:
+            return False
+        self._written(user_id, version, lambda queries: [q for q in queries if q["id"] != query_id])
+        return True
+
+    def stats(self):
+        return {"users": len(self._entries), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,252 @@
+"""
+Планировщик исходящих сообщений bot_gateway под лимиты Telegram.
+Token bucket на бота (~30 сообщений/с), на личный чат (1/с с короткой серией)
+и на группу (20/мин). Отправки ждут в очереди с приоритетами: короткие ответы
+на действия пользователя уходят раньше длинных результатов поиска.
+При TelegramRetryAfter отправка ставится на паузу (для всего бота), а сообщение —
+обратно в очередь, поэтому ответы не теряются. Внутри одного чата сообщения уходят по порядку.
+"""
+
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+from aiogram.exceptions import TelegramRetryAfter
+from config import (
+    GATEWAY_SEND_GLOBAL_RATE,
+    GATEWAY_SEND_CHAT_RATE,
+    GATEWAY_SEND_CHAT_BURST,
+    GATEWAY_SEND_GROUP_RATE,
+    GATEWAY_SEND_MAX_RETRIES,
+)
+
+PRIORITY_HIGH = 0  # короткие ответы на действия пользователя
+PRIORITY_NORMAL = 1  # длинные сообщения (результаты поиска, списки)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0  # RetryAfter от Telegram
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Через сколько секунд будет доступен токен (0 — уже доступен)"""
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.paused_until - now)
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity and self.paused_until <= now
+
+
+class _Send:
+    __slots__ = ("priority", "seq", "chat_id", "factory", "future", "enqueued_at", "retries")
+
+    def __init__(self, priority, seq, chat_id, factory, future):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.factory = factory
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.retries = 0
+
+
+class SendScheduler:
+    """
+    У каждого чата своя FIFO-очередь; в куче _ready лежат только головы очередей
+    чатов, которым можно отправлять, по (приоритет, порядок постановки). Голова,
+    упёршаяся в лимит своего чата, переезжает в кучу _delayed по времени готовности.
+    Пока сообщение чата в отправке, его следующая голова в кучи не попадает.
+    Отправка одного сообщения — O(log n) от числа чатов с ожидающими сообщениями.
+    """
+
+    # Как часто (в отправках) удалять бакеты простаивающих чатов
+    SWEEP_EVERY = 1000
+
+    def __init__(self, global_rate=GATEWAY_SEND_GLOBAL_RATE, chat_rate=GATEWAY_SEND_CHAT_RATE,
+                 chat_burst=GATEWAY_SEND_CHAT_BURST, group_rate=GATEWAY_SEND_GROUP_RATE,
+                 max_retries=GATEWAY_SEND_MAX_RETRIES):
+        self.global_bucket = TokenBucket(global_rate, max(1, int(global_rate)))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._buckets = {}
+        self._chats = {}  # chat_id -> deque[_Send]
+        self._busy_chats = set()  # чаты, у которых сообщение уже в отправке
+        self._ready = []  # (priority, seq, chat_id) — головы, которые можно отправлять
+        self._delayed = []  # (ready_at, priority, seq, chat_id) — головы, ждущие лимит чата
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._sending = set()
+        self.queued = 0
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            # У групп и каналов отрицательные id
+            if chat_id is not None and chat_id < 0:
+                bucket = TokenBucket(self.group_rate, 1)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for chat in self._chats.values():
+            for item in chat:
+                if not item.future.done():
+                    item.future.set_exception(RuntimeError("Send scheduler stopped"))
+        self._chats.clear()
+        self._ready.clear()
+        self._delayed.clear()
+        self.queued = 0
+
+    async def submit(self, chat_id, factory, priority=PRIORITY_HIGH):
+        """
+        factory — функция без аргументов, возвращающая корутину отправки
+        (вызывается заново при повторе). Возвращает результат отправки.
+        """
+        if self._task is None:
+            # Без фоновой задачи future никто не разрешит — вызывающий ждал бы вечно
+            raise RuntimeError("Send scheduler is not started")
+        future = asyncio.get_running_loop().create_future()
+        item = _Send(priority, next(self._seq), chat_id, factory, future)
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = deque()
+        chat.append(item)
+        self.queued += 1
+        if len(chat) == 1 and chat_id not in self._busy_chats:
+            self._push_head(chat_id)
+        return await future
+
+    def _push_head(self, chat_id):
+        head = self._chats[chat_id][0]
+        heapq.heappush(self._ready, (head.priority, head.seq, chat_id))
+        self._wakeup.set()
+
+    def _next_ready(self, now):
+        """Следующее сообщение, которое можно отправить сейчас, или (None, сколько ждать)"""
+        while self._delayed and self._delayed[0][0] <= now:
+            _, priority, seq, chat_id = heapq.heappop(self._delayed)
+            heapq.heappush(self._ready, (priority, seq, chat_id))
+        global_delay = self.global_bucket.delay(now)
+        if global_delay > 0:
+            return None, global_delay
+        while self._ready:
+            priority, seq, chat_id = heapq.heappop(self._ready)
+            delay = self._bucket(chat_id).delay(now)
+            if delay <= 0:
+                return self._chats[chat_id].popleft(), 0
+            heapq.heappush(self._delayed, (now + delay, priority, seq, chat_id))
+        return None, (self._delayed[0][0] - now) if self._delayed else None
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            item, delay = self._next_ready(now)
+            if item is not None:
+                self.queued -= 1
+                self.global_bucket.take(now)
+                self._bucket(item.chat_id).take(now)
+                self._busy_chats.add(item.chat_id)
+                task = asyncio.create_task(self._send(item))
+                self._sending.add(task)
+                task.add_done_callback(self._sending.discard)
+                continue
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send(self, item):
+        try:
+            result = await item.factory()
+        except TelegramRetryAfter as e:
+            self.retries += 1
+            # Flood wait обычно действует на весь бот, а не только на этот чат
+            paused_until = time.monotonic() + e.retry_after
+            self.global_bucket.paused_until = max(self.global_bucket.paused_until, paused_until)
+            self._bucket(item.chat_id).paused_until = paused_until
+            if item.retries < self.max_retries:
+                item.retries += 1
+                # Снова во главу очереди чата — порядок в чате сохраняется
+                self._chats.setdefault(item.chat_id, deque()).appendleft(item)
+                self.queued += 1
+            elif not item.future.done():
+                self.failed += 1
+                item.future.set_exception(e)
+        except Exception as e:
+            self.failed += 1
+            if not item.future.done():
+                item.future.set_exception(e)
+        else:
+            wait = time.monotonic() - item.enqueued_at
+            self.sent += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            if not item.future.done():
+                item.future.set_result(result)
+            if self.sent % self.SWEEP_EVERY == 0:
+                self._sweep()
+        finally:
+            self._busy_chats.discard(item.chat_id)
+            chat = self._chats.get(item.chat_id)
+            if chat:
+                self._push_head(item.chat_id)
+            elif chat is not None:
+                del self._chats[item.chat_id]
+            self._wakeup.set()
+
+    def _sweep(self):
+        now = time.monotonic()
+        idle = [
+            chat_id for chat_id, bucket in self._buckets.items()
+            if chat_id not in self._chats and chat_id not in self._busy_chats and bucket.idle(now)
+        ]
+        for chat_id in idle:
+            del self._buckets[chat_id]
+
+    def stats(self):
+        return {
+            "queued": self.queued,
+            "sending": len(self._sending),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retry_after": self.retries,
+            "chats": len(self._buckets),
+            "avg_wait": self.total_wait / self.sent if self.sent else None,
+            "max_wait": self.max_wait,
+        }
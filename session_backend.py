@@ -0,0 +1,195 @@
+"""
+Хранилище сессий пользователей: FSM-состояние и user_data.
+Реализации: Redis (по умолчанию) и in-memory (dict + TTL) для одного процесса,
+тестов и бенчмарков логики без Redis. Выбирается переменной SESSION_BACKEND.
+"""
+
+import json
+import time
+from config import SESSION_BACKEND, SESSION_TTL
+
+
+def _state_key(user_id):
+    return f"user_fsm:{str(user_id)}"
+
+
+def _data_key(user_id):
+    return f"user_data:{str(user_id)}"
+
+
+class SessionBackend:
+    """Общий интерфейс хранилища сессий"""
+
+    async def startup(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def get_state(self, user_id):
+        """Возвращает состояние FSM или None"""
+        raise NotImplementedError
+
+    async def set_state(self, user_id, state):
+        raise NotImplementedError
+
+    async def get_user_data(self, user_id):
+        """Возвращает dict с данными пользователя или None"""
+        raise NotImplementedError
+
+    async def set_user_data(self, user_id, data):
+        raise NotImplementedError
+
+    async def append_store(self, user_id, store):
+        """Добавляет магазин, если его ещё нет. Возвращает (added, stores)"""
+        raise NotImplementedError
+
+    async def pop_store(self, user_id, index):
+        """Удаляет магазин по индексу. Возвращает (removed или None, stores)"""
+        raise NotImplementedError
+
+    async def reset_search(self, user_id):
+        """Очищает список магазинов и сбрасывает current_query_id"""
+        raise NotImplementedError
+
+    def stats(self):
+        return {}
+
+
+class RedisSessionBackend(SessionBackend):
+    def __init__(self):
+        # Импорт здесь, чтобы memory-режим работал без пакета redis
+        from redis_pool import create_redis_client, pool_stats
+        from redis_scripts import SessionScripts, normalize_user_data, with_store_keys
+        self.client = create_redis_client()
+        self.scripts = SessionScripts(self.client)
+        self._pool_stats = pool_stats
+        self._normalize = normalize_user_data
+        self._with_store_keys = with_store_keys
+
+    async def startup(self):
+        await self.scripts.load()
+
+    async def shutdown(self):
+        await self.client.connection_pool.disconnect()
+
+    async def get_state(self, user_id):
+        state = await self.client.get(_state_key(user_id))
+        return state.decode() if state else None
+
+    async def set_state(self, user_id, state):
+        await self.client.set(_state_key(user_id), state)
+
+    async def get_user_data(self, user_id):
+        data = await self.client.get(_data_key(user_id))
+        if not data:
+            return None
+        return self._normalize(json.loads(data.decode("utf-8")))
+
+    async def set_user_data(self, user_id, data):
+        await self.client.set(_data_key(user_id), json.dumps(self._with_store_keys(data), ensure_ascii=False))
+
+    async def append_store(self, user_id, store):
+        return await self.scripts.append_store(_data_key(user_id), store)
+
+    async def pop_store(self, user_id, index):
+        return await self.scripts.pop_store(_data_key(user_id), index)
+
+    async def reset_search(self, user_id):
+        return await self.scripts.reset_search(_data_key(user_id))
+
+    def stats(self):
+        return {"backend": "redis", "redis_pool": self._pool_stats(self.client)}
+
+
+class MemorySessionBackend(SessionBackend):
+    """
+    Сессии в памяти процесса. Значения хранятся сериализованными в JSON,
+    чтобы изменения возвращённых dict не попадали в хранилище без set_*
+    (как и с Redis). Между воркерами uvicorn сессии не разделяются.
+    """
+
+    # Как часто (в операциях записи) вычищать протухшие ключи
+    SWEEP_EVERY = 1000
+
+    def __init__(self, ttl=SESSION_TTL):
+        self.ttl = ttl
+        self._items = {}
+        self._writes = 0
+
+    def _get(self, key):
+        item = self._items.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at is not None and expires_at < time.monotonic():
+            del self._items[key]
+            return None
+        return value
+
+    def _set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        self._items[key] = (expires_at, value)
+        self._writes += 1
+        if self._writes % self.SWEEP_EVERY == 0:
+            self._sweep()
+
+    def _sweep(self):
+        now = time.monotonic()
+        expired = [k for k, (exp, _) in self._items.items() if exp is not None and exp < now]
+        for key in expired:
+            del self._items[key]
+
+    async def get_state(self, user_id):
+        return self._get(_state_key(user_id))
+
+    async def set_state(self, user_id, state):
+        self._set(_state_key(user_id), state)
+
+    async def get_user_data(self, user_id):
+        data = self._get(_data_key(user_id))
+        return json.loads(data) if data else None
+
+    async def set_user_data(self, user_id, data):
+        self._set(_data_key(user_id), json.dumps(data, ensure_ascii=False))
+
+    # Между await здесь нет переключений, поэтому операции атомарны в рамках event loop
+    async def append_store(self, user_id, store):
+        data = await self.get_user_data(user_id) or {"city": None}
+        stores = data.get("stores") or []
+        if store.lower() in [s.lower() for s in stores]:
+            return False, stores
+        data["stores"] = stores + [store]
+        await self.set_user_data(user_id, data)
+        return True, data["stores"]
+
+    async def pop_store(self, user_id, index):
+        data = await self.get_user_data(user_id)
+        stores = (data or {}).get("stores") or []
+        if index < 0:
+            index += len(stores)
+        if not 0 <= index < len(stores):
+            return None, stores
+        removed = stores.pop(index)
+        data["stores"] = stores
+        await self.set_user_data(user_id, data)
+        return removed, stores
+
+    async def reset_search(self, user_id):
+        data = await self.get_user_data(user_id) or {"city": None}
+        data["stores"] = []
+        data["current_query_id"] = None
+        data.pop("current_query_index", None)  # поле старых сессий
+        await self.set_user_data(user_id, data)
+        return []
+
+    def stats(self):
+        return {"backend": "memory", "keys": len(self._items), "ttl": self.ttl}
+
+
+def create_session_backend(name=SESSION_BACKEND):
+    if name == "redis":
+        return RedisSessionBackend()
+    if name == "memory":
+        return MemorySessionBackend()
+    raise ValueError(f"Unknown SESSION_BACKEND: {name}")
@@ -0,0 +1,22 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Модули читают настройки при импорте — направляем все файлы во временный каталог
+_TMP = tempfile.mkdtemp(prefix="tg_mall_bot_tests_")
+os.environ.setdefault("SESSION_BACKEND", "memory")
+os.environ.setdefault("BOT_TOKEN", "1:test")  # bot_gateway требует токен при импорте
+os.environ.setdefault("LOG_MANIFEST", os.path.join(_TMP, "logs", "manifest.json"))
+os.environ.setdefault("LOG_FILE", os.path.join(_TMP, "logs", "technical.jsonl"))
+os.environ.setdefault("ERROR_LOG_FILE", os.path.join(_TMP, "logs", "errors.jsonl"))
+os.environ.setdefault("USER_ACTIVITY_LOG_FILE", os.path.join(_TMP, "logs", "user_activity.jsonl"))
+os.environ.setdefault("SAVED_QUERIES_DB", os.path.join(_TMP, "saved_queries.sqlite"))
+os.environ.setdefault("SAVED_QUERIES_FILE", os.path.join(_TMP, "saved_queries.json"))
+os.environ.setdefault("USER_MAP_KEY_FILE", os.path.join(_TMP, "user_map.key"))
+os.environ.setdefault("USER_MAP_FILE", os.path.join(_TMP, "user_map.enc"))
+os.environ.setdefault("USER_MAP_RECORDS_FILE", os.path.join(_TMP, "user_map.records"))
+os.environ.setdefault("MALLS_FILE", os.path.join(ROOT, "malls.json"))
+os.environ.setdefault("ALIASES_FILE", os.path.join(ROOT, "aliases.json"))
@@ -0,0 +1,162 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from aiogram import types
+from aiogram.exceptions import TelegramBadRequest
+
+import bot_gateway
+from send_scheduler import SendScheduler
+
+CHAT_ID = 1
+MESSAGE_ID = 100
+INLINE = types.InlineKeyboardMarkup(inline_keyboard=[[types.InlineKeyboardButton(text="x", callback_data="x")]])
+
+
+class StubBot:
+    """Bot без сети: записывает вызовы, по желанию падает с заданной ошибкой"""
+
+    def __init__(self, error=None):
+        self.error = error
+        self.calls = []
+
+    async def edit_message_text(self, text, **kwargs):
+        self.calls.append(("edit_message_text", text, kwargs))
+        if self.error:
+            raise self.error
+        return True
+
+    async def edit_message_reply_markup(self, **kwargs):
+        self.calls.append(("edit_message_reply_markup", kwargs))
+        if self.error:
+            raise self.error
+        return True
+
+
+def bad_request(message):
+    return TelegramBadRequest(None, f"Bad Request: {message}")
+
+
+@pytest.fixture
+def gateway(monkeypatch):
+    monkeypatch.setattr(bot_gateway, "send_scheduler", SendScheduler(global_rate=1000, chat_rate=1000, chat_burst=10))
+    return bot_gateway
+
+
+def use_bot(monkeypatch, error=None):
+    stub = StubBot(error)
+    monkeypatch.setattr(bot_gateway, "bot", stub)
+    return stub
+
+
+def run(coro_factory):
+    async def main():
+        bot_gateway.send_scheduler.start()
+        try:
+            return await coro_factory()
+        finally:
+            await bot_gateway.send_scheduler.stop()
+
+    return asyncio.run(main())
+
+
+def apply(edit, reply_markup=INLINE, text="Новый текст"):
+    return run(lambda: bot_gateway.apply_edit(CHAT_ID, edit, text, reply_markup, None))
+
+
+def test_text_edit_succeeds(gateway, monkeypatch):
+    stub = use_bot(monkeypatch)
+    assert apply({"message_id": MESSAGE_ID, "method": "text"}) is True
+    assert stub.calls == [("edit_message_text", "Новый текст", {
+        "chat_id": CHAT_ID, "message_id": MESSAGE_ID, "reply_markup": INLINE, "link_preview_options": None,
+    })]
+
+
+def test_not_modified_counts_as_success(gateway, monkeypatch):
+    use_bot(monkeypatch, bad_request("message is not modified: specified new message content is the same"))
+    assert apply({"message_id": MESSAGE_ID, "method": "text"}) is True
+
+
+def test_other_bad_request_falls_back(gateway, monkeypatch):
+    use_bot(monkeypatch, bad_request("message to edit not found"))
+    assert apply({"message_id": MESSAGE_ID, "method": "text"}) is False
+
+
+def test_reply_keyboard_cannot_be_set_by_edit(gateway, monkeypatch):
+    stub = use_bot(monkeypatch)
+    keyboard = types.ReplyKeyboardMarkup(keyboard=[[types.KeyboardButton(text="x")]])
+    assert apply({"message_id": MESSAGE_ID, "method": "text"}, reply_markup=keyboard) is False
+    assert stub.calls == [("edit_message_reply_markup", {"chat_id": CHAT_ID, "message_id": MESSAGE_ID, "reply_markup": None})]
+
+
+def test_strip_keyboard_sends_new_message(gateway, monkeypatch):
+    stub = use_bot(monkeypatch)
+    assert apply({"message_id": MESSAGE_ID, "method": "reply_markup"}) is False
+    assert [call[0] for call in stub.calls] == ["edit_message_reply_markup"]
+
+
+def test_strip_keyboard_error_is_ignored(gateway, monkeypatch):
+    # Ошибка снятия кнопок не мешает отправить ответ
+    use_bot(monkeypatch, bad_request("message can't be edited"))
+    assert apply({"message_id": MESSAGE_ID, "method": "reply_markup"}) is False
+
+
+def test_edit_without_message_id_is_skipped(gateway, monkeypatch):
+    stub = use_bot(monkeypatch)
+    assert apply({"message_id": None, "method": "text"}) is False
+    assert stub.calls == []
+
+
+def _callback(answers, acks):
+    async def answer_message(text, **kwargs):
+        answers.append((text, kwargs))
+
+    async def answer_callback(*args, **kwargs):
+        acks.append(True)
+
+    return SimpleNamespace(
+        from_user=SimpleNamespace(id=CHAT_ID),
+        data="pick_store::0",
+        message=SimpleNamespace(message_id=MESSAGE_ID, chat=SimpleNamespace(id=CHAT_ID), answer=answer_message),
+        answer=answer_callback,
+    )
+
+
+@pytest.mark.parametrize("error, sends_new_message", [
+    (None, False),
+    (bad_request("message is not modified"), False),
+    (bad_request("message to edit not found"), True),
+])
+def test_callback_query_edits_or_falls_back(gateway, monkeypatch, error, sends_new_message):
+    stub = use_bot(monkeypatch, error)
+    payloads = []
+
+    async def call_logic_api(kind, payload):
+        payloads.append((kind, payload))
+        return {
+            "text": "Магазин добавлен",
+            "reply_markup": {"inline_keyboard": [[{"text": "x", "callback_data": "x"}]]},
+            "edit": {"message_id": payload["message_id"], "method": "text"},
+        }
+
+    monkeypatch.setattr(bot_gateway, "call_logic_api", call_logic_api)
+    answers, acks = [], []
+    run(lambda: bot_gateway.handle_callback_query(_callback(answers, acks)))
+    assert payloads[0][1]["message_id"] == MESSAGE_ID
+    assert [call[0] for call in stub.calls] == ["edit_message_text"]
+    assert [text for text, _ in answers] == (["Магазин добавлен"] if sends_new_message else [])
+    assert acks == [True]
+
+
+def test_callback_query_without_edit_sends_new_message(gateway, monkeypatch):
+    stub = use_bot(monkeypatch)
+
+    async def call_logic_api(kind, payload):
+        return {"text": "Кнопка устарела", "reply_markup": None}
+
+    monkeypatch.setattr(bot_gateway, "call_logic_api", call_logic_api)
+    answers, acks = [], []
+    run(lambda: bot_gateway.handle_callback_query(_callback(answers, acks)))
+    assert stub.calls == []
+    assert [text for text, _ in answers] == ["Кнопка устарела"]
+    assert acks == [True]
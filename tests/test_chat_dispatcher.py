@@ -0,0 +1,80 @@
+import asyncio
+import random
+
+from aiogram import types
+
+from bot_gateway import ChatOrderedDispatcher
+
+
+def _update(update_id, chat_id):
+    return types.Update(
+        update_id=update_id,
+        message=types.Message(message_id=update_id, date=0, chat=types.Chat(id=chat_id, type="private"), text="x"),
+    )
+
+
+def test_updates_of_one_chat_run_in_order():
+    handled = []
+
+    async def handler(event, data):
+        await asyncio.sleep(random.random() * 0.005)
+        handled.append((event.message.chat.id, event.update_id))
+        return event.update_id
+
+    async def run():
+        dispatcher = ChatOrderedDispatcher(4)
+        results = await asyncio.gather(*[dispatcher(handler, _update(i, i % 5), {}) for i in range(100)])
+        assert results == list(range(100))
+        assert dispatcher.stats()["chats"] == 0
+
+    asyncio.run(run())
+    for chat_id in range(5):
+        ids = [update_id for chat, update_id in handled if chat == chat_id]
+        assert ids == sorted(ids)
+
+
+def test_limit_applies_to_logic_calls_only():
+    async def run():
+        dispatcher = ChatOrderedDispatcher(2)
+        peak = 0
+
+        async def handler(event, data):
+            nonlocal peak
+            async with dispatcher.logic_slot():
+                peak = max(peak, dispatcher.logic_running)
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.2)  # ожидание отправки: слот уже свободен
+
+        start = asyncio.get_running_loop().time()
+        await asyncio.gather(*[dispatcher(handler, _update(i, i), {}) for i in range(10)])
+        assert peak == 2
+        # Если бы слот держался на время отправки, 10 чатов заняли бы 5 * 0.21 с
+        assert asyncio.get_running_loop().time() - start < 0.5
+
+    asyncio.run(run())
+
+
+def test_cancelled_worker_releases_chat_queue():
+    async def run():
+        dispatcher = ChatOrderedDispatcher(2)
+        started = asyncio.Event()
+
+        async def slow(event, data):
+            started.set()
+            await asyncio.sleep(10)
+
+        async def fast(event, data):
+            return event.update_id
+
+        first = asyncio.ensure_future(dispatcher(slow, _update(1, 7), {}))
+        second = asyncio.ensure_future(dispatcher(fast, _update(2, 7), {}))
+        await started.wait()
+        for worker in list(dispatcher._workers):
+            worker.cancel()
+        results = await asyncio.gather(first, second, return_exceptions=True)
+        assert all(isinstance(r, asyncio.CancelledError) for r in results)
+        assert dispatcher.stats()["chats"] == 0
+        assert await dispatcher(fast, _update(3, 7), {}) == 3
+        assert await dispatcher.wait_idle(1)
+
+    asyncio.run(run())
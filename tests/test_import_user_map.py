@@ -0,0 +1,114 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import ROOT
+from migration_tools import import_user_map, user_id_map_crypto
+from migration_tools.import_user_map import merge, replace
+from migration_tools.user_id_map_crypto import UserMapStore
+from migration_tools.utils import get_user_uuid
+
+SCRIPT = os.path.join(ROOT, "migration_tools", "import_user_map.py")
+
+
+@pytest.fixture
+def map_store(tmp_path):
+    return UserMapStore(path=str(tmp_path / "user_map.records"), legacy_path=str(tmp_path / "user_map.enc"))
+
+
+def _ids(map_store):
+    return sorted(map_store.mapping(), key=int)
+
+
+def test_csv_with_header(tmp_path, map_store):
+    path = tmp_path / "users.csv"
+    path.write_text(f"user_id,uuid\n1,{get_user_uuid('1')}\n2,\n\n3\n", encoding="utf-8")
+    assert merge(str(path), map_store=map_store) == {"read": 3, "added": 3, "uuid_mismatch": 0}
+    assert map_store.mapping() == {str(i): get_user_uuid(str(i)) for i in (1, 2, 3)}
+
+
+def test_csv_without_header(tmp_path, map_store):
+    path = tmp_path / "users.csv"
+    path.write_text("10\n-1001\n11\n", encoding="utf-8")
+    assert merge(str(path), map_store=map_store)["added"] == 3
+    assert _ids(map_store) == ["-1001", "10", "11"]
+
+
+def test_jsonl(tmp_path, map_store):
+    path = tmp_path / "users.jsonl"
+    path.write_text('1\n{"user_id": 2}\n\n{"3": "%s"}\n' % get_user_uuid("3"), encoding="utf-8")
+    assert merge(str(path), map_store=map_store) == {"read": 3, "added": 3, "uuid_mismatch": 0}
+    assert _ids(map_store) == ["1", "2", "3"]
+
+
+@pytest.mark.parametrize("streaming", [True, False])
+@pytest.mark.parametrize("data", [
+    {"1": get_user_uuid("1"), "2": get_user_uuid("2")},
+    [1, {"user_id": 2, "uuid": get_user_uuid("2")}],
+])
+def test_json(tmp_path, map_store, monkeypatch, streaming, data):
+    if streaming:
+        pytest.importorskip("ijson")
+    else:
+        monkeypatch.setattr(import_user_map, "ijson", None)
+    path = tmp_path / "users.json"
+    path.write_text(json.dumps(data), encoding="utf-8")
+    assert merge(str(path), map_store=map_store) == {"read": 2, "added": 2, "uuid_mismatch": 0}
+    assert _ids(map_store) == ["1", "2"]
+
+
+def test_merge_skips_known_ids_across_chunks(tmp_path, map_store):
+    map_store.add_many(["1", "2"])
+    path = tmp_path / "users.csv"
+    path.write_text("\n".join(str(i) for i in range(6)) + "\n2\n", encoding="utf-8")
+    stats = merge(str(path), chunk_size=2, map_store=map_store)
+    assert stats == {"read": 7, "added": 4, "uuid_mismatch": 0}
+    assert _ids(map_store) == [str(i) for i in range(6)]
+    # В журнал дописаны только новые записи
+    with open(map_store.path, "rb") as f:
+        assert len(f.read().splitlines()) == 6
+
+
+def test_foreign_uuid_is_rejected(tmp_path, map_store):
+    path = tmp_path / "users.csv"
+    path.write_text(f"user_id,uuid\n1,{get_user_uuid('999')}\n2,{get_user_uuid('2')}\n", encoding="utf-8")
+    assert merge(str(path), map_store=map_store) == {"read": 2, "added": 1, "uuid_mismatch": 1}
+    assert map_store.mapping() == {"2": get_user_uuid("2")}
+
+
+def test_replace(tmp_path, map_store):
+    map_store.add_many(["1", "2"])
+    path = tmp_path / "users.json"
+    path.write_text(json.dumps({"3": get_user_uuid("3"), "4": get_user_uuid("0")}), encoding="utf-8")
+    assert replace(str(path), map_store=map_store) == {"read": 2, "added": 1, "uuid_mismatch": 1}
+    assert map_store.mapping() == {"3": get_user_uuid("3")}
+
+
+def test_cli_replace(tmp_path, monkeypatch):
+    env = dict(
+        os.environ,
+        USER_MAP_KEY_FILE=str(tmp_path / "user_map.key"),
+        USER_MAP_FILE=str(tmp_path / "user_map.enc"),
+        USER_MAP_RECORDS_FILE=str(tmp_path / "user_map.records"),
+    )
+    env.pop("USER_MAP_SECRET", None)
+    (tmp_path / "first.csv").write_text("1\n2\n", encoding="utf-8")
+    (tmp_path / "second.csv").write_text("5\n", encoding="utf-8")
+
+    def run(*args):
+        result = subprocess.run(
+            [sys.executable, SCRIPT, *args], cwd=tmp_path, env=env,
+            capture_output=True, text=True, timeout=60,
+        )
+        assert result.returncode == 0, result.stderr
+        return result.stdout
+
+    assert "добавлено новых: 2" in run("first.csv")
+    assert "добавлено новых: 1" in run("second.csv", "--replace")
+    # Журнал зашифрован ключом, который скрипт создал в tmp_path
+    monkeypatch.setattr(user_id_map_crypto, "KEY_FILE", env["USER_MAP_KEY_FILE"])
+    stored = UserMapStore(path=env["USER_MAP_RECORDS_FILE"], legacy_path=env["USER_MAP_FILE"])
+    assert stored.mapping() == {"5": get_user_uuid("5")}
@@ -0,0 +1,16 @@
+from analytics.log_stats import LogStats
+
+
+def test_merged_counters_stay_bounded():
+    total = LogStats(max_counter_keys=100)
+    for segment in range(10):
+        stats = LogStats(max_counter_keys=100)
+        for i in range(80):
+            stats.add({"event": "store_not_found", "input": f"rare-{segment}-{i}"})
+        for _ in range(50):
+            stats.add({"event": "store_not_found", "input": "Zara"})
+        total.merge(stats)
+    assert len(total.not_found) <= 100
+    # Частое значение переживает отсечение редких
+    assert total.not_found.most_common(1) == [("zara", 500)]
+    assert total.events["store_not_found"] == 1300
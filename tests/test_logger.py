@@ -0,0 +1,298 @@
+import glob
+import gzip
+import multiprocessing
+import os
+import random
+import time
+
+import pytest
+
+import logger
+from logger import JsonlLog, _jsonl_path
+
+
+def _wait_archivers():
+    for archiver in list(logger._archivers):
+        archiver.join(10)
+
+
+def _read_lines(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        return [line for line in f if line.strip()]
+
+
+def _all_lines(tmp_path, stream="technical"):
+    lines = []
+    for path in glob.glob(str(tmp_path / f"{stream}*.jsonl*")):
+        if not path.endswith(".lock"):
+            lines.extend(_read_lines(path))
+    return lines
+
+
+def test_non_jsonl_path_is_redirected():
+    assert _jsonl_path("logs/technical.jsonl") == "logs/technical.jsonl"
+    assert _jsonl_path("logs/technical.json") == "logs/technical.jsonl"
+
+
+def test_rotates_by_size(tmp_path, monkeypatch):
+    monkeypatch.setattr(logger, "LOG_MAX_BYTES", 100)
+    monkeypatch.setattr(logger, "LOG_COMPRESSION", "gzip")
+    log = JsonlLog(str(tmp_path / "technical.jsonl"))
+    for i in range(10):
+        log.write(f'{{"n": {i}, "pad": "{"x" * 20}"}}\n')
+    _wait_archivers()
+    assert glob.glob(str(tmp_path / "technical.*.jsonl.gz"))
+    assert len(_all_lines(tmp_path)) == 10
+
+
+def test_rotates_file_from_previous_day(tmp_path, monkeypatch):
+    monkeypatch.setattr(logger, "LOG_MAX_BYTES", 0)
+    monkeypatch.setattr(logger, "LOG_COMPRESSION", "none")
+    path = tmp_path / "technical.jsonl"
+    path.write_text('{"n": 0}\n', encoding="utf-8")
+    yesterday = time.time() - 86400
+    os.utime(path, (yesterday, yesterday))
+    JsonlLog(str(path)).write('{"n": 1}\n')
+    _wait_archivers()
+    day = time.strftime("%Y-%m-%d", time.localtime(yesterday))
+    assert _read_lines(str(tmp_path / f"technical.{day}.jsonl")) == ['{"n": 0}\n']
+    assert _read_lines(str(path)) == ['{"n": 1}\n']
+
+
+def _write_from_process(path, count):
+    log = JsonlLog(path)
+    for i in range(count):
+        log.write(f'{{"pid": {os.getpid()}, "n": {i}}}\n')
+    _wait_archivers()
+
+
+@pytest.mark.skipif(logger.fcntl is None, reason="нужен fcntl")
+def test_processes_share_file_without_losing_lines(tmp_path, monkeypatch):
+    monkeypatch.setattr(logger, "LOG_MAX_BYTES", 2000)
+    monkeypatch.setattr(logger, "LOG_COMPRESSION", "none")
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(target=_write_from_process, args=(str(tmp_path / "technical.jsonl"), 300))
+        for _ in range(4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+    lines = _all_lines(tmp_path)
+    assert len(lines) == 1200
+    assert len(set(lines)) == 1200
+
+
+@pytest.fixture
+def log_file(tmp_path, monkeypatch):
+    path = str(tmp_path / "writer.jsonl")
+    monkeypatch.setitem(logger._LOGS, path, JsonlLog(path))
+    return path
+
+
+def _stalled_writer(policy, maxsize=2):
+    # Поток записи не запущен — очередь только наполняется
+    writer = logger.LogWriter(maxsize=maxsize, policy=policy)
+    writer._thread = object()
+    return writer
+
+
+def _queued(writer):
+    return [item[1] for item in list(writer.queue.queue)]
+
+
+def test_drop_new_keeps_oldest(log_file):
+    writer = _stalled_writer("drop_new")
+    for i in range(4):
+        writer.put(log_file, f"{i}\n")
+    assert _queued(writer) == ["0\n", "1\n"]
+    assert writer.dropped == 2
+
+
+def test_drop_old_keeps_newest(log_file):
+    writer = _stalled_writer("drop_old")
+    for i in range(4):
+        writer.put(log_file, f"{i}\n")
+    assert _queued(writer) == ["2\n", "3\n"]
+    assert writer.dropped == 2
+
+
+def test_block_does_not_wait_inside_event_loop(log_file, monkeypatch):
+    import asyncio
+
+    monkeypatch.setattr(logger, "LOG_QUEUE_BLOCK_TIMEOUT", 5.0)
+    writer = _stalled_writer("block", maxsize=1)
+    assert writer.block_timeout == logger.MAX_BLOCK_TIMEOUT
+
+    async def log_from_handler():
+        start = time.monotonic()
+        writer.put(log_file, "0\n")
+        writer.put(log_file, "1\n")
+        return time.monotonic() - start
+
+    assert asyncio.run(log_from_handler()) < 0.05
+    assert writer.dropped == 1
+    start = time.monotonic()
+    writer.put(log_file, "2\n")  # вне цикла событий ждёт, но не дольше MAX_BLOCK_TIMEOUT
+    assert time.monotonic() - start < 1
+    assert writer.dropped == 2
+
+
+def test_close_flushes_queue_and_later_puts(log_file):
+    writer = logger.LogWriter(maxsize=100, batch_size=10)
+    for i in range(50):
+        writer.put(log_file, f'{{"n": {i}}}\n')
+    writer.close()
+    writer.put(log_file, '{"n": 50}\n')
+    assert len(_read_lines(log_file)) == 51
+    assert writer.stats()["written"] == 51
+    assert writer.dropped == 0
+
+
+def _make_segment(tmp_path, name, count):
+    path = tmp_path / name
+    path.write_text("".join(f'{{"n": {i}, "timestamp": "2024-05-01T00:00:{i:02d}"}}\n' for i in range(count)),
+                    encoding="utf-8")
+    return str(path)
+
+
+def _archive_many(paths, manifest_path):
+    for path in paths:
+        logger.archive_segment(path, "technical", "2024-05-01", manifest_path)
+
+
+@pytest.mark.skipif(logger.fcntl is None, reason="нужен fcntl")
+def test_manifest_keeps_entries_from_all_processes(tmp_path, monkeypatch):
+    monkeypatch.setattr(logger, "LOG_COMPRESSION", "gzip")
+    manifest_path = str(tmp_path / "manifest.json")
+    groups = [[_make_segment(tmp_path, f"technical.2024-05-01.{p * 10 + i + 1}.jsonl", 5) for i in range(10)]
+              for p in range(4)]
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=_archive_many, args=(group, manifest_path)) for group in groups]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+    segments = logger.read_manifest(manifest_path)
+    assert sorted(s["path"] for s in segments) == sorted(p + ".gz" for group in groups for p in group)
+    assert all(s["events"] == 5 and s["first_ts"] == "2024-05-01T00:00:00" for s in segments)
+
+
+def test_failed_archive_is_logged_and_recovered(tmp_path, monkeypatch):
+    monkeypatch.setattr(logger, "LOG_COMPRESSION", "gzip")
+    manifest_path = str(tmp_path / "manifest.json")
+    live = str(tmp_path / "technical.jsonl")
+    monkeypatch.setattr(logger, "_LOGS", {live: JsonlLog(live)})
+    errors = []
+    monkeypatch.setattr(logger, "_write", lambda log_file, user_id, event, details: errors.append((event, details)))
+    segment = _make_segment(tmp_path, "technical.2024-05-01.jsonl", 3)
+
+    def broken(*args):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(logger, "_add_to_manifest", broken)
+    logger.archive_segment(segment, "technical", "2024-05-01", manifest_path)
+    assert errors and errors[0][0] == "error_log_archive" and "disk full" in errors[0][1]["error"]
+    # Сжатие прошло, манифест — нет: при следующем старте сегмент дописывается в манифест
+    assert os.path.exists(segment + ".gz") and not os.path.exists(segment)
+    monkeypatch.undo()
+    monkeypatch.setattr(logger, "LOG_COMPRESSION", "gzip")
+    monkeypatch.setattr(logger, "_LOGS", {live: JsonlLog(live)})
+    other = _make_segment(tmp_path, "technical.2024-05-02.jsonl", 2)  # сжатие не начиналось
+    assert logger.recover_segments(manifest_path) == 2
+    segments = {s["path"]: s for s in logger.read_manifest(manifest_path)}
+    assert segments[segment + ".gz"]["events"] == 3
+    assert segments[other + ".gz"]["events"] == 2
+    assert not os.path.exists(other)
+    assert logger.recover_segments(manifest_path) == 0
+
+
+@pytest.fixture
+def written(monkeypatch):
+    """События, прошедшие уровень и сэмплирование (без записи в файлы)"""
+    entries = []
+    monkeypatch.setattr(logger, "_write_entry", lambda log_file, user_id, event, details: entries.append((event, details)))
+    monkeypatch.setattr(logger, "EVENT_LEVELS", logger.parse_event_levels(""))
+    monkeypatch.setattr(logger, "SAMPLE_RATES", {})
+    monkeypatch.setattr(logger, "MIN_LEVEL", logger.LEVELS["info"])
+    return entries
+
+
+def test_parse_event_levels_applies_overrides():
+    levels = logger.parse_event_levels("bot_response=info, store_search=debug, http_response=bogus")
+    assert levels["debug"] == logger.LEVELS["debug"]
+    assert levels["callback_query"] == logger.LEVELS["debug"]
+    assert levels["bot_response"] == logger.LEVELS["info"]
+    assert levels["store_search"] == logger.LEVELS["debug"]
+    # Неизвестный уровень — info
+    assert levels["http_response"] == logger.LEVELS["info"]
+
+
+def test_parse_sample_rates():
+    assert logger.parse_sample_rates("http_response=0.5, debug=0,broken") == {"http_response": 0.5, "debug": 0.0}
+    assert logger.parse_sample_rates("") == {}
+
+
+def test_default_levels_keep_compact_records(written):
+    logger.log_technical("u", "bot_response", {"text": "long"})
+    logger.log_technical("u", "http_response", {"status_code": 200})
+    logger.log_event("u", "error_handler", {"error": "boom"})
+    logger.log_user_activity("u", "store_added", {"store": "Zara"})
+    assert [event for event, _ in written] == ["http_response", "error_handler", "store_added"]
+
+
+def test_log_debug_builds_message_only_when_enabled(written, monkeypatch):
+    calls = []
+
+    def make_message():
+        calls.append(1)
+        return "stores: [...]"
+
+    logger.log_debug("u", make_message)
+    assert calls == [] and written == []
+
+    monkeypatch.setattr(logger, "MIN_LEVEL", logger.LEVELS["debug"])
+    logger.log_debug("u", make_message)
+    assert calls == [1]
+    assert written == [("debug", {"message": "stores: [...]"})]
+
+
+def test_event_level_override_enables_debug_event(written, monkeypatch):
+    monkeypatch.setattr(logger, "EVENT_LEVELS", logger.parse_event_levels("bot_response=info"))
+    logger.log_technical("u", "bot_response", {"text": "hi"})
+    assert written == [("bot_response", {"text": "hi"})]
+
+
+def test_sampling_uses_rate_with_fixed_rng(written, monkeypatch):
+    monkeypatch.setattr(logger, "SAMPLE_RATES", {"http_response": 0.25, "store_search": 0.0})
+    monkeypatch.setattr(logger, "random", random.Random(7))
+    for _ in range(1000):
+        logger.log_technical("u", "http_response")
+        logger.log_user_activity("u", "store_search")
+        logger.log_user_activity("u", "store_added")
+    # Случайное число берут только события с заданной долей: http_response, затем store_search
+    rng = random.Random(7)
+    draws = [(rng.random(), rng.random()) for _ in range(1000)]
+    expected = sum(1 for http_draw, _ in draws if http_draw < 0.25)
+    events = [event for event, _ in written]
+    assert events.count("http_response") == expected
+    assert 200 < expected < 300
+    assert events.count("store_search") == 0
+    assert events.count("store_added") == 1000
+
+
+def test_log_debug_is_sampled(written, monkeypatch):
+    monkeypatch.setattr(logger, "MIN_LEVEL", logger.LEVELS["debug"])
+    monkeypatch.setattr(logger, "SAMPLE_RATES", {"debug": 0.5})
+    monkeypatch.setattr(logger, "random", random.Random(3))
+    calls = []
+    for i in range(100):
+        logger.log_debug("u", lambda: calls.append(i) or str(i))
+    rng = random.Random(3)
+    expected = [str(i) for i in range(100) if rng.random() < 0.5]
+    assert [details["message"] for _, details in written] == expected
+    assert len(calls) == len(expected)
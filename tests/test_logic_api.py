@@ -0,0 +1,286 @@
+import asyncio
+
+import pytest
+
+import logic_api
+from migration_tools.utils import get_user_uuid
+from saved_queries import SavedQueryCache, SavedQueryRepository
+from session_backend import MemorySessionBackend
+
+USER = 42
+MESSAGE_ID = 100
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "saved_queries.sqlite")
+
+
+@pytest.fixture
+def api(db_path, monkeypatch):
+    """logic_api с in-memory сессиями и своей SQLite-базой сохранённых запросов"""
+    repository = SavedQueryRepository(db_path=db_path, legacy_path=None)
+    monkeypatch.setattr(logic_api, "session", MemorySessionBackend())
+    monkeypatch.setattr(logic_api, "saved_queries", SavedQueryCache(repository))
+    yield logic_api
+    repository.close()
+
+
+def run(scenario):
+    return asyncio.run(scenario())
+
+
+async def send(text, user_id=USER):
+    return await logic_api.process_update({"user_id": user_id, "text": text, "chat_id": user_id})
+
+
+async def press(callback_data, user_id=USER, message_id=MESSAGE_ID):
+    return await logic_api.process_callback({
+        "user_id": user_id, "callback_data": callback_data, "message_id": message_id, "chat_id": user_id,
+    })
+
+
+async def save_query(name, stores, city="Москва"):
+    """Сохраняет запрос через меню, как пользователь; возвращает его id"""
+    await send("/start")
+    await send(city)
+    for store in stores:
+        await send(store)
+    await press("save_query")
+    await send(name)
+    queries = await logic_api.saved_queries.list(get_user_uuid(USER))
+    return next(q["id"] for q in queries if q["name"] == name)
+
+
+def other_worker(db_path):
+    """Кэш другого воркера над той же базой"""
+    return SavedQueryCache(SavedQueryRepository(db_path=db_path, legacy_path=None), ttl=0)
+
+
+def test_saved_query_buttons_carry_ids(api):
+    async def scenario():
+        first = await save_query("первый", ["Calzedonia"])
+        second = await save_query("второй", ["Теремок", "Sokolov"])
+        await logic_api.saved_queries.delete(get_user_uuid(USER), first)
+        return second, await send("📜 Список запросов")
+
+    second, response = run(scenario)
+    assert response["reply_markup"]["inline_keyboard"] == [[{"text": "второй", "callback_data": f"saved_query::{second}"}]]
+
+
+def test_load_saved_query_by_id(api):
+    async def scenario():
+        first = await save_query("первый", ["Calzedonia"])
+        second = await save_query("второй", ["Теремок", "Sokolov"], city="Санкт-Петербург")
+        # Удаление первого не сдвигает кнопку второго
+        await logic_api.saved_queries.delete(get_user_uuid(USER), first)
+        response = await press(f"saved_query::{second}")
+        return second, response, await logic_api.get_user_data(USER), await logic_api.get_state(USER)
+
+    second, response, user_data, state = run(scenario)
+    assert "Загружен список <b>второй</b>" in response["text"]
+    assert "1. Теремок\n2. Sokolov" in response["text"]
+    assert response["edit"] == {"message_id": MESSAGE_ID, "method": "reply_markup"}
+    assert user_data == {"stores": ["Теремок", "Sokolov"], "current_query_id": second, "city": "Санкт-Петербург"}
+    assert state == logic_api.STATE_EDITING_SAVED_QUERY
+
+
+def test_load_saved_query_deleted_by_other_worker(api, db_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("saved_queries.time.monotonic", lambda: now[0])
+
+    async def scenario():
+        query_id = await save_query("первый", ["Calzedonia"])
+        await send("📜 Список запросов")
+        await other_worker(db_path).delete(get_user_uuid(USER), query_id)
+        # Запись другого воркера видна после TTL кэша
+        now[0] += logic_api.saved_queries.ttl
+        response = await press(f"saved_query::{query_id}")
+        return response, await logic_api.get_user_data(USER), await logic_api.get_state(USER)
+
+    response, user_data, state = run(scenario)
+    assert response["text"] == "Не удалось найти выбранный запрос. Пожалуйста, выберите другой из списка."
+    assert "edit" not in response
+    assert user_data.get("current_query_id") is None
+    assert state == logic_api.STATE_ENTERING_STORE
+
+
+def test_saved_query_with_bad_id(api):
+    response = run(lambda: press("saved_query::abc"))
+    assert response["text"] == "Не удалось найти выбранный запрос. Пожалуйста, выберите другой из списка."
+
+
+def test_old_positional_buttons_are_invalidated(api):
+    async def scenario():
+        await save_query("первый", ["Calzedonia"])
+        response = await press("load_query::0")
+        return response, await logic_api.get_user_data(USER), await logic_api.get_state(USER)
+
+    response, user_data, state = run(scenario)
+    assert response["text"] == "Кнопка устарела. Откройте «📜 Список запросов» заново."
+    # Старый список теряет кнопки, запрос не загружается
+    assert response["edit"] == {"message_id": MESSAGE_ID, "method": "reply_markup"}
+    assert user_data.get("current_query_id") is None
+    assert state == logic_api.STATE_ENTERING_STORE
+
+
+@pytest.fixture
+def renders(monkeypatch):
+    """Счётчик пересчётов результата поиска (без снимка)"""
+    calls = []
+    render = logic_api.render_mall_search
+
+    def counting_render(city, queries, resolved):
+        calls.append((city, list(queries)))
+        return render(city, queries, resolved)
+
+    monkeypatch.setattr(logic_api, "render_mall_search", counting_render)
+    return calls
+
+
+async def search_saved(query_id):
+    """Загружает сохранённый запрос кнопкой и нажимает «🔍 Искать»"""
+    await press(f"saved_query::{query_id}")
+    return await send("🔍 Искать")
+
+
+async def snapshot_of(query_id):
+    return (await logic_api.saved_queries.get(get_user_uuid(USER), query_id))["snapshot"]
+
+
+def test_snapshot_is_reused_while_catalog_city_and_stores_match(api, renders):
+    async def scenario():
+        query_id = await save_query("обед", ["Calzedonia", "Теремок"])
+        first = await search_saved(query_id)
+        snapshot = await snapshot_of(query_id)
+        second = await search_saved(query_id)
+        return first, second, snapshot
+
+    first, second, snapshot = run(scenario)
+    assert renders == [("Москва", ["Calzedonia", "Теремок"])]
+    assert second["text"] == first["text"]
+    assert "Calzedonia" in first["text"]
+    assert snapshot["catalog_version"] == logic_api.CATALOG_VERSION
+    assert snapshot["city"] == "Москва"
+    assert snapshot["stores"] == ["Calzedonia", "Теремок"]
+    assert snapshot["text"] == first["text"]
+
+
+def test_snapshot_is_recomputed_when_catalog_changes(api, renders, monkeypatch):
+    async def scenario():
+        query_id = await save_query("обед", ["Calzedonia"])
+        await search_saved(query_id)
+        monkeypatch.setattr(logic_api, "CATALOG_VERSION", "new-catalog")
+        await search_saved(query_id)
+        await search_saved(query_id)
+        return await snapshot_of(query_id)
+
+    snapshot = run(scenario)
+    assert len(renders) == 2
+    assert snapshot["catalog_version"] == "new-catalog"
+
+
+def test_snapshot_is_recomputed_when_stores_change(api, renders):
+    async def scenario():
+        query_id = await save_query("обед", ["Calzedonia"])
+        await search_saved(query_id)
+        # Правка магазинов сохранённого запроса через меню
+        await press(f"saved_query::{query_id}")
+        await send("🛒 Редактировать магазины")
+        await send("Теремок")
+        await send("⬅️ Назад")
+        response = await send("🔍 Искать")
+        await search_saved(query_id)
+        return response, await snapshot_of(query_id)
+
+    response, snapshot = run(scenario)
+    assert renders == [("Москва", ["Calzedonia"]), ("Москва", ["Calzedonia", "Теремок"])]
+    assert snapshot["stores"] == ["Calzedonia", "Теремок"]
+    assert snapshot["text"] == response["text"]
+
+
+def test_snapshot_is_not_used_or_overwritten_for_another_city(api, renders):
+    async def scenario():
+        query_id = await save_query("обед", ["Теремок"])
+        await search_saved(query_id)
+        moscow = await snapshot_of(query_id)
+        await press(f"saved_query::{query_id}")
+        user_data = await logic_api.get_user_data(USER)
+        await logic_api.set_user_data(USER, dict(user_data, city="Санкт-Петербург"))
+        await send("🔍 Искать")
+        return moscow, await snapshot_of(query_id)
+
+    moscow, snapshot = run(scenario)
+    assert renders == [("Москва", ["Теремок"]), ("Санкт-Петербург", ["Теремок"])]
+    # Снимок описывает сохранённый запрос (Москва), поиск по другому городу его не заменяет
+    assert snapshot == moscow
+
+
+def test_snapshot_is_not_written_when_session_stores_differ(api, renders, db_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("saved_queries.time.monotonic", lambda: now[0])
+
+    async def scenario():
+        query_id = await save_query("обед", ["Calzedonia"])
+        await press(f"saved_query::{query_id}")
+        # Другой воркер поменял магазины запроса, в сессии остался старый список
+        await other_worker(db_path).update(get_user_uuid(USER), query_id, stores=["Теремок"])
+        now[0] += logic_api.saved_queries.ttl
+        response = await send("🔍 Искать")
+        return response, await snapshot_of(query_id)
+
+    response, snapshot = run(scenario)
+    assert renders == [("Москва", ["Calzedonia"])]
+    assert "Calzedonia" in response["text"]
+    assert snapshot is None
+
+
+def test_snapshot_is_fresh():
+    snapshot = {"catalog_version": logic_api.CATALOG_VERSION, "city": "Москва", "stores": ["Zara"]}
+    assert logic_api.snapshot_is_fresh(snapshot, "Москва", ["Zara"])
+    assert not logic_api.snapshot_is_fresh(snapshot, "Санкт-Петербург", ["Zara"])
+    assert not logic_api.snapshot_is_fresh(snapshot, "Москва", ["Zara", "Lush"])
+    assert not logic_api.snapshot_is_fresh(dict(snapshot, catalog_version="old"), "Москва", ["Zara"])
+    assert not logic_api.snapshot_is_fresh(None, "Москва", ["Zara"])
+
+
+def test_store_callbacks_edit_the_pressed_message(api):
+    async def scenario():
+        await send("/start")
+        await send("Москва")
+        added = await send("Теремок")
+        wrong = await press(added["reply_markup"]["inline_keyboard"][0][0]["callback_data"])
+        picked = await press(wrong["reply_markup"]["inline_keyboard"][0][0]["callback_data"])
+        return wrong, picked
+
+    wrong, picked = run(scenario)
+    assert wrong["edit"] == {"message_id": MESSAGE_ID, "method": "text"}
+    assert wrong["text"].startswith("Выберите правильный магазин для:")
+    assert "inline_keyboard" in wrong["reply_markup"]
+    assert picked["edit"] == {"message_id": MESSAGE_ID, "method": "text"}
+    assert picked["text"].startswith("<b>Магазин добавлен:</b>")
+
+
+def test_callback_without_message_id_has_no_edit_directive(api):
+    async def scenario():
+        query_id = await save_query("обед", ["Calzedonia"])
+        await send("Теремок")
+        wrong = await press("wrong_store::0::0", message_id=None)
+        picked = await press("pick_store::0", message_id=None)
+        loaded = await press(f"saved_query::{query_id}", message_id=None)
+        stale = await press("load_query::0", message_id=None)
+        return wrong, picked, loaded, stale
+
+    for response in run(scenario):
+        assert "edit" not in response
+        assert response["text"]
+
+
+def test_edit_helpers():
+    assert logic_api.edit_reply(None, "text") == {"text": "text", "reply_markup": None}
+    assert logic_api.edit_reply(7, "text", {"inline_keyboard": []}, disable_web_page_preview=True) == {
+        "text": "text", "reply_markup": {"inline_keyboard": []}, "disable_web_page_preview": True,
+        "edit": {"message_id": 7, "method": "text"},
+    }
+    assert logic_api.strip_keyboard({"text": "t"}, None) == {"text": "t"}
+    assert logic_api.strip_keyboard({"text": "t"}, 7) == {"text": "t", "edit": {"message_id": 7, "method": "reply_markup"}}
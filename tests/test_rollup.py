@@ -0,0 +1,70 @@
+import json
+
+from analytics import rollup
+from analytics.log_stats import LATENCY_BUCKETS
+
+
+def _segment(path, entries):
+    with open(path, "w", encoding="utf-8") as f:
+        for entry in entries:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        f.write("not json\n")
+    return str(path)
+
+
+def _logs(tmp_path):
+    logs = tmp_path / "logs"
+    logs.mkdir()
+    first = _segment(logs / "user_activity.2024-05-01.jsonl", [
+        {"event": "store_search", "city": "Москва", "timestamp": "2024-05-01T10:00:00"},
+        {"event": "store_search", "city": "Москва", "timestamp": "2024-05-01T11:00:00"},
+        {"event": "store_added", "store": "Zara", "timestamp": "2024-05-01T11:00:01"},
+        {"event": "store_search", "city": "Санкт-Петербург", "timestamp": "2024-05-02T09:00:00"},
+    ])
+    second = _segment(logs / "technical.2024-05-01.jsonl", [
+        {"event": "http_response", "duration": 0.001, "timestamp": "2024-05-01T10:00:00"},
+        {"event": "http_response", "duration": 0.001, "timestamp": "2024-05-01T10:00:01"},
+        {"event": "http_response", "duration": 0.5, "timestamp": "2024-05-01T10:00:02"},
+        {"event": "http_response", "duration": "n/a", "timestamp": "2024-05-01T10:00:03"},
+    ])
+    # Открытый сегмент в свёртку не попадает
+    _segment(logs / "technical.jsonl", [{"event": "http_response", "duration": 9.0, "timestamp": "2024-05-01T12:00:00"}])
+    with open(logs / "manifest.json", "w", encoding="utf-8") as f:
+        json.dump({"segments": [{"path": first}, {"path": second}]}, f)
+    return str(logs)
+
+
+def test_rollup_daily_counts_and_latency(tmp_path):
+    db = str(tmp_path / "rollups.sqlite")
+    assert rollup.update_rollups(_logs(tmp_path), db, workers=1) == 2
+    report = rollup.daily_report(db)
+    assert list(report) == ["2024-05-01", "2024-05-02"]
+    day = report["2024-05-01"]
+    assert day["events"] == {"store_search": 2, "store_added": 1, "http_response": 4}
+    assert day["searches_by_city"] == {"Москва": 2}
+    assert day["latency"]["count"] == 3
+    assert day["latency"]["p50"] == LATENCY_BUCKETS[0]
+    assert 0.5 <= day["latency"]["p99"] < 0.5 * 1.25
+    assert report["2024-05-02"]["searches_by_city"] == {"Санкт-Петербург": 1}
+    assert report["2024-05-02"]["latency"] == {}
+    assert rollup.daily_report(db, since="2024-05-02") == {"2024-05-02": report["2024-05-02"]}
+
+
+def test_rollup_twice_does_not_double_count(tmp_path):
+    db = str(tmp_path / "rollups.sqlite")
+    logs = _logs(tmp_path)
+    rollup.update_rollups(logs, db, workers=1)
+    before = rollup.daily_report(db)
+    assert rollup.update_rollups(logs, db, workers=1) == 0
+    assert rollup.daily_report(db) == before
+
+
+def test_store_skips_segment_already_processed(tmp_path):
+    # Два запуска свернули один сегмент параллельно: второй не должен удвоить счётчики
+    logs = _logs(tmp_path)
+    conn = rollup.connect(str(tmp_path / "rollups.sqlite"))
+    path, events, result = rollup.rollup_segment(rollup.find_segments(logs, include_live=False)[0])
+    assert rollup._store(conn, path, events, result) is True
+    assert rollup._store(conn, path, events, result) is False
+    assert conn.execute("SELECT count FROM daily_events WHERE event = 'store_search' AND day = '2024-05-01'").fetchone() == (2,)
+    conn.close()
@@ -0,0 +1,192 @@
+import asyncio
+import json
+import os
+import threading
+
+import pytest
+
+from saved_queries import SavedQueryCache, SavedQueryRepository
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "saved_queries.sqlite")
+
+
+def _repository(db_path, legacy_path=None):
+    return SavedQueryRepository(db_path=db_path, legacy_path=legacy_path)
+
+
+def test_legacy_json_is_migrated_once(tmp_path, db_path):
+    legacy_path = tmp_path / "saved_queries.json"
+    legacy_path.write_text(json.dumps({
+        "u1": [
+            {"id": 1, "name": "a", "stores": ["Zara"], "city": "Москва"},
+            {"id": 1, "name": "dup", "stores": ["H&M"]},  # повторный id получает новый
+            {"name": "no id", "stores": []},
+        ],
+        "u2": [{"id": 7, "name": "b", "stores": ["Lush"], "city": None}],
+    }, ensure_ascii=False), encoding="utf-8")
+    repository = _repository(db_path, str(legacy_path))
+    queries = repository.list("u1")
+    assert [(q["id"], q["name"]) for q in queries] == [(1, "a"), (2, "dup"), (3, "no id")]
+    assert repository.get("u2", 7)["stores"] == ["Lush"]
+    assert not legacy_path.exists()
+    assert os.path.exists(str(legacy_path) + ".migrated")
+    repository.close()
+    assert len(_repository(db_path).list("u1")) == 3
+
+
+def test_ids_are_stable_and_not_reused(db_path):
+    repository = _repository(db_path)
+    first, _ = repository.create("u", "first", ["Zara"])
+    second, _ = repository.create("u", "second", ["H&M"], "Москва")
+    assert (first["id"], second["id"]) == (1, 2)
+    assert repository.delete("u", first["id"])
+    assert repository.delete("u", first["id"]) is None
+    assert repository.update("u", 99, name="x") is None
+    third, _ = repository.create("u", "third", [])
+    assert third["id"] == 3
+    assert [q["name"] for q in repository.list("u")] == ["second", "third"]
+    with pytest.raises(ValueError):
+        repository.update("u", 2, position=0)
+
+
+def test_concurrent_creates_get_distinct_ids(db_path):
+    # Отдельные подключения — как у разных воркеров
+    repositories = [_repository(db_path) for _ in range(4)]
+    repositories[0].list("u")  # схема создаётся до гонки
+
+    def create(repository):
+        for i in range(10):
+            repository.create("u", f"q{i}", [])
+
+    threads = [threading.Thread(target=create, args=(r,)) for r in repositories]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    ids = [q["id"] for q in repositories[0].list("u")]
+    assert sorted(ids) == list(range(1, 41))
+    assert repositories[0].version("u") == 40
+
+
+def test_cache_sees_writes_of_other_worker(db_path):
+    async def run():
+        worker_a = SavedQueryCache(_repository(db_path), ttl=0)
+        worker_b = SavedQueryCache(_repository(db_path), ttl=0)
+        query = await worker_a.create("u", "a", ["Zara"])
+        assert [q["name"] for q in await worker_b.list("u")] == ["a"]
+        assert await worker_a.update("u", query["id"], stores=["Zara", "Lush"])
+        assert (await worker_b.get("u", query["id"]))["stores"] == ["Zara", "Lush"]
+        assert await worker_b.delete("u", query["id"])
+        assert await worker_a.list("u") == []
+        assert await worker_a.get("u", query["id"]) is None
+
+    asyncio.run(run())
+
+
+def test_cache_applies_own_writes_without_rereading(db_path):
+    async def run():
+        cache = SavedQueryCache(_repository(db_path))
+        await cache.list("u")
+        query = await cache.create("u", "a", ["Zara"])
+        await cache.update("u", query["id"], name="b")
+        misses = cache.misses
+        assert [q["name"] for q in await cache.list("u")] == ["b"]
+        assert cache.misses == misses
+        # Возвращаемые списки — копии, кэш ими не портится
+        (await cache.list("u"))[0]["stores"].append("H&M")
+        assert (await cache.get("u", query["id"]))["stores"] == ["Zara"]
+
+    asyncio.run(run())
+
+
+def test_version_survives_new_connection(db_path):
+    async def run():
+        cache = SavedQueryCache(_repository(db_path), ttl=0)
+        query = await cache.create("u", "a", ["Zara"])
+        # Перезапуск другого процесса: версия читается из базы, а не из памяти или Redis
+        other = _repository(db_path)
+        other.update("u", query["id"], name="changed elsewhere")
+        assert (await cache.get("u", query["id"]))["name"] == "changed elsewhere"
+
+    asyncio.run(run())
+
+
+class CountingRepository:
+    """Считает обращения кэша к базе"""
+
+    def __init__(self, repository):
+        self.repository = repository
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.repository, name)
+
+        def call(*args, **kwargs):
+            self.calls.append(name)
+            return method(*args, **kwargs)
+
+        return call
+
+
+def test_cache_hits_do_not_touch_repository(db_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("saved_queries.time.monotonic", lambda: now[0])
+
+    async def run():
+        repository = CountingRepository(_repository(db_path))
+        cache = SavedQueryCache(repository, ttl=5)
+        query = await cache.create("u", "a", ["Zara"])
+        await cache.list("u")  # первое чтение — из базы
+        repository.calls.clear()
+        for _ in range(20):
+            await cache.list("u")
+            await cache.get("u", query["id"])
+        assert repository.calls == []
+        assert cache.stats()["hits"] >= 40
+
+        # Запись другого воркера видна после истечения TTL: одна сверка версии и перечитывание
+        _repository(db_path).update("u", query["id"], name="changed elsewhere")
+        assert (await cache.get("u", query["id"]))["name"] == "a"
+        now[0] += 5
+        assert (await cache.get("u", query["id"]))["name"] == "changed elsewhere"
+        assert repository.calls == ["version", "list_versioned"]
+
+        # Версия не менялась — после TTL только сверка, и снова без обращений до следующего TTL
+        repository.calls.clear()
+        now[0] += 5
+        await cache.list("u")
+        await cache.list("u")
+        assert repository.calls == ["version"]
+
+    asyncio.run(run())
+
+
+def test_cache_is_bounded(db_path):
+    async def run():
+        cache = SavedQueryCache(_repository(db_path), max_users=2)
+        for user_id in ("u1", "u2", "u3"):
+            await cache.list(user_id)
+        assert cache.stats()["users"] == 2
+
+    asyncio.run(run())
+
+
+def test_legacy_file_moved_by_other_worker(tmp_path, db_path, monkeypatch):
+    legacy_path = tmp_path / "saved_queries.json"
+    legacy_path.write_text(json.dumps({"u": [{"id": 1, "name": "a", "stores": []}]}), encoding="utf-8")
+    repository = _repository(db_path, str(legacy_path))
+    real_exists = os.path.exists
+
+    def exists_then_moved(path):
+        # Файл есть при проверке, но до open() его переименовывает другой воркер
+        result = real_exists(path)
+        if path == str(legacy_path) and result:
+            os.replace(path, path + ".migrated")
+        return result
+
+    monkeypatch.setattr(os.path, "exists", exists_then_moved)
+    assert repository.list("u") == []
+    assert os.path.exists(str(legacy_path) + ".migrated")
@@ -0,0 +1,147 @@
+import asyncio
+import time
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+
+from send_scheduler import PRIORITY_HIGH, PRIORITY_NORMAL, SendScheduler
+
+
+def _run(scheduler, coro):
+    async def main():
+        scheduler.start()
+        try:
+            return await coro()
+        finally:
+            await scheduler.stop()
+
+    return asyncio.run(main())
+
+
+def test_messages_of_one_chat_keep_order_across_priorities():
+    scheduler = SendScheduler(global_rate=1000, chat_rate=1000, chat_burst=10)
+    sent = []
+
+    async def send(chat_id, n):
+        sent.append((chat_id, n))
+        return n
+
+    async def main():
+        priorities = [PRIORITY_NORMAL, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_HIGH]
+        return await asyncio.gather(*[
+            scheduler.submit(chat_id, lambda c=chat_id, n=n: send(c, n), priorities[n])
+            for chat_id in (1, 2, 3) for n in range(4)
+        ])
+
+    assert _run(scheduler, main) == [0, 1, 2, 3] * 3
+    for chat_id in (1, 2, 3):
+        assert [n for c, n in sent if c == chat_id] == [0, 1, 2, 3]
+
+
+def test_high_priority_chat_goes_first():
+    scheduler = SendScheduler(global_rate=5, chat_rate=1000, chat_burst=10)
+    sent = []
+
+    async def send(chat_id):
+        sent.append(chat_id)
+
+    async def main():
+        # Общих токенов нет: оба ждут, и первым уходит более приоритетный
+        scheduler.global_bucket.tokens = 0
+        await asyncio.gather(
+            scheduler.submit(1, lambda: send(1), PRIORITY_NORMAL),
+            scheduler.submit(2, lambda: send(2), PRIORITY_HIGH),
+        )
+
+    _run(scheduler, main)
+    assert sent == [2, 1]
+
+
+def test_chat_and_group_rates():
+    scheduler = SendScheduler(global_rate=1000, chat_rate=10, chat_burst=2, group_rate=5)
+    sent = []
+
+    async def send(chat_id):
+        sent.append((chat_id, time.monotonic()))
+
+    async def main():
+        await asyncio.gather(*[scheduler.submit(chat_id, lambda c=chat_id: send(c)) for chat_id in (7, -7) for _ in range(4)])
+
+    _run(scheduler, main)
+    private = [t for c, t in sent if c == 7]
+    group = [t for c, t in sent if c == -7]
+    # Серия из двух, затем 10/с; у группы серии нет, 5/с
+    assert private[3] - private[0] == pytest.approx(0.2, abs=0.06)
+    assert group[3] - group[0] == pytest.approx(0.6, abs=0.08)
+
+
+def test_retry_after_requeues_and_pauses_whole_bot():
+    scheduler = SendScheduler(global_rate=1000, chat_rate=1000, chat_burst=10)
+    attempts = []
+
+    async def send(chat_id, n):
+        attempts.append((chat_id, n, time.monotonic()))
+        if chat_id == 1 and n == 0 and len(attempts) == 1:
+            raise TelegramRetryAfter(method=None, message="Flood control", retry_after=1)
+        return n
+
+    async def main():
+        first = asyncio.ensure_future(scheduler.submit(1, lambda: send(1, 0)))
+        second = asyncio.ensure_future(scheduler.submit(1, lambda: send(1, 1)))
+        await asyncio.sleep(0.05)
+        other = await scheduler.submit(2, lambda: send(2, 0))
+        return await asyncio.gather(first, second), other
+
+    start = time.monotonic()
+    assert _run(scheduler, main) == ([0, 1], 0)
+    # После паузы первым уходит повтор (он раньше в очереди), другой чат тоже ждал
+    assert [(c, n) for c, n, _ in attempts] == [(1, 0), (1, 0), (2, 0), (1, 1)]
+    assert attempts[2][2] - start >= 0.95
+    assert scheduler.stats()["retry_after"] == 1
+
+
+def test_retry_after_gives_up_after_max_retries():
+    scheduler = SendScheduler(global_rate=1000, chat_rate=1000, max_retries=1)
+
+    async def flood():
+        raise TelegramRetryAfter(method=None, message="Flood control", retry_after=0)
+
+    async def main():
+        with pytest.raises(TelegramRetryAfter):
+            await scheduler.submit(1, flood)
+
+    _run(scheduler, main)
+    assert scheduler.stats()["failed"] == 1
+
+
+def test_many_chats_are_dispatched_quickly():
+    scheduler = SendScheduler(global_rate=100000, chat_rate=100000, chat_burst=100)
+
+    async def send():
+        return None
+
+    async def main():
+        start = time.monotonic()
+        await asyncio.gather(*[scheduler.submit(i % 2000, send) for i in range(20000)])
+        return time.monotonic() - start
+
+    assert _run(scheduler, main) < 5
+    assert scheduler.stats()["queued"] == 0
+
+
+def test_submit_requires_started_scheduler():
+    scheduler = SendScheduler()
+
+    async def send():
+        return "sent"
+
+    async def main():
+        with pytest.raises(RuntimeError):
+            await scheduler.submit(1, send)
+        scheduler.start()
+        assert await scheduler.submit(1, send) == "sent"
+        await scheduler.stop()
+        with pytest.raises(RuntimeError):
+            await scheduler.submit(1, send)
+
+    asyncio.run(asyncio.wait_for(main(), 5))
@@ -0,0 +1,128 @@
+import asyncio
+
+import pytest
+
+import redis_pool
+from session_backend import MemorySessionBackend, RedisSessionBackend
+
+
+def _redis_backend(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")  # Lua-скрипты в fakeredis
+    monkeypatch.setattr(redis_pool, "create_redis_client", lambda: fakeredis.FakeAsyncRedis())
+    return RedisSessionBackend()
+
+
+@pytest.fixture(params=["memory", "redis"])
+def run(request, monkeypatch):
+    """Выполняет сценарий на каждом бэкенде: поведение должно совпадать"""
+    backend = MemorySessionBackend() if request.param == "memory" else _redis_backend(monkeypatch)
+
+    def run_scenario(scenario):
+        async def main():
+            await backend.startup()
+            try:
+                return await scenario(backend)
+            finally:
+                await backend.shutdown()
+
+        return asyncio.run(main())
+
+    return run_scenario
+
+
+def test_state_and_user_data_roundtrip(run):
+    async def scenario(session):
+        assert await session.get_state(1) is None
+        assert await session.get_user_data(1) is None
+        await session.set_state(1, "entering_store")
+        await session.set_user_data(1, {"city": "Москва", "stores": ["Zara"], "current_query_id": 3})
+        return await session.get_state(1), await session.get_user_data(1)
+
+    state, data = run(scenario)
+    assert state == "entering_store"
+    assert data == {"city": "Москва", "stores": ["Zara"], "current_query_id": 3}
+
+
+def test_returned_data_is_a_copy(run):
+    async def scenario(session):
+        await session.set_user_data(1, {"stores": ["Zara"]})
+        (await session.get_user_data(1))["stores"].append("H&M")
+        return await session.get_user_data(1)
+
+    assert run(scenario) == {"stores": ["Zara"]}
+
+
+def test_append_store_is_case_insensitive(run):
+    async def scenario(session):
+        first = await session.append_store(1, "Zara")
+        duplicate = await session.append_store(1, "zara")
+        second = await session.append_store(1, "H&M")
+        return first, duplicate, second, await session.get_user_data(1)
+
+    first, duplicate, second, data = run(scenario)
+    assert first == (True, ["Zara"])
+    assert duplicate == (False, ["Zara"])
+    assert second == (True, ["Zara", "H&M"])
+    assert data["stores"] == ["Zara", "H&M"]
+
+
+def test_append_store_folds_cyrillic_case(run):
+    async def scenario(session):
+        first = await session.append_store(1, "Ателье")
+        duplicate = await session.append_store(1, "АТЕЛЬЕ")
+        await session.append_store(1, "Zara")
+        await session.pop_store(1, 0)
+        # После удаления по индексу ключи сравнения остаются согласованы со списком
+        readded = await session.append_store(1, "ателье")
+        duplicate_after_pop = await session.append_store(1, "ZARA")
+        return first, duplicate, readded, duplicate_after_pop, await session.get_user_data(1)
+
+    first, duplicate, readded, duplicate_after_pop, data = run(scenario)
+    assert first == (True, ["Ателье"])
+    assert duplicate == (False, ["Ателье"])
+    assert readded == (True, ["Zara", "ателье"])
+    assert duplicate_after_pop == (False, ["Zara", "ателье"])
+    assert data["stores"] == ["Zara", "ателье"]
+
+
+def test_append_store_after_set_user_data(run):
+    async def scenario(session):
+        await session.set_user_data(1, {"city": "Москва", "stores": ["Ёлка", "Ателье"]})
+        return await session.append_store(1, "ёЛКА"), await session.get_user_data(1)
+
+    result, data = run(scenario)
+    assert result == (False, ["Ёлка", "Ателье"])
+    assert data == {"city": "Москва", "stores": ["Ёлка", "Ателье"]}
+
+
+def test_pop_store(run):
+    async def scenario(session):
+        await session.set_user_data(1, {"city": "Москва", "stores": ["Zara", "H&M", "Lush"]})
+        return [
+            await session.pop_store(1, 1),
+            await session.pop_store(1, -1),
+            await session.pop_store(1, 5),
+            await session.pop_store(2, 0),
+        ]
+
+    assert run(scenario) == [("H&M", ["Zara", "Lush"]), ("Lush", ["Zara"]), (None, ["Zara"]), (None, [])]
+
+
+def test_reset_search_keeps_city_and_drops_legacy_index(run):
+    async def scenario(session):
+        await session.set_user_data(1, {"city": "Москва", "stores": ["Zara"], "current_query_index": 2, "current_query_id": 5})
+        result = await session.reset_search(1)
+        return result, await session.get_user_data(1)
+
+    result, data = run(scenario)
+    assert result == []
+    assert data == {"city": "Москва", "stores": [], "current_query_id": None}
+
+
+def test_concurrent_appends_are_not_lost(run):
+    async def scenario(session):
+        await asyncio.gather(*[session.append_store(1, f"store {i}") for i in range(50)])
+        return await session.get_user_data(1)
+
+    assert sorted(run(scenario)["stores"]) == sorted(f"store {i}" for i in range(50))
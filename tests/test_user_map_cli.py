@@ -0,0 +1,59 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import ROOT
+from migration_tools.utils import get_user_uuid
+
+SCRIPT = os.path.join(ROOT, "migration_tools", "user_id_map_crypto.py")
+
+
+@pytest.fixture
+def run_cli(tmp_path):
+    env = dict(
+        os.environ,
+        USER_MAP_KEY_FILE=str(tmp_path / "user_map.key"),
+        USER_MAP_FILE=str(tmp_path / "user_map.enc"),
+        USER_MAP_RECORDS_FILE=str(tmp_path / "user_map.records"),
+    )
+    env.pop("USER_MAP_SECRET", None)
+
+    def run(*args, stdin=None):
+        result = subprocess.run(
+            [sys.executable, SCRIPT, *args], cwd=tmp_path, env=env,
+            input=stdin, capture_output=True, text=True, timeout=60,
+        )
+        assert result.returncode == 0, result.stderr
+        return result.stdout
+
+    return run
+
+
+def test_add_and_lookup(run_cli):
+    uuid5 = get_user_uuid("5")
+    assert f"Добавлен: 5 -> {uuid5}" in run_cli("--add", "5")
+    assert f"Уже есть: 5 -> {uuid5}" in run_cli("--add", "5")
+    assert run_cli("--get-uuid", "5").strip() == uuid5
+    assert run_cli("--get-user-id", uuid5).strip() == "5"
+
+
+def test_get_user_ids_from_file_and_stdin(run_cli, tmp_path):
+    run_cli("--add", "5")
+    run_cli("--add", "6")
+    unknown = get_user_uuid("7")
+    (tmp_path / "uuids.txt").write_text(f"{get_user_uuid('5')}\n{unknown}\n", encoding="utf-8")
+    assert run_cli("--get-user-ids", "uuids.txt").splitlines() == [f"{get_user_uuid('5')}\t5", f"{unknown}\t"]
+    assert run_cli("--get-user-ids", "-", stdin=get_user_uuid("6") + "\n").splitlines() == [f"{get_user_uuid('6')}\t6"]
+
+
+def test_export_and_compact(run_cli, tmp_path):
+    run_cli("--add", "5")
+    run_cli("--add", "6")
+    assert "Экспортировано" in run_cli("--export")
+    exported = json.loads((tmp_path / "user_map_decrypted.json").read_text(encoding="utf-8"))
+    assert exported == {"5": get_user_uuid("5"), "6": get_user_uuid("6")}
+    assert "перезаписан" in run_cli("--compact")
+    assert run_cli("--get-uuid", "6").strip() == get_user_uuid("6")
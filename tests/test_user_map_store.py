@@ -0,0 +1,54 @@
+import asyncio
+import json
+
+from migration_tools.user_id_map_crypto import MappingRegistrar, UserMapStore
+from migration_tools.utils import get_user_uuid
+
+
+def _store(tmp_path):
+    return UserMapStore(path=str(tmp_path / "user_map.records"), legacy_path=str(tmp_path / "user_map.enc"))
+
+
+def test_add_many_skips_known_ids(tmp_path):
+    store = _store(tmp_path)
+    assert store.add_many([1, "2", 1]) == ["1", "2"]
+    assert store.add_many(["2", "3"]) == ["3"]
+    assert store.get_uuid(3) == get_user_uuid("3")
+    assert store.get_user_ids([get_user_uuid("1"), "missing"]) == {get_user_uuid("1"): "1", "missing": None}
+
+
+def test_other_instance_sees_appended_records(tmp_path):
+    first, second = _store(tmp_path), _store(tmp_path)
+    first.add_many(["1"])
+    assert second.get_uuid("1") == get_user_uuid("1")
+    first.add_many(["2"])
+    assert second.get_user_id(get_user_uuid("2")) == "2"
+    # После компакции файл заменён — второй экземпляр перечитывает его целиком
+    first.compact()
+    first.add_many(["3"])
+    assert second.mapping() == {str(i): get_user_uuid(str(i)) for i in (1, 2, 3)}
+
+
+def test_legacy_blob_is_migrated_once(tmp_path):
+    store = _store(tmp_path)
+    legacy = {"10": get_user_uuid("10"), "11": get_user_uuid("11")}
+    (tmp_path / "user_map.enc").write_bytes(store.fernet.encrypt(json.dumps(legacy).encode("utf-8")))
+    assert store.mapping() == legacy
+    assert not (tmp_path / "user_map.enc").exists()
+    assert (tmp_path / "user_map.enc.migrated").exists()
+    assert _store(tmp_path).mapping() == legacy
+
+
+def test_registrar_flushes_queue_on_stop(tmp_path):
+    store = _store(tmp_path)
+
+    async def run():
+        registrar = MappingRegistrar(store, batch_size=2, flush_interval=10)
+        await registrar.start()
+        for user_id in range(5):
+            registrar.register(user_id)
+        registrar.register(0)  # уже в очереди
+        await registrar.stop()
+
+    asyncio.run(run())
+    assert _store(tmp_path).mapping() == {str(i): get_user_uuid(str(i)) for i in range(5)}